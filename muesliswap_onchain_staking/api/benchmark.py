@@ -0,0 +1,249 @@
+"""
+Benchmarks for the chain querier.
+Blocks are recorded once from ogmios and then replayed into fresh databases, so that the
+different ingestion modes can be compared on identical input.
+
+    python -m muesliswap_onchain_staking.api.benchmark record --out blocks.jsonl
+    python -m muesliswap_onchain_staking.api.benchmark ingest --blocks blocks.jsonl
+
+The farms query is benchmarked on synthetic farms with a growing number of reward tokens.
+
+    python -m muesliswap_onchain_staking.api.benchmark farms_query --farms 200
+"""
+
+import json
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+from ..utils.network import ogmios_url
+from . import ogmios_iterator
+from .chain_querier import process_block
+from .db_models import (
+    MODELS,
+    CurrentFarm,
+    FarmCumulativeRewardPerToken,
+    FarmEmissionRate,
+    FarmParams,
+    FarmRewardToken,
+    Token,
+    database,
+    init_database,
+)
+from .db_queries.farms import farms_queries
+from .tx_filter import default_tx_filter
+from .tx_processor import TrackedOutputs, to_db
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def record(out: str = "blocks.jsonl", blocks: int = 1000):
+    """
+    Record the next blocks after the configured start block to a file.
+    """
+    recorded = 0
+    with open(out, "w") as f:
+        for operation in ogmios_iterator.OgmiosIterator(ogmios_url).iterate_blocks([]):
+            if not isinstance(operation, ogmios_iterator.Rollforward):
+                continue
+            f.write(json.dumps(operation.block) + "\n")
+            recorded += 1
+            if recorded >= blocks:
+                break
+    print(f"Recorded {recorded} blocks to {out}")
+
+
+def _load_blocks(blocks: str) -> list[dict]:
+    with open(blocks) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _use_fresh_database(path: Path):
+    init_database(f"sqlite:///{path}")
+    database.connect()
+    database.create_tables(MODELS)
+    to_db.clear_caches(reset_stats=True)
+
+
+def ingest(
+    blocks: str = "blocks.jsonl",
+    modes: tuple = ("direct", "bulk"),
+    prefilter: bool = True,
+):
+    """
+    Replay the recorded blocks into a fresh database for each ingestion mode.
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    block_data = _load_blocks(blocks)
+    n_txs = sum(len(b.get("transactions", [])) for b in block_data)
+    tx_filter = default_tx_filter() if prefilter else None
+
+    print(f"{len(block_data)} blocks, {n_txs} transactions")
+    for name, decode_filter in (("decode", None), ("prefilter", default_tx_filter())):
+        start = time.perf_counter()
+        for b in block_data:
+            ogmios_iterator.txs_from_block(b, decode_filter)
+        print(f"{name + ' only':>14}: {time.perf_counter() - start:8.2f}s")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in modes:
+            _use_fresh_database(Path(tmp_dir).joinpath(f"{mode}.db"))
+            tracked_outputs = TrackedOutputs()
+            start = time.perf_counter()
+            for b in block_data:
+                process_block(
+                    b, tracked_outputs, bulk=mode == "bulk", tx_filter=tx_filter
+                )
+            elapsed = time.perf_counter() - start
+            print(
+                f"{mode:>14}: {elapsed:8.2f}s, "
+                f"{len(block_data) / elapsed:8.1f} blocks/s, "
+                f"{n_txs / elapsed:8.1f} txs/s"
+            )
+            for name, stats in to_db.cache_stats().items():
+                print(f"{name + ' cache':>14}: {stats['hit_rate']:8.1%} hit rate")
+        database.close()
+
+
+# the farms query before reward tokens, emission rates and cumulative rewards were queried separately
+_CARTESIAN_FARMS_QUERY = """
+    SELECT
+    fp.pool_id,
+    tk2.policy_id,
+    tk2.asset_name,
+    fp.farm_type,
+    fp.last_update_time,
+    fp.amount_staked,
+    group_concat(tk.policy_id, ';'),
+    group_concat(tk.asset_name, ';'),
+    group_concat(frt.idx, ';'),
+    group_concat(fer.emission_rate, ';'),
+    group_concat(fer.idx, ';'),
+    group_concat(fcrpt.cumulative_reward_per_token_numerator, ';'),
+    group_concat(fcrpt.cumulative_reward_per_token_denominator, ';'),
+    group_concat(fcrpt.idx, ';')
+    FROM
+    currentfarm cf
+    JOIN farmparams fp ON cf.farm_params_id = fp.id
+    JOIN farmrewardtoken frt ON frt.farm_params_id = fp.id
+    JOIN token tk on frt.token_id = tk.id
+    JOIN farmemissionrate fer ON fer.farm_params_id = fp.id
+    JOIN farmcumulativerewardpertoken fcrpt ON fcrpt.farm_params_id = fp.id
+    JOIN token tk2 on fp.stake_token_id = tk2.id
+    GROUP BY cf.pool_id, cf.farm_params_id, fp.id, tk2.id
+    ORDER BY cf.pool_id ASC
+    """
+
+
+def _add_synthetic_farms(farms: int, reward_tokens: int):
+    # only the tables read by the farms query are filled, the chain data they refer to is left out
+    database.pragma("foreign_keys", 0)
+    with database.atomic():
+        _insert_synthetic_farms(farms, reward_tokens)
+    database.pragma("foreign_keys", 1)
+
+
+def _insert_synthetic_farms(farms: int, reward_tokens: int):
+    Token.insert_many(
+        [(f"{i:056x}", "") for i in range(reward_tokens + 1)],
+        fields=[Token.policy_id, Token.asset_name],
+    ).execute()
+    for start in range(0, farms, 100):
+        ids = range(start + 1, min(start + 100, farms) + 1)
+        FarmParams.insert_many(
+            [
+                (i, f"{i:064x}", 1, "default", "2024-01-01 00:00:00", 10**9)
+                for i in ids
+            ],
+            fields=[
+                FarmParams.id,
+                FarmParams.pool_id,
+                FarmParams.stake_token,
+                FarmParams.farm_type,
+                FarmParams.last_update_time,
+                FarmParams.amount_staked,
+            ],
+        ).execute()
+        CurrentFarm.insert_many(
+            [(i, i, i, f"{i:064x}") for i in ids],
+            fields=[
+                CurrentFarm.transaction_output,
+                CurrentFarm.farm_state,
+                CurrentFarm.farm_params,
+                CurrentFarm.pool_id,
+            ],
+        ).execute()
+        for idx in range(reward_tokens):
+            FarmRewardToken.insert_many(
+                [(i, idx + 2, idx) for i in ids],
+                fields=[
+                    FarmRewardToken.farm_params,
+                    FarmRewardToken.token,
+                    FarmRewardToken.idx,
+                ],
+            ).execute()
+            FarmEmissionRate.insert_many(
+                [(i, 10**6, idx) for i in ids],
+                fields=[
+                    FarmEmissionRate.farm_params,
+                    FarmEmissionRate.emission_rate,
+                    FarmEmissionRate.idx,
+                ],
+            ).execute()
+            FarmCumulativeRewardPerToken.insert_many(
+                [(i, 0, 1, idx) for i in ids],
+                fields=[
+                    FarmCumulativeRewardPerToken.farm_params,
+                    FarmCumulativeRewardPerToken.cumulative_reward_per_token_numerator,
+                    FarmCumulativeRewardPerToken.cumulative_reward_per_token_denominator,
+                    FarmCumulativeRewardPerToken.idx,
+                ],
+            ).execute()
+
+
+def _time_queries(queries: list[str], repeat: int) -> tuple[int, float]:
+    # rows returned by the queries and the best latency of running them all
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = sum(len(database.execute_sql(sql).fetchall()) for sql in queries)
+        best = min(best, time.perf_counter() - start)
+    return rows, best
+
+
+def farms_query(farms: int = 200, reward_tokens: tuple = (1, 2, 4, 8), repeat: int = 5):
+    """
+    Compare the farms query joining all child tables at once with the separate child queries,
+    for farms with a growing number of reward tokens.
+    """
+    print(
+        f"{'tokens':>6} {'joined rows':>12} {'old rows':>9} {'old ms':>8} "
+        f"{'new rows':>9} {'new ms':>8}"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in reward_tokens:
+            _use_fresh_database(Path(tmp_dir).joinpath(f"farms_{n}.db"))
+            _add_synthetic_farms(farms, n)
+            # rows the old query aggregated, every combination of the child rows of a farm
+            joined = database.execute_sql(
+                """
+                SELECT COUNT(*) FROM currentfarm cf
+                JOIN farmrewardtoken frt ON frt.farm_params_id = cf.farm_params_id
+                JOIN farmemissionrate fer ON fer.farm_params_id = cf.farm_params_id
+                JOIN farmcumulativerewardpertoken fcrpt ON fcrpt.farm_params_id = cf.farm_params_id
+                """
+            ).fetchone()[0]
+            old_rows, old_time = _time_queries([_CARTESIAN_FARMS_QUERY], repeat)
+            new_rows, new_time = _time_queries(list(farms_queries()), repeat)
+            print(
+                f"{n:>6} {joined:>12} {old_rows:>9} {old_time * 1000:>8.2f} "
+                f"{new_rows:>9} {new_time * 1000:>8.2f}"
+            )
+            database.close()
+
+
+if __name__ == "__main__":
+    fire.Fire({"record": record, "ingest": ingest, "farms_query": farms_query})
@@ -3,33 +3,113 @@ The main file containing the logic for starting the querier.
 The querier syncs with the blockchain, listening for new blocks and updating the database accordingly.
 """
 
+import asyncio
 import logging
+from typing import Optional
 
 import fire
-from muesliswap_onchain_staking.api.tx_processor import process_tx
+from muesliswap_onchain_staking.api.tx_processor import (
+    process_tx,
+    address_credentials,
+    current_state,
+    farm_history,
+    to_db,
+    BlockWriter,
+    TrackedOutputs,
+)
 
 from ..utils.network import ogmios_url
-from . import ogmios_iterator
-from .db_models import Block, TransactionOutput
+from . import ogmios_iterator, rollback
+from .change_feed import CHANGE_FEED_URL, Publisher, make_publisher
+from .db_models import (
+    Block,
+    CurrentFarm,
+    FarmSnapshot,
+    FarmState,
+    TransactionOutput,
+    database,
+)
+from .db_queries.changes import block_changes
+from .tx_filter import TxPreFilter, default_tx_filter
+from .util import FixedTxHashTransaction, UndecodedTransaction
 
 _LOGGER = logging.getLogger(__name__)
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO, force=True
 )
 
+# log the hit rates of the lookup caches every this many blocks
+CACHE_STATS_INTERVAL = 1000
+# drop the undo journal of final blocks every this many blocks
+JOURNAL_PRUNE_INTERVAL = 100
 
-def main(rollback_to_slot: int = None, debug_sql: bool = False):
+
+def relevant_txs(
+    txs: list[FixedTxHashTransaction | UndecodedTransaction],
+    tracked_outputs: TrackedOutputs,
+):
     """
-    Start the querier.
+    Yield the decoded transactions with their index in the block.
+    Transactions that were skipped by the pre-filter are only decoded if they spend tracked outputs.
+    This is done lazily, so that outputs created earlier in the same block are already tracked.
     """
-    if debug_sql:
-        logger = logging.getLogger("peewee")
-        logger.addHandler(logging.StreamHandler())
-        logger.setLevel(logging.DEBUG)
+    for i, tx in enumerate(txs):
+        if isinstance(tx, UndecodedTransaction):
+            if not tracked_outputs.spends_any(tx.input_tx_hashes):
+                continue
+            tx = ogmios_iterator.decode_tx(tx.hash, tx.cbor)
+            if tx is None:
+                continue
+        yield i, tx
 
-    _LOGGER.info("Starting the querier")
-    if rollback_to_slot is not None:
-        Block.delete().where(Block.slot > rollback_to_slot).execute()
+
+def process_block(
+    block_data: dict,
+    tracked_outputs: TrackedOutputs,
+    bulk: bool = True,
+    txs: Optional[list[FixedTxHashTransaction | UndecodedTransaction]] = None,
+    tx_filter: Optional[TxPreFilter] = None,
+) -> Block:
+    """
+    Store the block and process all of its transactions.
+    In bulk mode, all rows of the block are written in a single database transaction.
+    The transactions are decoded from the block unless they are passed already decoded.
+    """
+    block = ogmios_iterator.tip_from_block(block_data)
+    if txs is None:
+        txs = ogmios_iterator.txs_from_block(block_data, tx_filter)
+    _LOGGER.info(f"Processing block {block.id}")
+    if not bulk:
+        db_block = Block.create(hash=block.id, slot=block.slot, height=block.height)
+        try:
+            writer = BlockWriter(db_block, tracked_outputs, bulk=False)
+            for i, tx in relevant_txs(txs, tracked_outputs):
+                process_tx(tx, writer, i)
+        except Exception:
+            rollback.revert_blocks([db_block.id])
+            tracked_outputs.load()
+            to_db.clear_caches()
+            raise
+        return db_block
+
+    try:
+        with database.atomic():
+            db_block = Block.create(hash=block.id, slot=block.slot, height=block.height)
+            writer = BlockWriter(db_block, tracked_outputs)
+            for i, tx in relevant_txs(txs, tracked_outputs):
+                process_tx(tx, writer, i)
+            writer.flush()
+    except Exception:
+        tracked_outputs.load()
+        to_db.clear_caches()
+        raise
+    return db_block
+
+
+def sync_points() -> list[ogmios_iterator.Point]:
+    """
+    Points to intersect the chain with, derived from the latest persisted blocks.
+    """
     sync_blocks = [
         Block.select().order_by(Block.slot.desc()).first(),
         Block.select().order_by(Block.slot.desc()).offset(1).first(),
@@ -37,54 +117,155 @@ def main(rollback_to_slot: int = None, debug_sql: bool = False):
         Block.select().order_by(Block.slot.desc()).offset(50).first(),
         Block.select().order_by(Block.slot.desc()).offset(1000).first(),
     ]
+    return [
+        ogmios_iterator.Point(slot=block.slot, id=block.hash)
+        for block in sync_blocks
+        if block is not None
+    ]
 
-    tracked_gov_states = []
-    tracked_treasury_states = []
-
-    for operation in ogmios_iterator.OgmiosIterator(ogmios_url).iterate_blocks(
-        [
-            ogmios_iterator.Point(slot=block.slot, id=block.hash)
-            for block in sync_blocks
-            if block is not None
-        ]
-    ):
-        if isinstance(operation, ogmios_iterator.Rollback):
-            if isinstance(operation.tip, ogmios_iterator.Origin):
-                _LOGGER.info("Rollback to origin")
-                Block.delete().execute()
-                continue
-            else:
-                _LOGGER.info(f"Rollback to tip {str(operation.tip)}")
-                Block.delete().where(Block.slot > operation.tip.slot).execute()
-                # At least one Rollback is executed once after each restart, so we can be sure this is initialized correctly
-                #                tracked_gov_states = list(
-                #                    GovState.select()
-                #                    .join(TransactionOutput)
-                #                    .where(TransactionOutput.spent_in_block.is_null())
-                #                )
-                #                tracked_treasury_states = list(
-                #                    TreasurerState.select()
-                #                    .join(TransactionOutput)
-                #                    .where(TransactionOutput.spent_in_block.is_null())
-                #                )
-                continue
+
+def handle_operation(
+    operation: ogmios_iterator.NextBlockResult,
+    tracked_outputs: TrackedOutputs,
+    bulk: bool = True,
+    tx_filter: Optional[TxPreFilter] = None,
+    publisher: Optional[Publisher] = None,
+):
+    """
+    Apply a rollback or a new block to the database and publish the changes.
+    """
+    if isinstance(operation, ogmios_iterator.Rollback):
+        if isinstance(operation.tip, ogmios_iterator.Origin):
+            _LOGGER.info("Rollback to origin")
+            slot = None
         else:
-            block = ogmios_iterator.tip_from_block(operation.block)
-            db_block = Block(hash=block.id, slot=block.slot, height=block.height)
-            db_block.save()
-            try:
-                _LOGGER.info(f"Processing block {block.id}")
-                for i, tx in enumerate(ogmios_iterator.txs_from_block(operation.block)):
-                    process_tx(
-                        tx,
-                        db_block,
-                        i,
-                        # tracked_gov_states, tracked_treasury_states
-                    )
-            except Exception as e:
-                _LOGGER.info(f"Error processing block {block.id}: {e}")
-                db_block.delete_instance()
-                raise
+            _LOGGER.info(f"Rollback to tip {str(operation.tip)}")
+            slot = operation.tip.slot
+        rollback.rollback_to(slot)
+        tracked_outputs.load()
+        to_db.clear_caches()
+        if publisher is not None and publisher.active:
+            publisher.publish({"type": "rollback", "slot": slot})
+        return
+    try:
+        db_block = process_block(
+            operation.block,
+            tracked_outputs,
+            bulk=bulk,
+            txs=operation.txs,
+            tx_filter=tx_filter,
+        )
+    except Exception as e:
+        _LOGGER.info(f"Error processing block {operation.block.get('id')}: {e}")
+        raise
+    if publisher is not None and publisher.active:
+        publisher.publish({"type": "block", **block_changes(db_block)})
+    if operation.block.get("height", 0) % JOURNAL_PRUNE_INTERVAL == 0:
+        rollback.prune_journal()
+    if operation.block.get("height", 0) % CACHE_STATS_INTERVAL == 0:
+        _LOGGER.info(f"Lookup cache stats: {to_db.cache_stats()}")
+
+
+def prepare_database():
+    """
+    Build the derived tables that are missing and decompose the credentials of stored addresses,
+    before following the chain.
+    """
+    if not CurrentFarm.select().exists() and FarmState.select().exists():
+        _LOGGER.info("Building the current state tables")
+        current_state.rebuild()
+    if not FarmSnapshot.select().exists() and FarmState.select().exists():
+        _LOGGER.info("Building the farm history")
+        farm_history.rebuild()
+    # incremental, only addresses stored before they were decomposed on insertion are left
+    address_credentials.backfill()
+
+
+async def sync_chain(
+    bulk: bool = True,
+    in_flight: int = 100,
+    prefilter: bool = True,
+    publisher: Optional[Publisher] = None,
+):
+    """
+    Follow the chain with the asyncio ogmios client, which reconnects on connection loss.
+    The database is written from a worker thread, so this can also run as a task
+    inside the event loop of the API server.
+    """
+    await asyncio.to_thread(prepare_database)
+    tracked_outputs = TrackedOutputs()
+    await asyncio.to_thread(tracked_outputs.load)
+    tx_filter = default_tx_filter() if prefilter else None
+    iterator = ogmios_iterator.AsyncOgmiosIterator(
+        ogmios_url, sync_points, in_flight=in_flight
+    )
+    async for operation in iterator.iterate_blocks():
+        await asyncio.to_thread(
+            handle_operation, operation, tracked_outputs, bulk, tx_filter, publisher
+        )
+
+
+def main(
+    rollback_to_slot: int = None,
+    debug_sql: bool = False,
+    bulk: bool = True,
+    in_flight: int = 100,
+    decode_workers: int = 0,
+    prefilter: bool = True,
+    use_async: bool = False,
+    change_feed_url: str = CHANGE_FEED_URL,
+):
+    """
+    Start the querier.
+    With decode_workers > 0, blocks are received and decoded in a pipeline
+    and only written to the database on the main thread.
+    With prefilter, only transactions that may be relevant are fully decoded.
+    With use_async, the asyncio ogmios client is used, which reconnects on connection loss.
+    Changes are published to the change feed at change_feed_url if it is a Redis URL.
+    """
+    if debug_sql:
+        logger = logging.getLogger("peewee")
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.DEBUG)
+
+    _LOGGER.info("Starting the querier")
+    if rollback_to_slot is not None:
+        rollback.rollback_to(rollback_to_slot)
+
+    publisher = make_publisher(change_feed_url)
+    if use_async:
+        asyncio.run(
+            sync_chain(
+                bulk=bulk,
+                in_flight=in_flight,
+                prefilter=prefilter,
+                publisher=publisher,
+            )
+        )
+        return
+
+    prepare_database()
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.load()
+
+    tx_filter = default_tx_filter() if prefilter else None
+    if decode_workers > 0:
+        iterator = ogmios_iterator.PipelinedOgmiosIterator(
+            ogmios_url,
+            in_flight=in_flight,
+            workers=decode_workers,
+            tx_filter=tx_filter,
+        )
+    else:
+        iterator = ogmios_iterator.OgmiosIterator(ogmios_url, in_flight=in_flight)
+    for operation in iterator.iterate_blocks(sync_points()):
+        handle_operation(
+            operation,
+            tracked_outputs,
+            bulk=bulk,
+            tx_filter=tx_filter,
+            publisher=publisher,
+        )
 
 
 if __name__ == "__main__":
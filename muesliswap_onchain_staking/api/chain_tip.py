@@ -0,0 +1,94 @@
+"""
+Tracks the latest block processed by the chain querier, as seen by the API server.
+The querier may run in another process, so the tip is polled from the database.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+from .db_queries import Repository
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ChainTip:
+    def __init__(self, repository: Repository, poll_interval: float = 1):
+        self.repository = repository
+        self.poll_interval = poll_interval
+        self.block: Optional[dict] = None
+        # called with the new block whenever the tip changes
+        self.listeners: list[Callable[[Optional[dict]], Awaitable]] = []
+        self._changed = asyncio.Condition()
+
+    @property
+    def hash(self) -> str:
+        return self.block["hash"] if self.block is not None else ""
+
+    async def poll(self) -> bool:
+        """
+        Fetch the latest block, returns whether it changed.
+        """
+        block = await self.repository.latest_block()
+        if block == self.block:
+            return False
+        # listeners are updated first, so that requests never see the new tip with stale state
+        for listener in self.listeners:
+            await listener(block)
+        self.block = block
+        async with self._changed:
+            self._changed.notify_all()
+        return True
+
+    async def wait_for_change(self):
+        async with self._changed:
+            await self._changed.wait()
+
+    async def follow(self):
+        """
+        Keep polling the latest block, to be run as a task.
+        """
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                _LOGGER.warning(f"Could not fetch the latest block: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+
+class WalletMarkers:
+    """
+    Per-wallet change markers, to be registered as a listener of the chain tip.
+    The marker of a wallet is the hash of the last block that changed its staking positions,
+    or of the block at which tracking started (or restarted) if no block changed them since.
+    Tracking restarts after a rollback and when more than `maxsize` wallets are tracked.
+    """
+
+    def __init__(self, repository: Repository, maxsize: int = 100000):
+        self.repository = repository
+        self.maxsize = maxsize
+        self.block: Optional[dict] = None
+        self.baseline = ""
+        self.changes: dict[str, str] = {}
+
+    def marker(self, wallet: str) -> str:
+        return self.changes.get(wallet, self.baseline)
+
+    def _restart(self, block: Optional[dict]):
+        self.baseline = block["hash"] if block is not None else ""
+        self.changes.clear()
+
+    async def update(self, block: Optional[dict]):
+        if (
+            self.block is None
+            or block is None
+            or not await self.repository.block_exists(self.block["hash"])
+        ):
+            self._restart(block)
+        else:
+            changed = await self.repository.wallets_changed_since(self.block["slot"])
+            for wallet in changed:
+                self.changes[wallet] = block["hash"]
+            if len(self.changes) > self.maxsize:
+                self._restart(block)
+        self.block = block
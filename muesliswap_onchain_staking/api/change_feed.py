@@ -0,0 +1,125 @@
+"""
+Push feed of the changes made by the chain querier.
+
+After every block, the querier publishes a "block" event with the updated farms and the created
+and spent staking positions, and a "rollback" event for every rollback.
+The channel is selected by CHANGE_FEED_URL:
+
+    memory          in-process, for a chain querier running inside the API (SYNC_CHAIN_IN_API)
+    redis://host    Redis pub/sub, for a separate chain querier process, requires the redis package
+"""
+
+import asyncio
+import logging
+import os
+from contextlib import contextmanager
+from typing import Iterator, Optional, Protocol
+
+import orjson
+
+_LOGGER = logging.getLogger(__name__)
+
+CHANGE_FEED_URL = os.getenv("CHANGE_FEED_URL", "memory")
+CHANGE_FEED_CHANNEL = "staking-api:changes"
+
+
+class Publisher(Protocol):
+    # whether anyone may receive the events, so that they need to be computed
+    active: bool
+
+    def publish(self, event: dict):
+        ...
+
+
+class ChangeFeed:
+    """
+    In-process fan-out of events to the subscribers of the API server.
+    Events may be published from any thread. Subscribers that fall behind by more than
+    `queue_size` events are disconnected, so that they reconnect instead of blocking the feed.
+    """
+
+    def __init__(self, queue_size: int = 1000):
+        self.queue_size = queue_size
+        self._subscribers: set[asyncio.Queue] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def active(self) -> bool:
+        return bool(self._subscribers)
+
+    def publish(self, event: dict):
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event: dict):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._subscribers.discard(queue)
+                # make room for the end of stream marker
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    @contextmanager
+    def subscription(self) -> Iterator[asyncio.Queue]:
+        """
+        A queue receiving the published events, ended by None when the subscriber falls behind.
+        """
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers.discard(queue)
+
+
+class RedisPublisher:
+    """
+    Publishes the events of a separate chain querier process to Redis.
+    """
+
+    active = True
+
+    def __init__(self, url: str):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+
+    def publish(self, event: dict):
+        try:
+            self._redis.publish(CHANGE_FEED_CHANNEL, orjson.dumps(event))
+        except Exception as e:
+            # the feed must never stop the querier
+            _LOGGER.warning(f"Could not publish to the change feed: {e}")
+
+
+async def relay_from_redis(url: str, feed: ChangeFeed):
+    """
+    Forward the events published to Redis to the in-process feed, to be run as a task.
+    """
+    from redis import asyncio as aioredis
+
+    while True:
+        try:
+            pubsub = aioredis.from_url(url).pubsub()
+            await pubsub.subscribe(CHANGE_FEED_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    feed.publish(orjson.loads(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _LOGGER.warning(f"Lost the change feed relay, reconnecting: {e}")
+            await asyncio.sleep(1)
+
+
+def make_publisher(url: str) -> Optional[Publisher]:
+    """
+    The publisher for a chain querier running in its own process.
+    """
+    if url.startswith("redis"):
+        return RedisPublisher(url)
+    return None
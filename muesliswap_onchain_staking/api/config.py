@@ -3,7 +3,7 @@ from pycardano import Network
 from ..utils.contracts import module_name
 from ..utils import network, contracts
 
-from ..onchain import unstake_permission_nft, farm_nft, staking
+from ..onchain import unstake_permission_nft, farm_nft, staking, batching
 
 # Only these scripts need to be hardcoded
 # And should also change seldomly
@@ -16,6 +16,9 @@ _, farm_nft_policy_id, _ = contracts.get_contract(
 _, _, staking_address = contracts.get_contract(
     module_name(staking), compressed=True
 )
+_, _, batching_address = contracts.get_contract(
+    module_name(batching), compressed=True
+)
 
 # default: start from a block around 19 feb 2024
 START_BLOCK_SLOT = 68_140_523 if network == Network.TESTNET else 125_125_931
@@ -23,4 +26,7 @@ START_BLOCK_HASH = (
     "a428110ff5024d82ea02020ec66581ff8ac7da2ca0fe702c27d3d98daa7bc6d6"
     if network == Network.TESTNET
     else "bde676ad40372bde8cd778c035ac606976c07ec7dde261f313f3ea39cc196c74"
-)
\ No newline at end of file
+)
+
+# maximum number of blocks that can be rolled back (k), identical on mainnet and preprod
+SECURITY_PARAMETER = 2160
@@ -1,5 +1,6 @@
 from .db import (
     Block,
+    UndoEntry,
     Address,
     Datum,
     Token,
@@ -8,12 +9,17 @@ from .db import (
     Transaction,
     TransactionOutput,
     TransactionOutputValue,
-    sqlite_db,
+    database,
+    add_missing_columns,
+    init_database,
+    is_postgres,
+    SQLITE_PRAGMAS,
 )
 from .staking import (
     StakingParams,
     StakingState,
     StakingCumulativePoolRptsAtStart,
+    CurrentStakingPosition,
 )
 from .farms import (
     FarmState,
@@ -21,25 +27,32 @@ from .farms import (
     FarmRewardToken,
     FarmEmissionRate,
     FarmCumulativeRewardPerToken,
+    CurrentFarm,
+    FarmSnapshot,
 )
 
-sqlite_db.connect()
-sqlite_db.create_tables(
-    [
-        Block,
-        Address,
-        Datum,
-        Token,
-        Transaction,
-        TransactionOutput,
-        TransactionOutputValue,
-        StakingParams,
-        StakingState,
-        StakingCumulativePoolRptsAtStart,
-        FarmState,
-        FarmParams,
-        FarmRewardToken,
-        FarmEmissionRate,
-        FarmCumulativeRewardPerToken,
-    ]
-)
+MODELS = [
+    Block,
+    UndoEntry,
+    Address,
+    Datum,
+    Token,
+    Transaction,
+    TransactionOutput,
+    TransactionOutputValue,
+    StakingParams,
+    StakingState,
+    StakingCumulativePoolRptsAtStart,
+    FarmState,
+    FarmParams,
+    FarmRewardToken,
+    FarmEmissionRate,
+    FarmCumulativeRewardPerToken,
+    CurrentFarm,
+    CurrentStakingPosition,
+    FarmSnapshot,
+]
+
+database.connect()
+add_missing_columns(MODELS)
+database.create_tables(MODELS)
@@ -6,7 +6,7 @@ class FarmParams(BaseModel):
     stake_token = ForeignKeyField(Token, backref="farm_params")
     farm_type = CharField(max_length=64)
     last_update_time = DateTimeField()
-    amount_staked = IntegerField()
+    amount_staked = BigIntegerField()
 
 
 class FarmRewardToken(BaseModel):
@@ -16,23 +16,80 @@ class FarmRewardToken(BaseModel):
     token = ForeignKeyField(Token, backref="farm_reward_tokens")
     idx = IntegerField()
 
+    class Meta:
+        # covers the lookup of the reward tokens of a farm
+        indexes = ((("farm_params", "idx", "token"), False),)
+
 
 class FarmEmissionRate(BaseModel):
     farm_params = ForeignKeyField(
         FarmParams, backref="farm_emission_rates", on_delete="CASCADE"
     )
-    emission_rate = IntegerField()
+    emission_rate = BigIntegerField()
     idx = IntegerField()
 
+    class Meta:
+        indexes = ((("farm_params", "idx", "emission_rate"), False),)
+
 
 class FarmCumulativeRewardPerToken(BaseModel):
     farm_params = ForeignKeyField(
         FarmParams, backref="farm_cumulative_rewards_per_token", on_delete="CASCADE"
     )
-    cumulative_reward_per_token_numerator = IntegerField()
-    cumulative_reward_per_token_denominator = IntegerField()
+    cumulative_reward_per_token_numerator = BigIntegerField()
+    cumulative_reward_per_token_denominator = BigIntegerField()
     idx = IntegerField()
 
+    class Meta:
+        indexes = (
+            (
+                (
+                    "farm_params",
+                    "idx",
+                    "cumulative_reward_per_token_numerator",
+                    "cumulative_reward_per_token_denominator",
+                ),
+                False,
+            ),
+        )
+
 
 class FarmState(OutputStateModel):
     farm_params = ForeignKeyField(FarmParams, backref="farm_states")
+
+
+class CurrentFarm(BaseModel):
+    """
+    The state of every unspent farm output, maintained by the chain querier
+    so that the API does not need to scan the history of all farm states.
+    """
+
+    transaction_output = ForeignKeyField(
+        TransactionOutput, unique=True, on_delete="CASCADE"
+    )
+    farm_state = ForeignKeyField(FarmState, on_delete="CASCADE")
+    farm_params = ForeignKeyField(FarmParams, backref="current_farms")
+    pool_id = CharField(max_length=64, index=True)
+
+    class Meta:
+        # covers listing all farms ordered by pool
+        indexes = ((("pool_id", "farm_params"), False),)
+
+
+class FarmSnapshot(OutputStateModel):
+    """
+    Append-only time series of the farm states per pool, written along with every farm state.
+    The lists are stored ';'-separated in the order of the reward tokens, fractions as numerator/denominator.
+    """
+
+    pool_id = CharField(max_length=64)
+    # last update time of the farm state, POSIX time in milliseconds
+    time = BigIntegerField()
+    amount_staked = BigIntegerField()
+    emission_rates = TextField()
+    cumulative_rewards_per_token = TextField()
+    # reward tokens per staked token and year at the emission rates of the snapshot
+    aprs = TextField()
+
+    class Meta:
+        indexes = ((("pool_id", "time"), False),)
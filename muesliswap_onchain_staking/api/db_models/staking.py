@@ -12,10 +12,42 @@ class StakingCumulativePoolRptsAtStart(BaseModel):
     staking_params = ForeignKeyField(
         StakingParams, backref="staking_cumulative_pool_rpts_at_start"
     )
-    cumulative_pool_rpts_at_start_numerator = IntegerField()
-    cumulative_pool_rpts_at_start_denominator = IntegerField()
+    cumulative_pool_rpts_at_start_numerator = BigIntegerField()
+    cumulative_pool_rpts_at_start_denominator = BigIntegerField()
     index = IntegerField()
 
+    class Meta:
+        indexes = (
+            (
+                (
+                    "staking_params",
+                    "index",
+                    "cumulative_pool_rpts_at_start_numerator",
+                    "cumulative_pool_rpts_at_start_denominator",
+                ),
+                False,
+            ),
+        )
+
 
 class StakingState(OutputStateModel):
     staking_params = ForeignKeyField(StakingParams, backref="staking_states")
+
+
+class CurrentStakingPosition(BaseModel):
+    """
+    The state of every unspent staking position output, maintained by the chain querier
+    so that the API does not need to scan the history of all staking states.
+    """
+
+    transaction_output = ForeignKeyField(
+        TransactionOutput, unique=True, on_delete="CASCADE"
+    )
+    staking_state = ForeignKeyField(StakingState, on_delete="CASCADE")
+    staking_params = ForeignKeyField(StakingParams, backref="current_positions")
+    owner = ForeignKeyField(Address, backref="current_positions")
+    pool_id = CharField(max_length=64, index=True)
+
+    class Meta:
+        # covers the lookup of the positions of a wallet
+        indexes = ((("owner", "staking_params"), False),)
@@ -2,4 +2,6 @@
 Contains queries to fetch data from the database.
 """
 from .farms import query_farms
-from .staking import query_staking_positions_per_wallet
\ No newline at end of file
+from .staking import query_staking_positions_per_wallet
+from .repository import Repository, make_repository
+from .pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidCursor, Page
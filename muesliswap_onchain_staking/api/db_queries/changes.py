@@ -0,0 +1,79 @@
+"""
+Changes made by a single block, as published on the change feed by the chain querier.
+"""
+
+from ..db_models import Block, database
+from .farms import farms_from_rows, farms_queries
+from .staking import staking_position_from_row
+
+# outputs created in the block, with the block id as parameter
+_BLOCK_OUTPUTS = """
+    SELECT o.id FROM transactionoutput o
+    JOIN "transaction" t ON o.transaction_id = t.id
+    WHERE t.block_id = {param}
+"""
+
+
+def block_farms_condition(param: str = None) -> str:
+    """
+    Condition for `farms_queries` selecting the farms updated in a block, with the block id as parameter.
+    """
+    if param is None:
+        param = database.param
+    return f"cf.transaction_output_id IN ({_BLOCK_OUTPUTS.format(param=param)})"
+
+
+def positions_changed_query(spent: bool, param: str = None) -> str:
+    """
+    Query for the staking positions created (or spent) in a block, with the block id as parameter.
+    """
+    if param is None:
+        param = database.param
+    if spent:
+        condition = f"o.spent_in_block_id = {param}"
+    else:
+        condition = f"o.id IN ({_BLOCK_OUTPUTS.format(param=param)})"
+    return f"""
+    SELECT
+    sp.pool_id,
+    sp.staked_since,
+    sp.batching_output_index,
+    a.address_raw,
+    scprs.cumulative_pool_rpts_at_start_numerator,
+    scprs.cumulative_pool_rpts_at_start_denominator,
+    o.transaction_hash,
+    o.output_index
+    FROM
+    stakingstate ss
+    JOIN transactionoutput o ON ss.transaction_output_id = o.id
+    JOIN stakingparams sp ON ss.staking_params_id = sp.id
+    JOIN address a ON sp.owner_id = a.id
+    JOIN stakingcumulativepoolrptsatstart scprs ON scprs.staking_params_id = sp.id
+    WHERE {condition}
+    ORDER BY o.transaction_hash, o.output_index, scprs."index"
+    """
+
+
+def block_changes(block: Block) -> dict:
+    """
+    The farms updated by the block, i.e. whose current state was created in it,
+    and the staking positions created and spent in it.
+    """
+    farms = farms_from_rows(
+        *(
+            database.execute_sql(sql, (block.id,)).fetchall()
+            for sql in farms_queries(where=block_farms_condition())
+        )
+    )
+    created = database.execute_sql(
+        positions_changed_query(spent=False), (block.id,)
+    ).fetchall()
+    spent = database.execute_sql(
+        positions_changed_query(spent=True), (block.id,)
+    ).fetchall()
+    return {
+        "block": {"slot": block.slot, "height": block.height, "hash": block.hash},
+        "farms": farms,
+        "positions_created": [staking_position_from_row(row) for row in created],
+        "positions_spent": [staking_position_from_row(row) for row in spent],
+    }
@@ -0,0 +1,52 @@
+from typing import List, Optional
+
+# bucket sizes for downsampling the farm history, in milliseconds
+BUCKETS = {
+    "hour": 60 * 60 * 1000,
+    "day": 24 * 60 * 60 * 1000,
+}
+
+
+def farm_history_query(params: List[str]) -> str:
+    """
+    Query with three parameters, the pool id and the start (inclusive) and end (exclusive) POSIX time in milliseconds.
+    """
+    pool_id, start, end = params
+    return f"""
+    SELECT time, amount_staked, emission_rates, cumulative_rewards_per_token, aprs
+    FROM farmsnapshot
+    WHERE pool_id = {pool_id} AND time >= {start} AND time < {end}
+    ORDER BY time ASC, id ASC
+    """
+
+
+def snapshot_from_row(row: tuple) -> dict:
+    emission_rates, cumulative, aprs = row[2], row[3], row[4]
+    return {
+        "time": row[0],
+        "amount_staked": row[1],
+        "emission_rates": [int(rate) for rate in emission_rates.split(";") if rate],
+        "cumulative_rewards_per_token": [
+            {"numerator": int(numerator), "denominator": int(denominator)}
+            for numerator, denominator in (
+                fraction.split("/") for fraction in cumulative.split(";") if fraction
+            )
+        ],
+        "aprs": [float(apr) if apr else None for apr in aprs.split(";")]
+        if emission_rates
+        else [],
+    }
+
+
+def downsample(snapshots: List[dict], bucket: Optional[str]) -> List[dict]:
+    """
+    Keep the last snapshot of every bucket, tagged with the start of the bucket.
+    """
+    if bucket is None:
+        return snapshots
+    size = BUCKETS[bucket]
+    buckets = {}
+    for snapshot in snapshots:
+        start = snapshot["time"] - snapshot["time"] % size
+        buckets[start] = {"bucket_start": start, **snapshot}
+    return list(buckets.values())
@@ -1,81 +1,176 @@
-from ..db_models import sqlite_db
+from collections import defaultdict
+from typing import List, Optional, Tuple
 
-def query_farms():
-    cursor = sqlite_db.execute_sql(
-        """
-        SELECT
-        fp.pool_id,
-        tk2.policy_id as stake_token_policy_id,
-        tk2.asset_name as stake_token_asset_name,
-        fp.farm_type,
-        fp.last_update_time,
-        fp.amount_staked,
-        group_concat(tk.policy_id, ';') as reward_token_policy_id,
-        group_concat(tk.asset_name, ';') as reward_token_asset_name,
-        group_concat(frt.idx, ';') as reward_token_index,
-        group_concat(fer.emission_rate, ';'),
-        group_concat(fer.idx, ';'),
-        group_concat(fcrpt.cumulative_reward_per_token_numerator, ';'),
-        group_concat(fcrpt.cumulative_reward_per_token_denominator, ';'),
-        group_concat(fcrpt.idx, ';')
+from ..db_models import database
+from .util import to_str
+
+
+def farms_queries(
+    where: str = "", order_by: str = "cf.pool_id ASC"
+) -> Tuple[str, str, str, str]:
+    """
+    Queries for the current farms and, separately, for their reward tokens, emission rates and
+    cumulative rewards per token, optionally restricted by a condition on the current farm `cf`.
+    The child tables are not joined into the farms query, as every combination of their rows
+    would be returned for each farm.
+    """
+    where = f"WHERE {where}" if where else ""
+    return (
+        f"""
+    SELECT
+    fp.id,
+    cf.pool_id,
+    tk2.policy_id as stake_token_policy_id,
+    tk2.asset_name as stake_token_asset_name,
+    fp.farm_type,
+    fp.last_update_time,
+    fp.amount_staked,
+    cf.id
+    FROM
+    currentfarm cf
+    JOIN farmparams fp ON cf.farm_params_id = fp.id
+    JOIN token tk2 on fp.stake_token_id = tk2.id
+    {where}
+    ORDER BY {order_by}
+    """,
+        f"""
+    SELECT frt.farm_params_id, frt.idx, tk.policy_id, tk.asset_name
+    FROM
+    currentfarm cf
+    JOIN farmrewardtoken frt ON frt.farm_params_id = cf.farm_params_id
+    JOIN token tk on frt.token_id = tk.id
+    {where}
+    ORDER BY frt.farm_params_id, frt.idx
+    """,
+        f"""
+    SELECT fer.farm_params_id, fer.idx, fer.emission_rate
+    FROM
+    currentfarm cf
+    JOIN farmemissionrate fer ON fer.farm_params_id = cf.farm_params_id
+    {where}
+    ORDER BY fer.farm_params_id, fer.idx
+    """,
+        f"""
+    SELECT
+    fcrpt.farm_params_id,
+    fcrpt.idx,
+    fcrpt.cumulative_reward_per_token_numerator,
+    fcrpt.cumulative_reward_per_token_denominator
+    FROM
+    currentfarm cf
+    JOIN farmcumulativerewardpertoken fcrpt ON fcrpt.farm_params_id = cf.farm_params_id
+    {where}
+    ORDER BY fcrpt.farm_params_id, fcrpt.idx
+    """,
+    )
+
+
+# filters of the farms, by the condition on the current farm `cf`, its params `fp` and stake token `tk2`
+FARM_FILTERS = {
+    "pool_id": "cf.pool_id = {}",
+    "farm_type": "fp.farm_type = {}",
+    "stake_token": "tk2.policy_id = {} AND tk2.asset_name = {}",
+    "reward_token": """EXISTS (
+        SELECT 1 FROM farmrewardtoken frt JOIN token tk ON frt.token_id = tk.id
+        WHERE frt.farm_params_id = cf.farm_params_id AND tk.policy_id = {} AND tk.asset_name = {}
+    )""",
+}
+# sort keys of the farms and their column in the rows of the farms query
+FARM_SORT_KEYS = {
+    "pool_id": ("cf.pool_id", 1),
+    "amount_staked": ("fp.amount_staked", 6),
+}
+# column of the id of the current farm, which breaks ties of the sort keys
+FARM_ID_COLUMN = 7
+
+
+def farms_page_queries(
+    where: str, order_by: str, limit_param: Optional[str] = None
+) -> Tuple[str, str, str, str]:
+    """
+    The `farms_queries` for the farms matching a condition as in `FARM_FILTERS`, in the given order
+    and limited to the number of farms in the limit parameter, if any.
+    """
+    limit = f"ORDER BY {order_by} LIMIT {limit_param}" if limit_param else ""
+    # the cross join makes SQLite loop over the current farms rather than the params of all farm states
+    return farms_queries(
+        where=f"""cf.id IN (
+        SELECT cf.id
         FROM
-        farmstate fs
-        JOIN farmparams fp ON fs.farm_params_id = fp.id
-        JOIN farmrewardtoken frt ON frt.farm_params_id = fp.id
-        JOIN token tk on frt.token_id = tk.id
-        JOIN farmemissionrate fer ON fer.farm_params_id = fp.id
-        JOIN farmcumulativerewardpertoken fcrpt ON fcrpt.farm_params_id = fp.id
+        currentfarm cf
+        CROSS JOIN farmparams fp
         JOIN token tk2 on fp.stake_token_id = tk2.id
-        GROUP BY fs.farm_params_id
-        ORDER BY fp.pool_id ASC
-        """
+        WHERE cf.farm_params_id = fp.id AND {where}
+        {limit}
+    )""",
+        order_by=order_by,
     )
-    results = []
-    for row in cursor.fetchall():
-        results.append(
-            {
-                "pool_id": row[0],
-                "stake_token": {
-                    "policy_id": row[1],
-                    "asset_name": row[2],
-                },
-                "farm_type": row[3],
-                "last_update_time": row[4],
-                "amount_staked": row[5],
-                "reward_tokens": [
-                    {
-                        "policy_id": policy_id,
-                        "asset_name": asset_name,
-                        "idx": idx,
-                    }
-                    for policy_id, asset_name, idx in zip(
-                        row[6].split(";"),
-                        row[7].split(";"),
-                        row[8].split(";"),
-                    )
-                ],
-                "emission_rates": [
-                    {
-                        "emission_rate": emission_rate,
-                        "idx": idx,
-                    }
-                    for emission_rate, idx in zip(
-                        row[9].split(";"),
-                        row[10].split(";"),
-                    )
-                ],
-                "cumulative_rewards_per_token": [
-                    {
-                        "numerator": numerator,
-                        "denominator": denominator,
-                        "idx": idx,
-                    }
-                    for numerator, denominator, idx in zip(
-                        row[11].split(";"),
-                        row[12].split(";"),
-                        row[13].split(";"),
-                    )
-                ],
-            }
+
+
+def _per_farm(rows: List[tuple]) -> dict:
+    # child rows by farm params id and index, repeated rows of farms sharing params collapse
+    per_farm = defaultdict(dict)
+    for farm_params_id, idx, *values in rows:
+        per_farm[farm_params_id][idx] = (idx, *values)
+    return {
+        farm_params_id: [entries[idx] for idx in sorted(entries)]
+        for farm_params_id, entries in per_farm.items()
+    }
+
+
+def farms_from_rows(
+    farm_rows: List[tuple],
+    reward_token_rows: List[tuple],
+    emission_rate_rows: List[tuple],
+    cumulative_rows: List[tuple],
+) -> List[dict]:
+    """
+    Assemble the farms from the rows of the `farms_queries`.
+    Values of the child tables are rendered as strings, as they always were in the API.
+    """
+    reward_tokens = _per_farm(reward_token_rows)
+    emission_rates = _per_farm(emission_rate_rows)
+    cumulative = _per_farm(cumulative_rows)
+    return [
+        {
+            "pool_id": row[1],
+            "stake_token": {
+                "policy_id": row[2],
+                "asset_name": row[3],
+            },
+            "farm_type": row[4],
+            "last_update_time": to_str(row[5]),
+            "amount_staked": row[6],
+            "reward_tokens": [
+                {
+                    "policy_id": policy_id,
+                    "asset_name": asset_name,
+                    "idx": str(idx),
+                }
+                for idx, policy_id, asset_name in reward_tokens.get(row[0], [])
+            ],
+            "emission_rates": [
+                {
+                    "emission_rate": str(emission_rate),
+                    "idx": str(idx),
+                }
+                for idx, emission_rate in emission_rates.get(row[0], [])
+            ],
+            "cumulative_rewards_per_token": [
+                {
+                    "numerator": str(numerator),
+                    "denominator": str(denominator),
+                    "idx": str(idx),
+                }
+                for idx, numerator, denominator in cumulative.get(row[0], [])
+            ],
+        }
+        for row in farm_rows
+    ]
+
+
+def query_farms():
+    with database.atomic():
+        return farms_from_rows(
+            *(database.execute_sql(sql).fetchall() for sql in farms_queries())
         )
-    return results
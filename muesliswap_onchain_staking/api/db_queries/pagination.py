@@ -0,0 +1,120 @@
+"""
+Keyset pagination and filtering of the farms and staking positions queries.
+
+A page continues after the sort key and id of the last row of the previous page, which clients pass
+back as an opaque cursor. Unlike an offset, every page costs the same as the first one, and no rows
+are skipped or repeated when rows before the cursor are added or removed between requests.
+"""
+
+import base64
+import datetime
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+import orjson
+
+MAX_PAGE_SIZE = 500
+DEFAULT_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _valid_key(sort: str, key: Any) -> bool:
+    if sort == "amount_staked":
+        return isinstance(key, int)
+    if sort == "staked_since":
+        try:
+            datetime.datetime.fromisoformat(key)
+            return True
+        except (TypeError, ValueError):
+            return False
+    return isinstance(key, str)
+
+
+@dataclass
+class Page:
+    """
+    At most `limit` rows, ordered by the sort key and then by id.
+    """
+
+    limit: int
+    sort: str
+    descending: bool = False
+    # sort key and id of the last row of the previous page
+    after: Optional[tuple[Any, int]] = None
+
+    @classmethod
+    def from_cursor(
+        cls, limit: int, sort: str, descending: bool, cursor: Optional[str]
+    ) -> "Page":
+        """
+        The page following the cursor, which must have been returned for the same sort order.
+        """
+        if cursor is None:
+            return cls(limit, sort, descending)
+        try:
+            data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            cursor_sort, cursor_descending, key, row_id = orjson.loads(data)
+        except (TypeError, ValueError) as e:
+            raise InvalidCursor(f"Malformed cursor: {e}")
+        if (cursor_sort, cursor_descending) != (sort, descending):
+            raise InvalidCursor("The cursor belongs to another sort order")
+        if not _valid_key(sort, key) or not isinstance(row_id, int):
+            raise InvalidCursor("Malformed cursor")
+        return cls(limit, sort, descending, (key, row_id))
+
+    def cursor(self, key: Any, row_id: int) -> str:
+        """
+        The cursor of the page following the row with the given sort key and id.
+        """
+        data = orjson.dumps([self.sort, self.descending, key, row_id])
+        return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+    def order_by(self, key: str, id_column: str) -> str:
+        direction = "DESC" if self.descending else "ASC"
+        return f"{key} {direction}, {id_column} {direction}"
+
+
+def _sqlite_params(count: int) -> list[str]:
+    return ["?"] * count
+
+
+class Conditions:
+    """
+    The conditions of a WHERE clause and the values of their parameters, with the placeholders
+    given by `params` for a number of parameters (see `Repository.params`).
+    """
+
+    def __init__(self, params: Callable[[int], list[str]] = _sqlite_params):
+        self.params = params
+        self.conditions: list[str] = []
+        self.values: list = []
+
+    def param(self, value) -> str:
+        self.values.append(value)
+        return self.params(len(self.values))[-1]
+
+    def add(self, condition: str, *values):
+        """
+        Add a condition with a `{}` placeholder for each value.
+        """
+        self.conditions.append(
+            condition.format(*(self.param(value) for value in values))
+        )
+
+    def add_after(self, page: Page, key: str, id_column: str, key_value: Any):
+        """
+        Restrict to the rows following the previous page, if any.
+        """
+        if page.after is None:
+            return
+        operator = "<" if page.descending else ">"
+        self.add(
+            f"({key}, {id_column}) {operator} ({{}}, {{}})", key_value, page.after[1]
+        )
+
+    @property
+    def where(self) -> str:
+        return " AND ".join(self.conditions) if self.conditions else "TRUE"
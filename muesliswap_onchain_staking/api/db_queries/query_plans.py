@@ -0,0 +1,146 @@
+"""
+Checks that the queries of the API and the chain querier are served by indexes.
+Every query is run through SQLite's EXPLAIN QUERY PLAN and any full table scan is reported.
+The indexes are created together with the tables, also for existing databases.
+
+    python -m muesliswap_onchain_staking.api.db_queries.query_plans
+"""
+
+import sys
+from typing import Dict, List, Tuple
+
+from ..db_models import database, is_postgres
+from ..tx_processor import to_db
+from .changes import block_farms_condition, positions_changed_query
+from .farm_history import farm_history_query
+from .farms import FARM_FILTERS, FARM_SORT_KEYS, farms_page_queries, farms_queries
+from .pagination import Conditions, Page
+from .rewards import position_stakes_per_farm_query, position_stakes_per_wallet_query
+from .staking import (
+    POSITION_SORT_KEYS,
+    staking_positions_page_query,
+    staking_positions_per_credentials_query,
+    staking_positions_per_wallet_query,
+    staking_positions_per_wallets_query,
+    wallets_changed_since_queries,
+)
+
+
+def _farms_page_queries() -> Tuple[Tuple[str, str, str, str], tuple]:
+    page = Page(10, "amount_staked", descending=True, after=(0, 0))
+    conditions = Conditions()
+    conditions.add(FARM_FILTERS["farm_type"], "")
+    conditions.add(FARM_FILTERS["reward_token"], "", "")
+    key, _ = FARM_SORT_KEYS[page.sort]
+    conditions.add_after(page, key, "cf.id", 0)
+    order_by = page.order_by(key, "cf.id")
+    limit_param = conditions.param(page.limit)
+    return (
+        farms_page_queries(conditions.where, order_by, limit_param),
+        tuple(conditions.values),
+    )
+
+
+def _staking_positions_page_query(column: str) -> Tuple[str, tuple]:
+    page = Page(10, "amount_staked", after=(0, 0))
+    conditions = Conditions()
+    conditions.add(f"a.{column} IN ({{}})", "")
+    conditions.add("csp.pool_id = {}", "")
+    key, _ = POSITION_SORT_KEYS[page.sort]
+    conditions.add_after(page, key, "csp.id", 0)
+    order_by = page.order_by(key, "csp.id")
+    limit_param = conditions.param(page.limit)
+    return (
+        staking_positions_page_query(conditions.where, order_by, limit_param),
+        tuple(conditions.values),
+    )
+
+
+def checked_queries() -> Dict[str, Tuple[str, tuple]]:
+    """
+    The checked queries with placeholder parameters.
+    """
+    mark_spent_sql, mark_spent_params = to_db.mark_spent_query(
+        [("00" * 32, 0), ("11" * 32, 1)], 0
+    ).sql()
+    farms_page_sqls, farms_page_params = _farms_page_queries()
+    return {
+        **{f"query_farms_{i}": (sql, ()) for i, sql in enumerate(farms_queries())},
+        **{
+            f"farms_page_{i}": (sql, farms_page_params)
+            for i, sql in enumerate(farms_page_sqls)
+        },
+        "staking_positions_page_per_wallet": _staking_positions_page_query(
+            "address_raw"
+        ),
+        "staking_positions_page_per_stake_credential": _staking_positions_page_query(
+            "stake_credential"
+        ),
+        "query_staking_positions_per_wallet": (
+            staking_positions_per_wallet_query(),
+            ("",),
+        ),
+        "query_staking_positions_per_wallets": (
+            staking_positions_per_wallets_query(["?", "?"]),
+            ("", ""),
+        ),
+        "query_staking_positions_per_payment_credentials": (
+            staking_positions_per_credentials_query("payment_credential", ["?"]),
+            ("",),
+        ),
+        "query_staking_positions_per_stake_credentials": (
+            staking_positions_per_credentials_query("stake_credential", ["?"]),
+            ("",),
+        ),
+        "farm_history": (farm_history_query(["?", "?", "?"]), ("", 0, 0)),
+        "position_stakes_per_farm": (position_stakes_per_farm_query(), ("",)),
+        "position_stakes_per_wallet": (position_stakes_per_wallet_query(), ("",)),
+        "wallets_created_since": (wallets_changed_since_queries()[0], (0,)),
+        "wallets_spent_since": (wallets_changed_since_queries()[1], (0,)),
+        **{
+            f"block_farms_{i}": (sql, (0,))
+            for i, sql in enumerate(farms_queries(where=block_farms_condition()))
+        },
+        "block_positions_created": (positions_changed_query(spent=False), (0,)),
+        "block_positions_spent": (positions_changed_query(spent=True), (0,)),
+        "mark_spent": (mark_spent_sql, tuple(mark_spent_params)),
+    }
+
+
+def full_scans(sql: str, params: tuple = ()) -> List[str]:
+    """
+    The steps of the query plan that scan a whole table without using an index.
+    """
+    return [
+        detail
+        for _, _, _, detail in database.execute_sql(
+            f"EXPLAIN QUERY PLAN {sql}", params
+        ).fetchall()
+        if detail.startswith("SCAN ") and " USING " not in detail
+        # row values passed as parameters
+        and "CONSTANT ROW" not in detail
+    ]
+
+
+def check_query_plans() -> Dict[str, List[str]]:
+    """
+    Full scans per checked query, empty if every query is served by indexes.
+    """
+    return {
+        name: full_scans(sql, params)
+        for name, (sql, params) in checked_queries().items()
+    }
+
+
+def main():
+    if is_postgres():
+        sys.exit("Query plans can only be checked on SQLite")
+    failed = False
+    for name, scans in check_query_plans().items():
+        print(f"{name}: {', '.join(scans) if scans else 'ok'}")
+        failed |= bool(scans)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
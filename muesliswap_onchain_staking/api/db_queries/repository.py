@@ -0,0 +1,377 @@
+"""
+Non-blocking access to the queries for the API server.
+Every query runs on a read-only connection taken from a pool, so that requests neither wait
+for a thread of the server nor for the write lock held by the chain querier.
+
+The async drivers (aiosqlite for SQLite, asyncpg for PostgreSQL) are optional.
+Without them, the queries run on a worker thread through the peewee database.
+"""
+
+import asyncio
+import datetime
+import logging
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from ..db_models import database, is_postgres
+from .farm_history import farm_history_query, snapshot_from_row
+from .farms import (
+    FARM_FILTERS,
+    FARM_ID_COLUMN,
+    FARM_SORT_KEYS,
+    farms_from_rows,
+    farms_page_queries,
+    farms_queries,
+)
+from .pagination import Conditions, Page
+from .rewards import (
+    position_stakes_from_rows,
+    position_stakes_per_farm_query,
+    position_stakes_per_wallet_query,
+)
+from .staking import (
+    POSITION_ID_COLUMN,
+    POSITION_OWNER_COLUMNS,
+    POSITION_SORT_KEYS,
+    staking_position_from_row,
+    staking_positions_page_query,
+    staking_positions_per_credentials_query,
+    staking_positions_per_wallet_query,
+    staking_positions_per_wallets_query,
+    wallets_changed_since_queries,
+)
+from .util import to_str
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+_LOGGER = logging.getLogger(__name__)
+
+LATEST_BLOCK_QUERY = "SELECT slot, height, hash FROM block ORDER BY slot DESC LIMIT 1"
+BLOCK_EXISTS_QUERY = "SELECT 1 FROM block WHERE hash = {param}"
+
+# query parameters of peewee's pooled database, not understood by the async drivers
+_POOL_PARAMS = ("max_connections", "stale_timeout", "timeout")
+
+
+class Repository(ABC):
+    """
+    Read access to the API data, independent of the database driver.
+    """
+
+    # placeholder for query parameters
+    param = "?"
+    postgres = False
+
+    def params(self, count: int) -> list[str]:
+        """
+        Placeholders for the given number of query parameters.
+        """
+        return [self.param] * count
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def fetch(self, sql: str, params: tuple = ()) -> list[tuple]:
+        """
+        Run the query and return all rows.
+        """
+
+    async def latest_block(self) -> Optional[dict]:
+        rows = await self.fetch(LATEST_BLOCK_QUERY)
+        if not rows:
+            return None
+        slot, height, block_hash = rows[0]
+        return {"slot": slot, "height": height, "hash": block_hash}
+
+    async def fetch_all(self, queries: list[tuple[str, tuple]]) -> list[list[tuple]]:
+        """
+        Run the queries on a consistent snapshot of the database and return the rows of each.
+        """
+        return [await self.fetch(sql, params) for sql, params in queries]
+
+    async def farms(self) -> list[dict]:
+        return farms_from_rows(
+            *await self.fetch_all([(sql, ()) for sql in farms_queries()])
+        )
+
+    def _sort_key_value(self, page: Page):
+        # datetimes are compared as stored, which asyncpg only accepts as datetime objects
+        key = page.after[0] if page.after is not None else None
+        if page.sort == "staked_since" and key is not None and self.postgres:
+            return datetime.datetime.fromisoformat(key)
+        return key
+
+    def _next_cursor(
+        self, page: Optional[Page], rows: list[tuple], key_column: int, id_column: int
+    ) -> Optional[str]:
+        if page is None or len({row[id_column] for row in rows}) < page.limit:
+            return None
+        last = rows[-1]
+        key = last[key_column]
+        if page.sort == "staked_since":
+            key = to_str(key)
+        return page.cursor(key, last[id_column])
+
+    async def farms_page(
+        self, filters: dict[str, tuple], page: Optional[Page] = None
+    ) -> tuple[list[dict], Optional[str]]:
+        """
+        The farms matching the filters (see `FARM_FILTERS`, with the values of their parameters),
+        and the cursor of the next page if there may be one. Without a page, all matching farms
+        are returned ordered by pool.
+        """
+        conditions = Conditions(self.params)
+        for name, values in filters.items():
+            conditions.add(FARM_FILTERS[name], *values)
+        order_by = "cf.pool_id ASC"
+        limit_param = None
+        key_column = 1
+        if page is not None:
+            key, key_column = FARM_SORT_KEYS[page.sort]
+            conditions.add_after(page, key, "cf.id", self._sort_key_value(page))
+            order_by = page.order_by(key, "cf.id")
+            limit_param = conditions.param(page.limit)
+        values = tuple(conditions.values)
+        rows = await self.fetch_all(
+            [
+                (sql, values)
+                for sql in farms_page_queries(conditions.where, order_by, limit_param)
+            ]
+        )
+        return farms_from_rows(*rows), self._next_cursor(
+            page, rows[0], key_column, FARM_ID_COLUMN
+        )
+
+    async def staking_positions_page(
+        self,
+        column: str,
+        owners: list[str],
+        pool_id: Optional[str] = None,
+        page: Optional[Page] = None,
+    ) -> tuple[list[dict], Optional[str]]:
+        """
+        The positions of the given wallets or credential hashes in the address column
+        (see `POSITION_OWNER_COLUMNS`), optionally of a single farm, and the cursor of the next page
+        if there may be one. Without a page, all matching positions are returned ordered by time of staking.
+        """
+        assert column in POSITION_OWNER_COLUMNS, f"Unknown owner column {column}"
+        if not owners:
+            return [], None
+        conditions = Conditions(self.params)
+        conditions.add(f"a.{column} IN ({', '.join(['{}'] * len(owners))})", *owners)
+        if pool_id is not None:
+            conditions.add("csp.pool_id = {}", pool_id)
+        order_by = "sp.staked_since ASC, csp.id ASC"
+        limit_param = None
+        key_column = 1
+        if page is not None:
+            key, key_column = POSITION_SORT_KEYS[page.sort]
+            conditions.add_after(page, key, "csp.id", self._sort_key_value(page))
+            order_by = page.order_by(key, "csp.id")
+            limit_param = conditions.param(page.limit)
+        rows = await self.fetch(
+            staking_positions_page_query(conditions.where, order_by, limit_param),
+            tuple(conditions.values),
+        )
+        return [staking_position_from_row(row) for row in rows], self._next_cursor(
+            page, rows, key_column, POSITION_ID_COLUMN
+        )
+
+    async def staking_positions_per_wallet(self, wallet: str) -> list[dict]:
+        rows = await self.fetch(
+            staking_positions_per_wallet_query(self.param), (wallet,)
+        )
+        return [staking_position_from_row(row) for row in rows]
+
+    async def staking_positions_per_wallets(self, wallets: list[str]) -> list[dict]:
+        """
+        The positions of all given wallets in a single query, ordered by wallet.
+        """
+        if not wallets:
+            return []
+        rows = await self.fetch(
+            staking_positions_per_wallets_query(self.params(len(wallets))),
+            tuple(wallets),
+        )
+        return [staking_position_from_row(row) for row in rows]
+
+    async def staking_positions_per_credentials(
+        self, column: str, credentials: list[str]
+    ) -> list[dict]:
+        """
+        The positions of all addresses with the given payment or stake credential hashes
+        (column "payment_credential" or "stake_credential"), ordered by wallet.
+        """
+        if not credentials:
+            return []
+        rows = await self.fetch(
+            staking_positions_per_credentials_query(
+                column, self.params(len(credentials))
+            ),
+            tuple(credentials),
+        )
+        return [staking_position_from_row(row) for row in rows]
+
+    async def farm_history(self, pool_id: str, start: int, end: int) -> list[dict]:
+        rows = await self.fetch(
+            farm_history_query(self.params(3)), (pool_id, start, end)
+        )
+        return [snapshot_from_row(row) for row in rows]
+
+    async def position_stakes_per_farm(self, pool_id: str) -> list[dict]:
+        rows = await self.fetch(position_stakes_per_farm_query(self.param), (pool_id,))
+        return position_stakes_from_rows(rows)
+
+    async def position_stakes_per_wallet(self, wallet: str) -> list[dict]:
+        rows = await self.fetch(position_stakes_per_wallet_query(self.param), (wallet,))
+        return position_stakes_from_rows(rows)
+
+    async def block_exists(self, block_hash: str) -> bool:
+        rows = await self.fetch(
+            BLOCK_EXISTS_QUERY.format(param=self.param), (block_hash,)
+        )
+        return bool(rows)
+
+    async def wallets_changed_since(self, slot: int) -> set[str]:
+        """
+        The wallets whose staking positions changed in a block after the given slot.
+        """
+        wallets = set()
+        for sql in wallets_changed_since_queries(self.param):
+            wallets.update(wallet for (wallet,) in await self.fetch(sql, (slot,)))
+        return wallets
+
+
+class SqliteRepository(Repository):
+    def __init__(self, path: str, pool_size: int = 8):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool: asyncio.Queue = asyncio.Queue()
+
+    async def open(self):
+        for _ in range(self.pool_size):
+            self._pool.put_nowait(
+                await aiosqlite.connect(f"file:{self.path}?mode=ro", uri=True)
+            )
+
+    async def close(self):
+        while not self._pool.empty():
+            await self._pool.get_nowait().close()
+
+    @asynccontextmanager
+    async def _connection(self):
+        connection = await self._pool.get()
+        try:
+            yield connection
+        finally:
+            self._pool.put_nowait(connection)
+
+    async def fetch(self, sql: str, params: tuple = ()) -> list[tuple]:
+        async with self._connection() as connection:
+            async with connection.execute(sql, params) as cursor:
+                return list(await cursor.fetchall())
+
+    async def fetch_all(self, queries: list[tuple[str, tuple]]) -> list[list[tuple]]:
+        async with self._connection() as connection:
+            # a read transaction sees a single snapshot of the WAL
+            await connection.execute("BEGIN")
+            try:
+                results = []
+                for sql, params in queries:
+                    async with connection.execute(sql, params) as cursor:
+                        results.append(list(await cursor.fetchall()))
+                return results
+            finally:
+                await connection.rollback()
+
+
+class PostgresRepository(Repository):
+    param = "$1"
+    postgres = True
+
+    def params(self, count: int) -> list[str]:
+        return [f"${i}" for i in range(1, count + 1)]
+
+    def __init__(self, dsn: str, pool_size: int = 8):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self._pool = None
+
+    async def open(self):
+        self._pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=1,
+            max_size=self.pool_size,
+            server_settings={"default_transaction_read_only": "on"},
+        )
+
+    async def close(self):
+        await self._pool.close()
+
+    async def fetch(self, sql: str, params: tuple = ()) -> list[tuple]:
+        async with self._pool.acquire() as connection:
+            return [tuple(row) for row in await connection.fetch(sql, *params)]
+
+    async def fetch_all(self, queries: list[tuple[str, tuple]]) -> list[list[tuple]]:
+        async with self._pool.acquire() as connection:
+            async with connection.transaction(
+                isolation="repeatable_read", readonly=True
+            ):
+                return [
+                    [tuple(row) for row in await connection.fetch(sql, *params)]
+                    for sql, params in queries
+                ]
+
+
+class ThreadedRepository(Repository):
+    """
+    Fallback that runs the queries through the peewee database on a worker thread.
+    """
+
+    def __init__(self):
+        self.param = database.param
+        self.postgres = is_postgres()
+
+    def _fetch_all(self, queries: list[tuple[str, tuple]]) -> list[list[tuple]]:
+        with database.connection_context(), database.atomic():
+            return [
+                database.execute_sql(sql, params).fetchall() for sql, params in queries
+            ]
+
+    async def fetch(self, sql: str, params: tuple = ()) -> list[tuple]:
+        return (await self.fetch_all([(sql, params)]))[0]
+
+    async def fetch_all(self, queries: list[tuple[str, tuple]]) -> list[list[tuple]]:
+        return await asyncio.to_thread(self._fetch_all, queries)
+
+
+def make_repository(url: str) -> Repository:
+    """
+    Create the repository for a database URL as accepted by `make_database`.
+    """
+    parts = urlsplit(url)
+    if parts.scheme == "sqlite" and aiosqlite is not None:
+        return SqliteRepository(url[len("sqlite:///") :])
+    if parts.scheme.startswith("postgres") and asyncpg is not None:
+        query = dict(parse_qsl(parts.query))
+        pool_size = int(query.get("max_connections", 8))
+        query = {k: v for k, v in query.items() if k not in _POOL_PARAMS}
+        dsn = urlunsplit(("postgresql", parts.netloc, parts.path, urlencode(query), ""))
+        return PostgresRepository(dsn, pool_size=pool_size)
+    _LOGGER.warning(
+        f"No async driver installed for {parts.scheme}, querying on worker threads"
+    )
+    return ThreadedRepository()
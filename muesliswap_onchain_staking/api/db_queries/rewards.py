@@ -0,0 +1,78 @@
+from ..db_models import database
+
+
+def position_stakes_query(where: str) -> str:
+    """
+    Query for the staked amount and the cumulative rewards per token at start of the current staking positions
+    matching the condition on the position `csp` or its owner `a`, one row per reward token.
+    """
+    return f"""
+    SELECT
+    o.transaction_hash,
+    o.output_index,
+    csp.pool_id,
+    a.address_raw,
+    COALESCE(tov.amount, 0),
+    scprs.cumulative_pool_rpts_at_start_numerator,
+    scprs.cumulative_pool_rpts_at_start_denominator
+    FROM
+    currentstakingposition csp
+    JOIN transactionoutput o ON csp.transaction_output_id = o.id
+    JOIN address a ON csp.owner_id = a.id
+    JOIN currentfarm cf ON cf.pool_id = csp.pool_id
+    JOIN farmparams fp ON cf.farm_params_id = fp.id
+    LEFT JOIN transactionoutputvalue tov
+        ON tov.transaction_output_id = o.id AND tov.token_id = fp.stake_token_id
+    JOIN stakingcumulativepoolrptsatstart scprs ON scprs.staking_params_id = csp.staking_params_id
+    WHERE {where}
+    ORDER BY o.transaction_hash, o.output_index, scprs."index"
+    """
+
+
+def position_stakes_per_farm_query(param: str = None) -> str:
+    if param is None:
+        param = database.param
+    return position_stakes_query(f"csp.pool_id = {param}")
+
+
+def position_stakes_per_wallet_query(param: str = None) -> str:
+    if param is None:
+        param = database.param
+    return position_stakes_query(f"a.address_raw = {param}")
+
+
+def position_stakes_from_rows(rows: list[tuple]) -> list[dict]:
+    """
+    Group the rows per position, keeping their order.
+    """
+    positions = []
+    for (
+        transaction_hash,
+        output_index,
+        pool_id,
+        address,
+        amount,
+        numerator,
+        denominator,
+    ) in rows:
+        if (
+            not positions
+            or positions[-1]["output_ref"]["transaction_hash"] != transaction_hash
+            or positions[-1]["output_ref"]["output_index"] != output_index
+        ):
+            positions.append(
+                {
+                    "output_ref": {
+                        "transaction_hash": transaction_hash,
+                        "output_index": output_index,
+                    },
+                    "pool_id": pool_id,
+                    "address": address,
+                    "staked_amount": int(amount),
+                    "cumulative_pool_rpts_at_start": [],
+                }
+            )
+        positions[-1]["cumulative_pool_rpts_at_start"].append(
+            (int(numerator), int(denominator))
+        )
+    return positions
@@ -1,40 +1,168 @@
-from ..db_models import sqlite_db
+from typing import Optional
+
+from ..db_models import database
+from .util import to_str
+
+
+def staking_positions_query(where: str, order_by: str = "") -> str:
+    """
+    Query for the current staking positions of the wallets matching the condition on the address `a`.
+    """
+    return f"""
+    SELECT
+    sp.pool_id,
+    sp.staked_since,
+    sp.batching_output_index,
+    a.address_raw,
+    scprs.cumulative_pool_rpts_at_start_numerator,
+    scprs.cumulative_pool_rpts_at_start_denominator,
+    o.transaction_hash,
+    o.output_index
+    FROM
+    currentstakingposition csp
+    JOIN transactionoutput o ON csp.transaction_output_id = o.id
+    JOIN stakingparams sp ON csp.staking_params_id = sp.id
+    JOIN address a ON csp.owner_id = a.id
+    JOIN stakingcumulativepoolrptsatstart scprs ON scprs.staking_params_id = sp.id
+    WHERE {where}
+    ORDER BY {order_by}sp.staked_since ASC, sp.batching_output_index ASC, scprs."index" ASC
+    """
+
+
+def staking_positions_per_wallet_query(param: str = None) -> str:
+    """
+    Query with a single parameter, the wallet, using the given placeholder (defaults to the one of the database).
+    """
+    if param is None:
+        param = database.param
+    return staking_positions_query(f"a.address_raw = {param}")
+
+
+def staking_positions_per_wallets_query(params: list[str]) -> str:
+    """
+    Query with one parameter per wallet, ordered by wallet.
+    """
+    return staking_positions_query(
+        f"a.address_raw IN ({', '.join(params)})", order_by="a.address_raw, "
+    )
+
+
+# columns of the address holding its credentials, see `Address`
+CREDENTIAL_COLUMNS = ("payment_credential", "stake_credential")
+
+
+def staking_positions_per_credentials_query(column: str, params: list[str]) -> str:
+    """
+    Query with one parameter per credential hash in the given address column, ordered by wallet.
+    """
+    assert column in CREDENTIAL_COLUMNS, f"Unknown credential column {column}"
+    return staking_positions_query(
+        f"a.{column} IN ({', '.join(params)})", order_by="a.address_raw, "
+    )
+
+
+# sort keys of the staking positions and their column in the rows of the page query,
+# the staked amount is that of the stake token of the farm
+POSITION_SORT_KEYS = {
+    "staked_since": ("sp.staked_since", 1),
+    "amount_staked": ("COALESCE(tov.amount, 0)", 9),
+}
+# column of the id of the current staking position, which breaks ties of the sort keys
+POSITION_ID_COLUMN = 8
+# columns of the address by which positions are selected
+POSITION_OWNER_COLUMNS = ("address_raw",) + CREDENTIAL_COLUMNS
+
+
+def staking_positions_page_query(
+    where: str, order_by: str, limit_param: Optional[str] = None
+) -> str:
+    """
+    Query for the current staking positions matching the condition on the position `csp`,
+    its params `sp` or owner `a`, in the given order and limited to the number of positions
+    in the limit parameter, if any. The rows are those of `staking_positions_query`
+    followed by the id of the position and its staked amount.
+    """
+    positions = """
+    FROM
+    currentstakingposition csp
+    JOIN transactionoutput o ON csp.transaction_output_id = o.id
+    JOIN stakingparams sp ON csp.staking_params_id = sp.id
+    JOIN address a ON csp.owner_id = a.id
+    LEFT JOIN currentfarm cf ON cf.pool_id = csp.pool_id
+    LEFT JOIN farmparams fp ON cf.farm_params_id = fp.id
+    LEFT JOIN transactionoutputvalue tov
+        ON tov.transaction_output_id = o.id AND tov.token_id = fp.stake_token_id
+    """
+    limit = f"ORDER BY {order_by} LIMIT {limit_param}" if limit_param else ""
+    return f"""
+    SELECT
+    sp.pool_id,
+    sp.staked_since,
+    sp.batching_output_index,
+    a.address_raw,
+    scprs.cumulative_pool_rpts_at_start_numerator,
+    scprs.cumulative_pool_rpts_at_start_denominator,
+    o.transaction_hash,
+    o.output_index,
+    csp.id,
+    COALESCE(tov.amount, 0)
+    {positions}
+    JOIN stakingcumulativepoolrptsatstart scprs ON scprs.staking_params_id = sp.id
+    WHERE csp.id IN (
+        SELECT csp.id
+        {positions}
+        WHERE {where}
+        {limit}
+    )
+    ORDER BY {order_by}, scprs."index" ASC
+    """
+
+
+def staking_position_from_row(row: tuple) -> dict:
+    return {
+        "pool_id": row[0],
+        "staked_since": to_str(row[1]),
+        "batching_output_index": row[2],
+        "address": row[3],
+        "cumulative_pool_rpts_at_start": {
+            "numerator": row[4],
+            "denominator": row[5],
+        },
+        "output_ref": {"transaction_hash": row[6], "output_index": row[7]},
+    }
 
 
 def query_staking_positions_per_wallet(
     wallet: str,
 ):
-    cursor = sqlite_db.execute_sql(
-        """
-        SELECT
-        sp.pool_id,
-        sp.staked_since,
-        sp.batching_output_index,
-        a.address_raw,
-        scprs.cumulative_pool_rpts_at_start_numerator,
-        scprs.cumulative_pool_rpts_at_start_denominator
-        FROM
-        stakingparams sp
-        JOIN address a ON sp.owner_id = a.id
-        JOIN stakingcumulativepoolrptsatstart scprs ON scprs.staking_params_id = sp.id
-        JOIN stakingstate ss ON ss.staking_params_id = sp.id
-        WHERE a.address_raw = ?
-        ORDER BY sp.staked_since ASC, sp.batching_output_index ASC
-        """,
+    cursor = database.execute_sql(
+        staking_positions_per_wallet_query(),
         (wallet,),
     )
-    results = []
-    for row in cursor.fetchall():
-        results.append(
-            {
-                "pool_id": row[0],
-                "staked_since": row[1],
-                "batching_output_index": row[2],
-                "address": row[3],
-                "cumulative_pool_rpts_at_start": {
-                    "numerator": row[4],
-                    "denominator": row[5],
-                },
-            }
-        )
-    return results
+    return [staking_position_from_row(row) for row in cursor.fetchall()]
+
+
+def wallets_changed_since_queries(param: str = None) -> list[str]:
+    """
+    Queries with a single parameter, a slot, for the wallets whose staking positions were created
+    respectively spent in a block after that slot.
+    """
+    if param is None:
+        param = database.param
+    wallets = """
+    SELECT DISTINCT a.address_raw
+    FROM transactionoutput o
+    JOIN stakingstate ss ON ss.transaction_output_id = o.id
+    JOIN stakingparams sp ON ss.staking_params_id = sp.id
+    JOIN address a ON sp.owner_id = a.id
+    """
+    return [
+        f"""{wallets}
+    WHERE o.transaction_id IN (
+        SELECT t.id FROM block b JOIN "transaction" t ON t.block_id = b.id WHERE b.slot > {param}
+    )
+    """,
+        f"""{wallets}
+    WHERE o.spent_in_block_id IN (SELECT id FROM block WHERE slot > {param})
+    """,
+    ]
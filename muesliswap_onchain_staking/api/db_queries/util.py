@@ -1,3 +1,10 @@
+def to_str(value) -> str:
+    """
+    Render a datetime like SQLite stores it, PostgreSQL returns datetime objects.
+    """
+    return value if isinstance(value, str) else str(value)
+
+
 def parse_merged_assets(policy_ids, asset_names, amounts):
     """
     Parse the merged assets
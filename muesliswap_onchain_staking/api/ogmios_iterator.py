@@ -1,15 +1,28 @@
+import copyreg
+import asyncio
 import json
 import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
+from typing import Callable, Optional
 
+import cbor2
 import pycardano
 import websocket
+import websockets
 
 from muesliswap_onchain_staking.api.config import (
     START_BLOCK_SLOT,
     START_BLOCK_HASH,
 )
-from muesliswap_onchain_staking.api.util import FixedTxHashTransaction
+from muesliswap_onchain_staking.api.tx_filter import TxPreFilter, input_tx_hashes
+from muesliswap_onchain_staking.api.util import (
+    FixedTxHashTransaction,
+    UndecodedTransaction,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -22,6 +35,10 @@ NEXT_BLOCK = TEMPLATE.copy()
 NEXT_BLOCK["method"] = "nextBlock"
 NEXT_BLOCK = json.dumps(NEXT_BLOCK)
 
+QUERY_TIP = TEMPLATE.copy()
+QUERY_TIP["method"] = "queryNetwork/tip"
+QUERY_TIP = json.dumps(QUERY_TIP)
+
 
 @dataclass
 class Point:
@@ -44,6 +61,8 @@ class Origin:
 class Rollforward:
     tip: Tip
     block: dict
+    # transactions of the block, if they were already decoded
+    txs: Optional[list[FixedTxHashTransaction | UndecodedTransaction]] = None
 
 
 @dataclass
@@ -54,45 +73,236 @@ class Rollback:
 NextBlockResult = Rollforward | Rollback
 
 
+def _register_pickle_support():
+    """
+    Decoded transactions are sent back from the decoding workers, but the C implementation
+    of CBORTag can not be pickled and pycardano's dict types can not be unpickled by default.
+    """
+    copyreg.pickle(cbor2.CBORTag, lambda tag: (cbor2.CBORTag, (tag.tag, tag.value)))
+    subclasses = [pycardano.serialization.DictCBORSerializable]
+    while subclasses:
+        cls = subclasses.pop()
+        copyreg.pickle(cls, lambda d: (type(d), (d.data,)))
+        subclasses.extend(cls.__subclasses__())
+
+
+_register_pickle_support()
+
+
 class OgmiosIterator:
-    def __init__(self, ogmios_url: str):
+    def __init__(self, ogmios_url: str, in_flight: int = 100):
         self.ogmios_url = ogmios_url
+        self.in_flight = in_flight
         self.ws = websocket.WebSocket()
         self.ws.connect(self.ogmios_url)
 
     def _init_connection(self, start_points: list[Point]):
-        data = TEMPLATE.copy()
-        data["method"] = "findIntersection"
-        data["params"] = {
-            "points": [{"slot": p.slot, "id": p.id} for p in start_points]
-            + [{"slot": START_BLOCK_SLOT, "id": START_BLOCK_HASH}]
-            + ["origin"]
-        }
-
-        self.ws.send(json.dumps(data))
-        # we send the origin so we will always find an intersection
-        print(self.ws.recv())
+        self.ws.send(find_intersection_request(start_points))
+        _LOGGER.info(f"Intersection: {self.ws.recv()}")
 
     def iterate_blocks(self, start_points: list[Point]):
         self._init_connection(start_points)
-        # we want to always keep 100 blocks in queue to avoid waiting for node
-        for _ in range(100):
+        # we want to always keep some blocks in queue to avoid waiting for node
+        for _ in range(self.in_flight):
             self.ws.send(NEXT_BLOCK)
         while True:
-            resp = json.loads(self.ws.recv())
-            result = resp["result"]
-            if result["direction"] == "forward":
-                yield Rollforward(
-                    tip=Tip(**result["tip"]),
-                    block=result["block"],
+            yield parse_next_block(self.ws.recv())
+            self.ws.send(NEXT_BLOCK)
+
+
+class PipelinedOgmiosIterator(OgmiosIterator):
+    """
+    Receives from ogmios on a separate thread and decodes the blocks in a pool of worker processes.
+    Results (rollbacks included) are yielded in the order in which they were received.
+    The yielded blocks come with decoded transactions and without their raw transactions.
+    """
+
+    def __init__(
+        self,
+        ogmios_url: str,
+        in_flight: int = 100,
+        workers: int = None,
+        tx_filter: Optional[TxPreFilter] = None,
+    ):
+        super().__init__(ogmios_url, in_flight)
+        self.workers = workers
+        self.tx_filter = tx_filter
+
+    def _receive(
+        self,
+        pool: ProcessPoolExecutor,
+        results: queue.Queue,
+        stop: threading.Event,
+    ):
+        try:
+            for _ in range(self.in_flight):
+                self.ws.send(NEXT_BLOCK)
+            while not stop.is_set():
+                # blocks while the consumer is behind by more than the in-flight window
+                results.put(
+                    pool.submit(decode_next_block, self.ws.recv(), self.tx_filter)
                 )
-            else:
-                yield Rollback(
-                    tip=Point(**result["point"])
-                    if "origin" != result["point"]
-                    else Origin(),
+                self.ws.send(NEXT_BLOCK)
+        except Exception as e:
+            if not stop.is_set():
+                results.put(e)
+
+    def iterate_blocks(self, start_points: list[Point]):
+        self._init_connection(start_points)
+        results = queue.Queue(maxsize=self.in_flight)
+        stop = threading.Event()
+        # spawn, as forking from a process with a running receiver thread is unsafe
+        with ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            receiver = threading.Thread(
+                target=self._receive, args=(pool, results, stop), daemon=True
+            )
+            receiver.start()
+            try:
+                while True:
+                    result: Future | Exception = results.get()
+                    if isinstance(result, Exception):
+                        raise result
+                    yield result.result()
+            finally:
+                stop.set()
+                self.ws.close()
+                pool.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncOgmiosIterator:
+    """
+    asyncio based variant of OgmiosIterator that keeps running if the connection drops.
+
+    Results are passed to the consumer through a bounded queue, so that no more blocks are
+    requested while the consumer is behind. On connection loss or a missed heartbeat,
+    it reconnects and intersects again with the points returned by `start_points`,
+    which should be derived from the blocks persisted so far.
+    Ogmios always answers a new intersection with a rollback to the intersection,
+    so blocks that were received but not yet persisted are simply discarded.
+    """
+
+    def __init__(
+        self,
+        ogmios_url: str,
+        start_points: Callable[[], list[Point]],
+        in_flight: int = 100,
+        heartbeat_interval: float = 20,
+        heartbeat_timeout: float = 20,
+        max_reconnect_delay: float = 30,
+    ):
+        self.ogmios_url = ogmios_url
+        self.start_points = start_points
+        self.in_flight = in_flight
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_reconnect_delay = max_reconnect_delay
+        self._reconnect_delay = 1
+
+    async def _sync(self, results: asyncio.Queue):
+        async with websockets.connect(
+            self.ogmios_url,
+            max_size=None,
+            ping_interval=self.heartbeat_interval,
+            ping_timeout=self.heartbeat_timeout,
+        ) as ws:
+            # looked up only now, to intersect at the latest persisted blocks
+            start_points = await asyncio.to_thread(self.start_points)
+            await ws.send(find_intersection_request(start_points))
+            intersection = await asyncio.wait_for(ws.recv(), self.heartbeat_timeout)
+            _LOGGER.info(f"Intersection: {intersection}")
+            self._reconnect_delay = 1
+            # results from the previous connection are superseded by the rollback to the intersection
+            while not results.empty():
+                results.get_nowait()
+            for _ in range(self.in_flight):
+                await ws.send(NEXT_BLOCK)
+            while True:
+                await results.put(parse_next_block(await ws.recv()))
+                await ws.send(NEXT_BLOCK)
+
+    async def _receive(self, results: asyncio.Queue):
+        while True:
+            try:
+                await self._sync(results)
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                _LOGGER.warning(
+                    f"Lost connection to ogmios ({e!r}), reconnecting in {self._reconnect_delay}s"
                 )
-            self.ws.send(NEXT_BLOCK)
+            except Exception as e:
+                await results.put(e)
+                raise
+            await asyncio.sleep(self._reconnect_delay)
+            self._reconnect_delay = min(
+                2 * self._reconnect_delay, self.max_reconnect_delay
+            )
+
+    async def iterate_blocks(self):
+        results = asyncio.Queue(maxsize=self.in_flight)
+        receiver = asyncio.create_task(self._receive(results))
+        try:
+            while True:
+                result = await results.get()
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            receiver.cancel()
+
+
+def query_tip(ogmios_url: str) -> Point | Origin:
+    """
+    The current tip of the node.
+    """
+    ws = websocket.WebSocket()
+    ws.connect(ogmios_url)
+    try:
+        ws.send(QUERY_TIP)
+        result = json.loads(ws.recv())["result"]
+    finally:
+        ws.close()
+    return (
+        Point(slot=result["slot"], id=result["id"]) if result != "origin" else Origin()
+    )
+
+
+def find_intersection_request(start_points: list[Point]) -> str:
+    data = TEMPLATE.copy()
+    data["method"] = "findIntersection"
+    data["params"] = {
+        "points": [{"slot": p.slot, "id": p.id} for p in start_points]
+        + [{"slot": START_BLOCK_SLOT, "id": START_BLOCK_HASH}]
+        # we send the origin so we will always find an intersection
+        + ["origin"]
+    }
+    return json.dumps(data)
+
+
+def parse_next_block(message: str) -> NextBlockResult:
+    result = json.loads(message)["result"]
+    if result["direction"] == "forward":
+        return Rollforward(
+            tip=Tip(**result["tip"]),
+            block=result["block"],
+        )
+    return Rollback(
+        tip=Point(**result["point"]) if "origin" != result["point"] else Origin(),
+    )
+
+
+def decode_next_block(
+    message: str, tx_filter: Optional[TxPreFilter] = None
+) -> NextBlockResult:
+    """
+    Parse the response to nextBlock and decode the transactions of the block.
+    Runs in the worker processes of the pipelined iterator.
+    """
+    result = parse_next_block(message)
+    if isinstance(result, Rollforward):
+        result.txs = txs_from_block(result.block, tx_filter)
+        result.block.pop("transactions", None)
+    return result
 
 
 def tip_from_block(block: dict) -> Tip:
@@ -103,39 +313,65 @@ def tip_from_block(block: dict) -> Tip:
     )
 
 
-def txs_from_block(block: dict) -> list[FixedTxHashTransaction]:
+def decode_tx(tx_hash: str, tx_cbor: str) -> Optional[FixedTxHashTransaction]:
+    """
+    Decode a transaction, returns None for transactions that are not supported by pycardano.
+    """
+    try:
+        return FixedTxHashTransaction(
+            transaction=pycardano.Transaction.from_cbor(tx_cbor),
+            hash=tx_hash,
+        )
+    except pycardano.DeserializeException as e:
+        if "pycardano.certificate" in str(e):
+            _LOGGER.info(
+                "Ignoring transaction with a certificate that is not supported by pycardano"
+            )
+            return None
+        _LOGGER.warning(f"Could not decode transaction {tx_hash}", exc_info=True)
+        raise ValueError(f"Error parsing transactions in block: {e}") from e
+    except ValueError as e:
+        if "2 is not a valid Network" in str(e):
+            _LOGGER.info(
+                "Ignoring transaction with Byron address, not supported by pycardano"
+            )
+            return None
+        _LOGGER.warning(f"Could not decode transaction {tx_hash}", exc_info=True)
+        raise ValueError(f"Error parsing transactions in block: {e}") from e
+    except Exception as e:
+        _LOGGER.warning(f"Could not decode transaction {tx_hash}", exc_info=True)
+        raise ValueError(f"Error parsing transactions in block: {e}") from e
+
+
+def txs_from_block(
+    block: dict, tx_filter: Optional[TxPreFilter] = None
+) -> list[FixedTxHashTransaction | UndecodedTransaction]:
+    """
+    Decode the transactions of the block.
+    If a pre-filter is given, transactions that do not match it are not decoded.
+    """
     if block["type"] == "ebb":
         return []
     txs_transformed = []
     for tx in block["transactions"]:
         try:
-            txs_transformed.append(
-                FixedTxHashTransaction(
-                    transaction=pycardano.Transaction.from_cbor(tx["cbor"]),
-                    hash=tx["id"],
-                )
-            )
+            tx_hash, tx_cbor = tx["id"], tx["cbor"]
         except KeyError as e:
             raise ValueError(
                 f"Error parsing transactions in block: {e}, make sure that --include-cbor is set as flag when running ogmios"
             ) from e
-        except pycardano.DeserializeException as e:
-            if "pycardano.certificate" in str(e):
-                _LOGGER.info(
-                    "Ignoring transaction with a certificate that is not supported by pycardano"
+        if tx_filter is not None:
+            tx_bytes = bytes.fromhex(tx_cbor)
+            if not tx_filter.matches(tx_bytes):
+                txs_transformed.append(
+                    UndecodedTransaction(
+                        hash=tx_hash,
+                        cbor=tx_cbor,
+                        input_tx_hashes=input_tx_hashes(tx_bytes),
+                    )
                 )
                 continue
-            print(tx)
-            raise ValueError(f"Error parsing transactions in block: {e}") from e
-        except ValueError as e:
-            if "2 is not a valid Network" in str(e):
-                _LOGGER.info(
-                    "Ignoring transaction with Byron address, not supported by pycardano"
-                )
-                continue
-            print(tx)
-            raise ValueError(f"Error parsing transactions in block: {e}") from e
-        except Exception as e:
-            print(tx)
-            raise ValueError(f"Error parsing transactions in block: {e}") from e
+        decoded_tx = decode_tx(tx_hash, tx_cbor)
+        if decoded_tx is not None:
+            txs_transformed.append(decoded_tx)
     return txs_transformed
@@ -0,0 +1,137 @@
+"""
+Cache for the serialized responses of the API server.
+
+Responses are stored as ORJSON bytes under a key that contains the hash of the latest processed block,
+so that no response outlives the block it was computed for, also when the backend is shared between
+API replicas (e.g. Redis). In addition, the whole cache is cleared on every new block.
+The backends are those of fastapi-cache, selected by RESPONSE_CACHE_URL:
+
+    memory          bounded in-memory cache (default)
+    redis://host    Redis, requires the redis package
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+import orjson
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends import Backend
+
+from .chain_tip import ChainTip
+
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", "memory")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+
+
+class BoundedInMemoryBackend(Backend):
+    """
+    In-memory backend that keeps at most `maxsize` entries, evicting the least recently used one.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._store: OrderedDict[str, Tuple[float, bytes]] = OrderedDict()
+
+    def _get(self, key: str) -> Optional[Tuple[float, bytes]]:
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._store[key]
+            return None
+        self._store.move_to_end(key)
+        return entry
+
+    async def get_with_ttl(self, key: str) -> Tuple[int, Optional[bytes]]:
+        entry = self._get(key)
+        if entry is None:
+            return 0, None
+        return int(entry[0] - time.monotonic()), entry[1]
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._get(key)
+        return entry[1] if entry is not None else None
+
+    async def set(self, key: str, value: bytes, expire: Optional[int] = None) -> None:
+        self._store[key] = (time.monotonic() + (expire or 0), value)
+        self._store.move_to_end(key)
+        if len(self._store) > self.maxsize:
+            self._store.popitem(last=False)
+
+    async def clear(
+        self, namespace: Optional[str] = None, key: Optional[str] = None
+    ) -> int:
+        if key is not None:
+            return 1 if self._store.pop(key, None) is not None else 0
+        keys = [k for k in self._store if namespace is None or k.startswith(namespace)]
+        for k in keys:
+            del self._store[k]
+        return len(keys)
+
+
+def make_cache_backend(url: str) -> Backend:
+    if url.startswith("redis"):
+        from fastapi_cache.backends.redis import RedisBackend
+        from redis import asyncio as aioredis
+
+        return RedisBackend(aioredis.from_url(url))
+    return BoundedInMemoryBackend(RESPONSE_CACHE_SIZE)
+
+
+class ResponseCache:
+    """
+    Serves responses from the backend initialized with FastAPICache.init, computing them on a miss.
+    Concurrent misses for the same key are only computed once.
+    """
+
+    def __init__(self, chain_tip: ChainTip):
+        self.chain_tip = chain_tip
+        self.hits = 0
+        self.misses = 0
+        self._pending: dict[str, asyncio.Future] = {}
+
+    def _key(self, key: str) -> str:
+        return f"{FastAPICache.get_prefix()}:{self.chain_tip.hash}:{key}"
+
+    async def get(self, key: str, compute: Callable[[], Awaitable[Any]]) -> bytes:
+        """
+        The serialized response for the key, which must identify the endpoint and its parameters.
+        """
+        key = self._key(key)
+        body = await FastAPICache.get_backend().get(key)
+        if body is not None:
+            self.hits += 1
+            return body
+        self.misses += 1
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        pending = self._pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            body = orjson.dumps(await compute())
+            await FastAPICache.get_backend().set(
+                key, body, expire=FastAPICache.get_expire()
+            )
+            pending.set_result(body)
+            return body
+        except Exception as e:
+            pending.set_exception(e)
+            # mark the exception as retrieved, there may be no concurrent callers waiting for it
+            pending.exception()
+            raise
+        finally:
+            del self._pending[key]
+
+    async def invalidate(self, _block: Optional[dict] = None):
+        await FastAPICache.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,142 @@
+"""
+Reward engine computing the rewards claimable by staking positions, as paid out when unstaking.
+
+The cumulative rewards per token of a farm are advanced to the requested time like
+`compute_updated_cumulative_rewards_per_token` does on-chain, once per farm.
+All positions of the farm are then computed in one pass with exact integer arithmetic,
+using `floor_scale_fraction` on the same unnormalized fractions as the contracts.
+"""
+
+import datetime
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+from ..onchain.staking import MILLIS_IN_DAY
+
+# numerator and denominator
+IntFraction = Tuple[int, int]
+
+
+def to_posix_millis(value) -> int:
+    """
+    Convert a stored datetime (a string on SQLite) back to the POSIX time in milliseconds it was created from.
+    Stored datetimes are naive and in UTC, see `to_datetime`.
+    """
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return round(value.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def _by_idx(entries: List[dict], value) -> list:
+    # entries are identified by their index, which gives the order of the reward tokens
+    by_idx = {int(entry["idx"]): value(entry) for entry in entries}
+    return [by_idx[idx] for idx in sorted(by_idx)]
+
+
+@dataclass
+class FarmRewards:
+    """
+    The reward parameters of the current state of a farm.
+    """
+
+    pool_id: str
+    reward_tokens: List[dict]
+    emission_rates: List[int]
+    last_update_time: int
+    amount_staked: int
+    cumulative_rewards_per_token: List[IntFraction]
+
+    @classmethod
+    def from_farm(cls, farm: dict) -> "FarmRewards":
+        """
+        Create from a farm as returned by the farms query.
+        """
+        return cls(
+            pool_id=farm["pool_id"],
+            reward_tokens=_by_idx(
+                farm["reward_tokens"],
+                lambda t: {"policy_id": t["policy_id"], "asset_name": t["asset_name"]},
+            ),
+            emission_rates=_by_idx(
+                farm["emission_rates"], lambda e: int(e["emission_rate"])
+            ),
+            last_update_time=to_posix_millis(farm["last_update_time"]),
+            amount_staked=int(farm["amount_staked"]),
+            cumulative_rewards_per_token=_by_idx(
+                farm["cumulative_rewards_per_token"],
+                lambda c: (int(c["numerator"]), int(c["denominator"])),
+            ),
+        )
+
+    def cumulative_rewards_per_token_at(self, time: int) -> List[IntFraction]:
+        """
+        The cumulative rewards per token if the farm was updated at the given POSIX time in milliseconds.
+        """
+        if self.amount_staked == 0:
+            return list(self.cumulative_rewards_per_token)
+        # the contracts only accept strictly increasing update times
+        elapsed = max(time - self.last_update_time, 0)
+        denominator = self.amount_staked * MILLIS_IN_DAY
+        return [
+            (
+                numerator * denominator + emission_rate * elapsed * start_denominator,
+                start_denominator * denominator,
+            )
+            for (numerator, start_denominator), emission_rate in zip(
+                self.cumulative_rewards_per_token, self.emission_rates
+            )
+        ]
+
+    def claimable_rewards(
+        self,
+        positions: Iterable[Tuple[int, List[IntFraction]]],
+        time: int,
+    ) -> List[List[int]]:
+        """
+        The claimable amount of every reward token for each position,
+        given as its staked amount and its cumulative rewards per token at start.
+        """
+        current = self.cumulative_rewards_per_token_at(time)
+        return [
+            [
+                (numerator * amount) // denominator
+                - (start_numerator * amount) // start_denominator
+                for (numerator, denominator), (
+                    start_numerator,
+                    start_denominator,
+                ) in zip(current, starts)
+            ]
+            for amount, starts in positions
+        ]
+
+
+def add_claimable_rewards(
+    farms: Dict[str, FarmRewards], positions: List[dict], time: int
+) -> List[dict]:
+    """
+    Add the claimable rewards to positions as returned by the position stakes queries,
+    computing all positions of a farm in one pass. Positions of unknown farms get no rewards.
+    """
+    per_farm = defaultdict(list)
+    for position in positions:
+        per_farm[position["pool_id"]].append(position)
+    for pool_id, farm_positions in per_farm.items():
+        farm = farms.get(pool_id)
+        if farm is None:
+            for position in farm_positions:
+                position["claimable_rewards"] = []
+            continue
+        amounts = farm.claimable_rewards(
+            (
+                (position["staked_amount"], position["cumulative_pool_rpts_at_start"])
+                for position in farm_positions
+            ),
+            time,
+        )
+        for position, position_amounts in zip(farm_positions, amounts):
+            position["claimable_rewards"] = [
+                {**token, "amount": amount}
+                for token, amount in zip(farm.reward_tokens, position_amounts)
+            ]
+    return positions
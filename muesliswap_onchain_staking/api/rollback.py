@@ -0,0 +1,163 @@
+"""
+Reverting blocks on chain rollbacks.
+
+Rows created for a block are either reachable through its transactions (outputs, their values and states),
+marked by it (spent outputs) or recorded in its undo journal (params created with `BlockWriter.get_or_create`).
+Outputs spent by a reverted block are added back to the current state tables.
+Reverting a block therefore only touches the rows it changed, instead of cascading over whole tables.
+The journal is only kept for the last SECURITY_PARAMETER blocks, deeper rollbacks (e.g. to origin
+or to a slot requested manually) clean up orphaned params afterwards.
+
+    python -m muesliswap_onchain_staking.api.rollback rollback_to --slot 68140523
+    python -m muesliswap_onchain_staking.api.rollback delete_orphaned_params
+"""
+
+import logging
+from collections import defaultdict
+from typing import List, Optional
+
+import fire
+import peewee
+
+from .config import SECURITY_PARAMETER
+from .db_models import (
+    Block,
+    FarmCumulativeRewardPerToken,
+    FarmEmissionRate,
+    FarmParams,
+    FarmRewardToken,
+    FarmState,
+    StakingCumulativePoolRptsAtStart,
+    StakingParams,
+    StakingState,
+    Transaction,
+    TransactionOutput,
+    UndoEntry,
+    database,
+)
+from .tx_processor import current_state
+
+_LOGGER = logging.getLogger(__name__)
+
+# models that may be recorded in the undo journal, referencing models before referenced ones
+JOURNALED_MODELS = [
+    StakingCumulativePoolRptsAtStart,
+    StakingParams,
+    FarmRewardToken,
+    FarmEmissionRate,
+    FarmCumulativeRewardPerToken,
+    FarmParams,
+]
+
+BATCH_SIZE = 100
+
+
+def revert_blocks(block_ids: List[int]):
+    """
+    Undo all changes of the given blocks and delete them.
+    The blocks must be the latest ones, as rows of later blocks may depend on them.
+    Params created by one of the blocks may still be referenced by the states of a later one,
+    so the states of all blocks are deleted before any of their params.
+    Addresses, datums and tokens are intentionally kept: they are shared rows looked up by their
+    content, which the blocks that are synced again after the rollback mostly reference anyway.
+    """
+    with database.atomic():
+        unspent_output_ids = []
+        for batch in peewee.chunked(block_ids, BATCH_SIZE):
+            unspent_output_ids.extend(
+                output_id
+                for (output_id,) in TransactionOutput.select(TransactionOutput.id)
+                .where(TransactionOutput.spent_in_block.in_(batch))
+                .tuples()
+            )
+            TransactionOutput.update(spent_in_block=None).where(
+                TransactionOutput.spent_in_block.in_(batch)
+            ).execute()
+            # outputs, their values and states are deleted along with the transactions
+            Transaction.delete().where(Transaction.block.in_(batch)).execute()
+
+        journal = defaultdict(list)
+        for batch in peewee.chunked(block_ids, BATCH_SIZE):
+            for table_name, row_id in (
+                UndoEntry.select(UndoEntry.table_name, UndoEntry.row_id)
+                .where(UndoEntry.block.in_(batch))
+                .tuples()
+            ):
+                journal[table_name].append(row_id)
+        for model in JOURNALED_MODELS:
+            for ids in peewee.chunked(journal[model._meta.table_name], BATCH_SIZE):
+                model.delete().where(model.id.in_(ids)).execute()
+
+        for batch in peewee.chunked(block_ids, BATCH_SIZE):
+            Block.delete().where(Block.id.in_(batch)).execute()
+        # outputs of the reverted blocks are gone, the others are live again
+        current_state.add_outputs(unspent_output_ids)
+
+    # only the journal of the last SECURITY_PARAMETER blocks is kept
+    if len(block_ids) > SECURITY_PARAMETER:
+        delete_orphaned_params()
+
+
+def rollback_to(slot: Optional[int] = None) -> int:
+    """
+    Revert all blocks after the given slot, or all blocks if no slot is given.
+    Returns the number of reverted blocks.
+    """
+    query = Block.select(Block.id)
+    if slot is not None:
+        query = query.where(Block.slot > slot)
+    block_ids = [block_id for (block_id,) in query.tuples()]
+    revert_blocks(block_ids)
+    return len(block_ids)
+
+
+def prune_journal():
+    """
+    Drop the undo journal of blocks that are deeper than the security parameter and can not be rolled back.
+    """
+    horizon = (
+        Block.select(Block.id)
+        .order_by(Block.slot.desc())
+        .offset(SECURITY_PARAMETER)
+        .first()
+    )
+    if horizon is None:
+        return
+    UndoEntry.delete().where(UndoEntry.block <= horizon.id).execute()
+
+
+def delete_orphaned_params() -> int:
+    """
+    Delete params that are not referenced by any state anymore.
+    Returns the number of deleted params.
+    """
+    with database.atomic():
+        staking_params = StakingParams.select(StakingParams.id).where(
+            StakingParams.id.not_in(StakingState.select(StakingState.staking_params))
+        )
+        StakingCumulativePoolRptsAtStart.delete().where(
+            StakingCumulativePoolRptsAtStart.staking_params.in_(staking_params)
+        ).execute()
+        deleted = (
+            StakingParams.delete()
+            .where(
+                StakingParams.id.not_in(
+                    StakingState.select(StakingState.staking_params)
+                )
+            )
+            .execute()
+        )
+        # reward tokens, emission rates and cumulative rewards are deleted along with the params
+        deleted += (
+            FarmParams.delete()
+            .where(FarmParams.id.not_in(FarmState.select(FarmState.farm_params)))
+            .execute()
+        )
+    _LOGGER.info(f"Deleted {deleted} orphaned params")
+    return deleted
+
+
+if __name__ == "__main__":
+    fire.Fire(
+        {"rollback_to": rollback_to, "delete_orphaned_params": delete_orphaned_params}
+    )
@@ -1,18 +1,37 @@
+import asyncio
 import logging
-from copy import deepcopy
+import orjson
+import os
+import time
 from contextlib import asynccontextmanager
-from typing import Any
+from collections import defaultdict
+from typing import Annotated, Any, Optional
 
-from fastapi import Query, FastAPI
-from fastapi.responses import ORJSONResponse
+from fastapi import HTTPException, Path, Query, FastAPI, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from starlette.responses import Response
 from fastapi_cache import FastAPICache, Coder
-from fastapi_cache.backends.inmemory import InMemoryBackend
+from pydantic import BaseModel, Field, StringConstraints
 from fastapi.middleware.cors import CORSMiddleware
 
-from muesliswap_onchain_staking.api.db_models import db
+from muesliswap_onchain_staking.api.chain_querier import sync_chain
+from muesliswap_onchain_staking.api.change_feed import (
+    CHANGE_FEED_URL,
+    ChangeFeed,
+    relay_from_redis,
+)
+from muesliswap_onchain_staking.api.chain_tip import ChainTip, WalletMarkers
+from muesliswap_onchain_staking.api.db_models.db import DATABASE_URL
 
 from muesliswap_onchain_staking.api.db_queries import *
+from muesliswap_onchain_staking.api.db_queries.farm_history import downsample
+from muesliswap_onchain_staking.api.util import address_credentials
+from muesliswap_onchain_staking.api.rewards import FarmRewards, add_claimable_rewards
+from muesliswap_onchain_staking.api.response_cache import (
+    RESPONSE_CACHE_URL,
+    ResponseCache,
+    make_cache_backend,
+)
 
 # logger setup
 _LOGGER = logging.getLogger(__name__)
@@ -20,6 +39,20 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO, force=True
 )
 
+# follow the chain inside the API process instead of running a separate chain querier
+SYNC_CHAIN_IN_API = os.getenv("SYNC_CHAIN_IN_API", "false").lower() == "true"
+
+repository = make_repository(DATABASE_URL)
+chain_tip = ChainTip(repository)
+wallet_markers = WalletMarkers(repository)
+response_cache = ResponseCache(chain_tip)
+change_feed = ChangeFeed()
+
+# maximum number of wallets and of key hashes per batch request
+MAX_BATCH_SIZE = 1000
+# interval of the keep-alive comments on the change stream
+STREAM_KEEPALIVE_INTERVAL = 15
+
 
 def DashingQuery(convert_underscores=True, **kwargs) -> Query:
     """
@@ -30,7 +63,34 @@ def DashingQuery(convert_underscores=True, **kwargs) -> Query:
     return query
 
 
+@asynccontextmanager
+async def startup(_app: FastAPI):
+    # responses are cached as serialized bytes, hence no coder
+    FastAPICache.init(
+        make_cache_backend(RESPONSE_CACHE_URL),
+        prefix="staking-api",
+        expire=20,
+        coder=NoCoder,
+    )
+    await repository.open()
+    chain_tip.listeners.append(response_cache.invalidate)
+    chain_tip.listeners.append(wallet_markers.update)
+    await chain_tip.poll()
+    tasks = [asyncio.create_task(chain_tip.follow())]
+    if SYNC_CHAIN_IN_API:
+        tasks.append(asyncio.create_task(sync_chain(publisher=change_feed)))
+    elif CHANGE_FEED_URL.startswith("redis"):
+        tasks.append(
+            asyncio.create_task(relay_from_redis(CHANGE_FEED_URL, change_feed))
+        )
+    yield
+    for task in tasks:
+        task.cancel()
+    await repository.close()
+
+
 app = FastAPI(
+    lifespan=startup,
     default_response_class=ORJSONResponse,
     title="MuesliSwap Staking API",
     description="The MuesliSwap Staking API provides access to on-chain data for the MuesliSwap On-Chain Staking System.",
@@ -56,17 +116,6 @@ class NoCoder(Coder):
         return value
 
 
-@asynccontextmanager
-async def startup():
-    # For now in memory, but we can use redis or other backends later
-    FastAPICache.init(
-        InMemoryBackend(),
-        expire=20,
-        coder=NoCoder,
-    )
-    yield
-
-
 def add_cachecontrol(response: Response, max_age: int, directive: str = "public"):
     # see https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
     # and https://fastapi.tiangolo.com/advanced/response-headers/
@@ -79,6 +128,38 @@ def add_jsoncontenttype(response: Response):
     response.headers["Content-Type"] = f"application/json"
 
 
+def cached_json_response(body: bytes, max_age: int, etag: Optional[str]) -> Response:
+    # headers set on the injected response are dropped when a response is returned directly
+    response = Response(content=body, media_type="application/json")
+    add_cachecontrol(response, max_age=max_age)
+    if etag is not None:
+        response.headers["ETag"] = etag
+    return response
+
+
+def make_etag(marker: str) -> Optional[str]:
+    # no ETag before the first block is processed
+    return f'"{marker}"' if marker else None
+
+
+def etag_matches(request: Request, etag: Optional[str]) -> bool:
+    # see https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/If-None-Match
+    if_none_match = request.headers.get("If-None-Match")
+    if etag is None or if_none_match is None:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in [
+        candidate.removeprefix("W/") for candidate in candidates
+    ]
+
+
+def not_modified_response(etag: str, max_age: int) -> Response:
+    response = Response(status_code=304)
+    add_cachecontrol(response, max_age=max_age)
+    response.headers["ETag"] = etag
+    return response
+
+
 def decode_token_name(token_name_hex: str) -> str | None:
     if token_name_hex == "":
         return ""
@@ -94,11 +175,17 @@ HEX_RE = r"^[0-9a-fA-F]+$"
 HEX_56_RE = r"^[0-9a-fA-F]{56}$"
 HEX_64_RE = r"^[0-9a-fA-F]{64}$"
 PUBKEY_HASHES_RE = r"^[0-9a-fA-F]{56}(?:,[0-9a-fA-F]{56})*$"
+WALLETS_RE = r"^([0-9a-fA-F]+(?:,[0-9a-fA-F]+)*)?$"
 TOKEN_RE = r"^(\.|[0-9a-fA-F]{56}\.[0-9a-fA-F]*)$"
 AS_BASE_RE = r"^(from|to)$"
 BOOLISH_RE = r"^(true|false|1|0)$"
 PROVIDER_RE = r"^(muesliswap|minswap|vyfi)$"
 PROPOSAL_TYPE_RE = r"^(any|[A-Za-z]+(?:,[A-Za-z]+)*)$"
+BUCKET_RE = r"^(raw|hour|day)$"
+CURSOR_RE = r"^[0-9A-Za-z_-]+$"
+ORDER_RE = r"^(asc|desc)$"
+FARM_SORT_RE = r"^(pool_id|amount_staked)$"
+POSITION_SORT_RE = r"^(staked_since|amount_staked)$"
 
 
 #################################################################################################
@@ -161,6 +248,15 @@ WalletQuery = DashingQuery(
     min_length=2,
     pattern=HEX_RE,
 )
+WalletsQuery = DashingQuery(
+    description="Comma-separated wallet addresses in hex",
+    examples=[
+        "",
+        "01dcbc64ce3cc4aeac225a45dd67dfc3717f732f6303556efb6dd8024f0420b0d045f11e8a66319f9d19ffcba35aa9fee0164014776a1f7c95",
+    ],
+    default="",
+    pattern=WALLETS_RE,
+)
 AddressQuery = DashingQuery(
     description="Wallet address in bech32",
     examples=[
@@ -200,6 +296,47 @@ TransactionIdQuery = DashingQuery(
     examples=[0, 1, 2],
     ge=0,
 )
+LimitQuery = DashingQuery(
+    default=None,
+    description=f"Return pages of at most this many items, defaults to {DEFAULT_PAGE_SIZE} when a cursor is given",
+    ge=1,
+    le=MAX_PAGE_SIZE,
+)
+CursorQuery = DashingQuery(
+    default=None,
+    description="Cursor of the page to return, as returned in next_cursor with the same sort and order",
+    max_length=512,
+    pattern=CURSOR_RE,
+)
+OrderQuery = DashingQuery(
+    default="asc",
+    description="Sort order",
+    pattern=ORDER_RE,
+)
+PoolIdQuery = DashingQuery(
+    default=None,
+    description="Pool ID of a farm",
+    max_length=64,
+    pattern=HEX_RE,
+)
+StakeTokenQuery = DashingQuery(
+    default=None,
+    description="Stake token of a farm as policy_id.asset_name in hex, or . for ada",
+    examples=[
+        ".",
+        "afbe91c0b44b3040e360057bf8354ead8c49c4979ae6ab7c4fbdc9eb.4d494c4b7632",
+    ],
+    pattern=TOKEN_RE,
+)
+RewardTokenQuery = DashingQuery(
+    default=None,
+    description="Reward token of a farm as policy_id.asset_name in hex, or . for ada",
+    examples=[
+        ".",
+        "afbe91c0b44b3040e360057bf8354ead8c49c4979ae6ab7c4fbdc9eb.4d494c4b7632",
+    ],
+    pattern=TOKEN_RE,
+)
 ProposalTypeQuery = DashingQuery(
     description="Proposal types (e.g. Opinion, Reject, GovStateUpdate, FundPayout, LicenseRelease, PoolUpgrade) that must be contained, separated through ','",
     examples=[["any"], ["FundPayout"], ["LicenseRelease", "PoolUpgrade"]],
@@ -209,39 +346,46 @@ ProposalTypeQuery = DashingQuery(
 
 
 @app.get("/api/v1/health")
-def health(response: Response):
-    add_cachecontrol(response, max_age=5)
-    add_jsoncontenttype(response)
-    last_block = db.Block.select().order_by(db.Block.slot.desc()).first()
-    return ORJSONResponse(
+async def health():
+    last_block = await repository.latest_block()
+    response = ORJSONResponse(
         {
             "status": "ok" if last_block else "nok",
-            "last_block": (
-                {
-                    "slot": last_block.slot,
-                    "height": last_block.height,
-                    "hash": last_block.hash,
-                }
-                if last_block
-                else None
-            ),
+            "last_block": last_block,
         }
     )
+    add_cachecontrol(response, max_age=5)
+    return response
 
 
-@app.get("/api/v1/farms")
-def farms(response: Response, include_decoded_names: bool = Query(default=False)):
+@app.get("/api/v1/metrics")
+async def metrics():
+    return ORJSONResponse({"response_cache": response_cache.stats()})
+
+
+def make_page(
+    limit: Optional[int], cursor: Optional[str], sort: str, order: str
+) -> Optional[Page]:
     """
-    Get all farms.
+    The requested page, None if all items are requested.
     """
-    add_cachecontrol(response, max_age=20)
-    add_jsoncontenttype(response)
-    farms_data = query_farms()
-    if not include_decoded_names:
-        return ORJSONResponse(farms_data)
+    if limit is None and cursor is None:
+        return None
+    try:
+        return Page.from_cursor(
+            limit or DEFAULT_PAGE_SIZE, sort, order == "desc", cursor
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def token_filter(token: str) -> tuple[str, str]:
+    policy_id, _, asset_name = token.lower().partition(".")
+    return policy_id, asset_name
 
-    farms_data_with_decoded_names = deepcopy(farms_data)
-    for farm in farms_data_with_decoded_names:
+
+def add_decoded_names(farms_data: list[dict]) -> list[dict]:
+    for farm in farms_data:
         farm["stake_token"]["decoded_asset_name"] = decode_token_name(
             farm["stake_token"]["asset_name"]
         )
@@ -249,26 +393,463 @@ def farms(response: Response, include_decoded_names: bool = Query(default=False)
             reward_token["decoded_asset_name"] = decode_token_name(
                 reward_token["asset_name"]
             )
-    return ORJSONResponse(farms_data_with_decoded_names)
+    return farms_data
 
 
-@app.get("/api/v1/staking/positions")
-def staking_positions(response: Response, wallet: str = WalletQuery):
+async def farms_data(include_decoded_names: bool) -> list[dict]:
+    farms_data = await repository.farms()
+    if not include_decoded_names:
+        return farms_data
+    return add_decoded_names(farms_data)
+
+
+async def farms_page_data(
+    include_decoded_names: bool, filters: dict[str, tuple], page: Optional[Page]
+):
+    farms_data, next_cursor = await repository.farms_page(filters, page)
+    if include_decoded_names:
+        add_decoded_names(farms_data)
+    if page is None:
+        return farms_data
+    return {"items": farms_data, "count": len(farms_data), "next_cursor": next_cursor}
+
+
+@app.get("/api/v1/farms")
+async def farms(
+    request: Request,
+    include_decoded_names: bool = Query(default=False),
+    pool_id: Optional[str] = PoolIdQuery,
+    stake_token: Optional[str] = StakeTokenQuery,
+    farm_type: Optional[str] = DashingQuery(default=None, max_length=64),
+    reward_token: Optional[str] = RewardTokenQuery,
+    limit: Optional[int] = LimitQuery,
+    cursor: Optional[str] = CursorQuery,
+    sort: str = DashingQuery(default="pool_id", pattern=FARM_SORT_RE),
+    order: str = OrderQuery,
+):
     """
-    Get all staking positions for a wallet.
+    Get all farms, optionally only those with the given pool ID, stake token, farm type or reward token.
+    With a limit or cursor, the farms are returned in pages ordered by sort and order,
+    as an object with the items and the cursor of the next page (null on the last page).
     """
-    add_cachecontrol(response, max_age=10)
-    add_jsoncontenttype(response)
-    positions = query_staking_positions_per_wallet(wallet)
+    page = make_page(limit, cursor, sort, order)
+    filters = {
+        name: values
+        for name, values in (
+            ("pool_id", (pool_id.lower(),) if pool_id else None),
+            ("stake_token", token_filter(stake_token) if stake_token else None),
+            ("farm_type", (farm_type,) if farm_type else None),
+            ("reward_token", token_filter(reward_token) if reward_token else None),
+        )
+        if values is not None
+    }
+    # farms can change with every block
+    etag = make_etag(chain_tip.hash)
+    if etag_matches(request, etag):
+        return not_modified_response(etag, max_age=20)
+    if not filters and page is None:
+        body = await response_cache.get(
+            f"farms:{include_decoded_names}",
+            lambda: farms_data(include_decoded_names),
+        )
+    else:
+        body = await response_cache.get(
+            f"farms:{include_decoded_names}:{sorted(filters.items())}:{page}",
+            lambda: farms_page_data(include_decoded_names, filters, page),
+        )
+    return cached_json_response(body, max_age=20, etag=etag)
+
+
+async def staking_positions_data(
+    wallet: str, pool_id: Optional[str] = None, page: Optional[Page] = None
+) -> dict:
+    if pool_id is None and page is None:
+        positions = await repository.staking_positions_per_wallet(wallet)
+        next_cursor = None
+    else:
+        positions, next_cursor = await repository.staking_positions_page(
+            "address_raw", [wallet], pool_id, page
+        )
+    data = {"items": positions, "count": len(positions)}
+    if page is not None:
+        data["next_cursor"] = next_cursor
     if not positions:
-        return ORJSONResponse(
-            {
-                "items": [],
-                "count": 0,
-                "message": "No staking positions found for this wallet.",
-            }
+        data["message"] = "No staking positions found for this wallet."
+    return data
+
+
+async def farm_rewards() -> dict[str, FarmRewards]:
+    return {
+        farm["pool_id"]: FarmRewards.from_farm(farm)
+        for farm in await repository.farms()
+    }
+
+
+async def claimable_rewards_per_position(wallet: str, at: int) -> dict[tuple, dict]:
+    positions = add_claimable_rewards(
+        await farm_rewards(), await repository.position_stakes_per_wallet(wallet), at
+    )
+    return {
+        (p["output_ref"]["transaction_hash"], p["output_ref"]["output_index"]): p
+        for p in positions
+    }
+
+
+async def staking_positions_with_rewards(
+    wallet: str, at: int, pool_id: Optional[str], page: Optional[Page]
+) -> Response:
+    # rewards accrue continuously, so these responses are neither cached nor tagged
+    data = await staking_positions_data(wallet, pool_id, page)
+    rewards = await claimable_rewards_per_position(wallet, at)
+    for item in data["items"]:
+        position = rewards.get(
+            (item["output_ref"]["transaction_hash"], item["output_ref"]["output_index"])
+        )
+        item["staked_amount"] = position["staked_amount"] if position else None
+        item["claimable_rewards"] = position["claimable_rewards"] if position else []
+    data["rewards_at"] = at
+    response = ORJSONResponse(data)
+    add_cachecontrol(response, max_age=10)
+    return response
+
+
+AtQuery = Query(
+    default=None,
+    description="POSIX time in milliseconds at which to compute the rewards, defaults to now",
+    ge=0,
+)
+
+
+def posix_millis_now() -> int:
+    return int(time.time() * 1000)
+
+
+@app.get("/api/v1/staking/positions")
+async def staking_positions(
+    request: Request,
+    wallet: str = WalletQuery,
+    include_rewards: bool = Query(default=False),
+    at: Optional[int] = AtQuery,
+    pool_id: Optional[str] = PoolIdQuery,
+    limit: Optional[int] = LimitQuery,
+    cursor: Optional[str] = CursorQuery,
+    sort: str = DashingQuery(default="staked_since", pattern=POSITION_SORT_RE),
+    order: str = OrderQuery,
+):
+    """
+    Get all staking positions for a wallet, optionally only those in the farm with the given pool ID.
+    With include_rewards, every position contains its staked amount and the amounts of the reward tokens
+    it could claim by unstaking at the given time.
+    With a limit or cursor, the positions are returned in pages ordered by sort and order,
+    together with the cursor of the next page (null on the last page).
+    """
+    page = make_page(limit, cursor, sort, order)
+    if pool_id is not None:
+        pool_id = pool_id.lower()
+    if include_rewards:
+        return await staking_positions_with_rewards(
+            wallet, at if at is not None else posix_millis_now(), pool_id, page
+        )
+    etag = make_etag(wallet_markers.marker(wallet))
+    if etag_matches(request, etag):
+        return not_modified_response(etag, max_age=10)
+    body = await response_cache.get(
+        f"staking_positions:{wallet}"
+        if pool_id is None and page is None
+        else f"staking_positions:{wallet}:{pool_id}:{page}",
+        lambda: staking_positions_data(wallet, pool_id, page),
+    )
+    return cached_json_response(body, max_age=10, etag=etag)
+
+
+@app.get("/api/v1/staking/positions/by-stake-key")
+async def staking_positions_by_stake_key(
+    request: Request,
+    stake_key_hash: str = StakekeyHashQuery,
+    pool_id: Optional[str] = PoolIdQuery,
+    limit: Optional[int] = LimitQuery,
+    cursor: Optional[str] = CursorQuery,
+    sort: str = DashingQuery(default="staked_since", pattern=POSITION_SORT_RE),
+    order: str = OrderQuery,
+):
+    """
+    Get all staking positions of the addresses delegating with a stake key hash,
+    filtered and paged like the positions of a wallet.
+    """
+    return await staking_positions_by_credential(
+        request,
+        "stake_credential",
+        stake_key_hash.lower(),
+        pool_id.lower() if pool_id else None,
+        make_page(limit, cursor, sort, order),
+    )
+
+
+@app.get("/api/v1/staking/positions/by-payment-key")
+async def staking_positions_by_payment_key(
+    request: Request,
+    pubkey_hash: str = PubkeyHashQuery,
+    pool_id: Optional[str] = PoolIdQuery,
+    limit: Optional[int] = LimitQuery,
+    cursor: Optional[str] = CursorQuery,
+    sort: str = DashingQuery(default="staked_since", pattern=POSITION_SORT_RE),
+    order: str = OrderQuery,
+):
+    """
+    Get all staking positions of the addresses with a payment key hash,
+    filtered and paged like the positions of a wallet.
+    """
+    return await staking_positions_by_credential(
+        request,
+        "payment_credential",
+        pubkey_hash.lower(),
+        pool_id.lower() if pool_id else None,
+        make_page(limit, cursor, sort, order),
+    )
+
+
+async def staking_positions_by_credential(
+    request: Request,
+    column: str,
+    credential: str,
+    pool_id: Optional[str],
+    page: Optional[Page],
+) -> Response:
+    # the markers are per wallet, so any block may change the positions of a credential
+    etag = make_etag(chain_tip.hash)
+    if etag_matches(request, etag):
+        return not_modified_response(etag, max_age=10)
+
+    async def data():
+        if pool_id is None and page is None:
+            positions = await repository.staking_positions_per_credentials(
+                column, [credential]
+            )
+            return {"items": positions, "count": len(positions)}
+        positions, next_cursor = await repository.staking_positions_page(
+            column, [credential], pool_id, page
         )
-    return ORJSONResponse({"items": positions, "count": len(positions)})
+        data = {"items": positions, "count": len(positions)}
+        if page is not None:
+            data["next_cursor"] = next_cursor
+        return data
+
+    body = await response_cache.get(
+        f"staking_positions:{column}:{credential}:{pool_id}:{page}", data
+    )
+    return cached_json_response(body, max_age=10, etag=etag)
+
+
+class StakingPositionsBatch(BaseModel):
+    wallets: list[
+        Annotated[str, StringConstraints(min_length=2, pattern=HEX_RE)]
+    ] = Field(
+        default=[],
+        max_length=MAX_BATCH_SIZE,
+        description="Wallet addresses in hex",
+    )
+    stake_key_hashes: list[
+        Annotated[str, StringConstraints(pattern=HEX_56_RE)]
+    ] = Field(
+        default=[],
+        max_length=MAX_BATCH_SIZE,
+        description="Stake key hashes, matching all addresses delegating with them",
+    )
+    pubkey_hashes: list[Annotated[str, StringConstraints(pattern=HEX_56_RE)]] = Field(
+        default=[],
+        max_length=MAX_BATCH_SIZE,
+        description="Payment key hashes, matching all addresses with them",
+    )
+
+
+def unique_lower(values: list[str]) -> list[str]:
+    # deduplicated, keeping the order of the request
+    return list(dict.fromkeys(value.lower() for value in values))
+
+
+def group_positions(positions: list[dict], key) -> dict[str, list[dict]]:
+    grouped = defaultdict(list)
+    for position in positions:
+        grouped[key(position["address"])].append(position)
+    return grouped
+
+
+def positions_lines(field: str, keys: list[str], grouped: dict[str, list[dict]]):
+    for key in keys:
+        items = grouped.get(key, [])
+        yield orjson.dumps({field: key, "items": items, "count": len(items)})
+        yield b"\n"
+
+
+async def staking_positions_lines(batch: StakingPositionsBatch):
+    wallets = unique_lower(batch.wallets)
+    stake_key_hashes = unique_lower(batch.stake_key_hashes)
+    pubkey_hashes = unique_lower(batch.pubkey_hashes)
+    per_wallet, per_stake_key, per_pubkey = await asyncio.gather(
+        repository.staking_positions_per_wallets(wallets),
+        repository.staking_positions_per_credentials(
+            "stake_credential", stake_key_hashes
+        ),
+        repository.staking_positions_per_credentials(
+            "payment_credential", pubkey_hashes
+        ),
+    )
+    for line in positions_lines(
+        "wallet", wallets, group_positions(per_wallet, lambda address: address)
+    ):
+        yield line
+    for line in positions_lines(
+        "stake_key_hash",
+        stake_key_hashes,
+        group_positions(
+            per_stake_key,
+            lambda address: address_credentials(bytes.fromhex(address))[1],
+        ),
+    ):
+        yield line
+    for line in positions_lines(
+        "pubkey_hash",
+        pubkey_hashes,
+        group_positions(
+            per_pubkey, lambda address: address_credentials(bytes.fromhex(address))[0]
+        ),
+    ):
+        yield line
+
+
+@app.post("/api/v1/staking/positions")
+async def staking_positions_batch(batch: StakingPositionsBatch):
+    """
+    Get all staking positions for many wallets, stake key hashes and payment key hashes at once.
+    The positions are streamed as newline-delimited JSON, one line per requested wallet and key hash.
+    """
+    return StreamingResponse(
+        staking_positions_lines(batch), media_type="application/x-ndjson"
+    )
+
+
+@app.get("/api/v1/farms/{pool_id}/history")
+async def farm_history(
+    request: Request,
+    pool_id: str = Path(pattern=HEX_RE, max_length=64),
+    start: int = Query(
+        default=0, ge=0, description="Start POSIX time in milliseconds (inclusive)"
+    ),
+    end: int = Query(
+        default=2**62, ge=0, description="End POSIX time in milliseconds (exclusive)"
+    ),
+    bucket: str = Query(
+        default="raw",
+        pattern=BUCKET_RE,
+        description="Keep only the last state per hour or day",
+    ),
+):
+    """
+    Get the history of the states of a farm: amount staked, emission rates, cumulative rewards per token
+    and the APR per reward token (reward tokens per staked token and year) at every update.
+    """
+    pool_id = pool_id.lower()
+    etag = make_etag(chain_tip.hash)
+    if etag_matches(request, etag):
+        return not_modified_response(etag, max_age=60)
+
+    async def data():
+        snapshots = await repository.farm_history(pool_id, start, end)
+        return {
+            "pool_id": pool_id,
+            "bucket": bucket,
+            "items": downsample(snapshots, None if bucket == "raw" else bucket),
+        }
+
+    body = await response_cache.get(
+        f"farm_history:{pool_id}:{start}:{end}:{bucket}", data
+    )
+    return cached_json_response(body, max_age=60, etag=etag)
+
+
+async def farm_rewards_of(pool_id: str) -> Optional[FarmRewards]:
+    farms, _ = await repository.farms_page({"pool_id": (pool_id,)})
+    return FarmRewards.from_farm(farms[0]) if farms else None
+
+
+async def farm_rewards_lines(farm: FarmRewards, pool_id: str, at: int):
+    positions = await repository.position_stakes_per_farm(pool_id)
+    add_claimable_rewards({pool_id: farm}, positions, at)
+    for position in positions:
+        position.pop("cumulative_pool_rpts_at_start")
+        position["rewards_at"] = at
+        yield orjson.dumps(position)
+        yield b"\n"
+
+
+@app.get("/api/v1/farms/{pool_id}/rewards")
+async def farm_rewards_export(
+    pool_id: str = Path(pattern=HEX_RE, max_length=64),
+    at: Optional[int] = AtQuery,
+):
+    """
+    Export the claimable rewards of all staking positions of a farm at the given time.
+    The positions are streamed as newline-delimited JSON, one line per position.
+    """
+    pool_id = pool_id.lower()
+    farm = await farm_rewards_of(pool_id)
+    if farm is None:
+        raise HTTPException(status_code=404, detail="Farm not found")
+    return StreamingResponse(
+        farm_rewards_lines(farm, pool_id, at if at is not None else posix_millis_now()),
+        media_type="application/x-ndjson",
+    )
+
+
+def stream_event(event: dict, wallets: set[str]) -> Optional[dict]:
+    """
+    The event as seen by a subscriber, with only the positions of the subscribed wallets.
+    """
+    if event["type"] != "block":
+        return event
+    return {
+        **event,
+        "positions_created": [
+            p for p in event["positions_created"] if p["address"] in wallets
+        ],
+        "positions_spent": [
+            p for p in event["positions_spent"] if p["address"] in wallets
+        ],
+    }
+
+
+async def change_stream(wallets: set[str]):
+    with change_feed.subscription() as events:
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    events.get(), timeout=STREAM_KEEPALIVE_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            if event is None:
+                # fell behind, the client reconnects and refetches the current state
+                return
+            event = stream_event(event, wallets)
+            yield b"event: %s\ndata: %s\n\n" % (
+                event["type"].encode(),
+                orjson.dumps(event),
+            )
+
+
+@app.get("/api/v1/stream")
+async def stream(wallets: str = WalletsQuery):
+    """
+    Stream the changes as server-sent events: a "block" event per new block with the updated farms
+    and the staking positions of the given wallets created and spent in it, and a "rollback" event
+    with the slot rolled back to (null for the origin).
+    """
+    return StreamingResponse(
+        change_stream(set(unique_lower(filter(None, wallets.split(","))))),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # for debugging
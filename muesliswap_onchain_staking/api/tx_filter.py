@@ -0,0 +1,46 @@
+"""
+Cheap byte-level checks on the raw CBOR of transactions,
+to avoid fully decoding the vast majority of transactions that are irrelevant to the querier.
+"""
+
+import re
+from dataclasses import dataclass
+
+from .config import farm_nft_policy_id, staking_address, batching_address
+
+# transaction ids (and other 32 byte strings) are encoded as CBOR byte strings with header 0x5820
+# matches may overlap, so that a spurious header can not hide a real one
+_BYTES32_RE = re.compile(b"\x58\x20(?=(.{32}))", re.DOTALL)
+
+
+@dataclass
+class TxPreFilter:
+    """
+    A transaction is relevant if its CBOR contains one of the needles,
+    i.e. it has an output at one of our script addresses or holds a farm NFT.
+    Transactions that spend tracked outputs are found through `input_tx_hashes`,
+    as the tracked outputs change while the chain is processed.
+    False positives only cost a full decode.
+    """
+
+    needles: tuple[bytes, ...]
+
+    def matches(self, tx_cbor: bytes) -> bool:
+        return any(needle in tx_cbor for needle in self.needles)
+
+
+def input_tx_hashes(tx_cbor: bytes) -> set[str]:
+    """
+    Return a superset of the ids of the transactions whose outputs are spent by the transaction.
+    """
+    return {m.hex() for m in _BYTES32_RE.findall(tx_cbor)}
+
+
+def default_tx_filter() -> TxPreFilter:
+    return TxPreFilter(
+        needles=(
+            staking_address.payment_part.payload,
+            farm_nft_policy_id.payload,
+            batching_address.payment_part.payload,
+        )
+    )
@@ -3,31 +3,28 @@ import pycardano
 from ..db_models import Block, TransactionOutput
 from ..util import FixedTxHashTransaction
 
+from .block_writer import BlockWriter
+from .tracked_outputs import TrackedOutputs
 from .staking import process_tx as process_staking_tx
 from .farms import process_tx as process_farms_tx
 
 
 def process_tx(
     tx: FixedTxHashTransaction,
-    block: Block,
+    writer: BlockWriter,
     block_index: int,
-    # tracked_gov_states: TrackedGovStates,
-    # tracked_treasury_states: TrackedTreasuryStates,
 ):
     """
     Process a transaction and update the database accordingly.
     """
 
-    # mark all inputs to the transaction as spent
+    # mark all tracked inputs to the transaction as spent
     spent_inputs = [
         (_input.transaction_id.payload.hex(), _input.index)
         for _, _input in enumerate(tx.transaction_body.inputs)
     ]
-    for h, i in spent_inputs:
-        TransactionOutput.update(spent_in_block=block).where(
-            (TransactionOutput.transaction_hash == h) & (TransactionOutput.output_index == i)
-        ).execute()
+    writer.spend(spent_inputs)
 
     # model specific processing
-    process_farms_tx(tx, block, block_index)
-    process_staking_tx(tx, block, block_index)
+    process_farms_tx(tx, writer, block_index)
+    process_staking_tx(tx, writer, block_index)
@@ -0,0 +1,62 @@
+"""
+Backfill of the credential columns of addresses stored before they were decomposed on insertion.
+
+    python -m muesliswap_onchain_staking.api.tx_processor.address_credentials backfill
+"""
+
+import logging
+
+import fire
+
+from ..db_models import Address, database
+from ..util import address_credentials
+
+_LOGGER = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def _undecomposed():
+    return Address.select(Address.id, Address.address_raw).where(
+        Address.payment_credential.is_null(), Address.stake_credential.is_null()
+    )
+
+
+def backfill(batch_size: int = BATCH_SIZE):
+    """
+    Decompose all addresses that have no credentials yet.
+    Addresses without any credential (e.g. Byron addresses) are checked again on every run,
+    but only addresses with a credential are written.
+    """
+    last_id = 0
+    updated = 0
+    while True:
+        batch = list(
+            _undecomposed()
+            .where(Address.id > last_id)
+            .order_by(Address.id)
+            .limit(batch_size)
+        )
+        if not batch:
+            break
+        last_id = batch[-1].id
+        decomposed = []
+        for address in batch:
+            credentials = address_credentials(bytes.fromhex(address.address_raw))
+            if credentials == (None, None):
+                continue
+            address.payment_credential, address.stake_credential = credentials
+            decomposed.append(address)
+        if not decomposed:
+            continue
+        with database.atomic():
+            Address.bulk_update(
+                decomposed,
+                fields=[Address.payment_credential, Address.stake_credential],
+            )
+        updated += len(decomposed)
+        _LOGGER.info(f"Decomposed {updated} addresses")
+
+
+if __name__ == "__main__":
+    fire.Fire({"backfill": backfill})
@@ -0,0 +1,213 @@
+from collections import defaultdict
+from typing import Dict, List, Tuple, Type, Union
+
+import peewee
+import pycardano
+
+from ..db_models import (
+    Block,
+    Datum,
+    Transaction,
+    TransactionOutput,
+    TransactionOutputValue,
+    UndoEntry,
+)
+from ..db_models.db import BaseModel, OutputStateModel
+from . import current_state, to_db
+from .tracked_outputs import OutRef, TrackedOutputs
+
+# keep the number of bound parameters per statement well below SQLite's limit
+INSERT_BATCH_SIZE = 100
+
+
+class BlockWriter:
+    """
+    Writes the rows produced while processing a single block.
+
+    In bulk mode the Transaction, TransactionOutput, TransactionOutputValue and Datum rows
+    (and the states attached to the outputs) are buffered in memory and written with
+    `insert_many` on `flush`, which is expected to run inside the same database transaction
+    as the creation of the block.
+    Otherwise every row is written immediately, one statement (and commit) at a time.
+    """
+
+    def __init__(
+        self, block: Block, tracked_outputs: TrackedOutputs, bulk: bool = True
+    ):
+        self.block = block
+        self.tracked_outputs = tracked_outputs
+        self.bulk = bulk
+        self.transactions: Dict[str, dict] = {}
+        self.outputs: Dict[OutRef, dict] = {}
+        self.output_values: List[Tuple[OutRef, int, int]] = []
+        self.datums: Dict[str, dict] = {}
+        self.states: Dict[
+            Type[OutputStateModel], List[Tuple[OutRef, dict]]
+        ] = defaultdict(list)
+        self.spent_inputs: List[OutRef] = []
+        self.undo_entries: List[dict] = []
+
+    def add_output(
+        self,
+        tx_output: pycardano.TransactionOutput,
+        index: int,
+        transaction_hash: str,
+        block_index: int,
+    ) -> Union[TransactionOutput, OutRef]:
+        """
+        Store the output, returns a reference to be passed to `add_state`.
+        """
+        out_ref = (transaction_hash, index)
+        self.tracked_outputs.add(out_ref)
+        if not self.bulk:
+            return to_db.add_output(
+                tx_output, index, transaction_hash, self.block, block_index
+            )
+        if out_ref in self.outputs:
+            return out_ref
+        if tx_output.datum is not None:
+            datum_hash, datum_data = to_db.serialize_datum(tx_output.datum)
+            if to_db.datum_cache.get(datum_hash) is None:
+                self.datums[datum_hash] = {"hash": datum_hash, "data": datum_data}
+        elif tx_output.datum_hash is not None:
+            datum_hash = tx_output.datum_hash.to_primitive().hex()
+        else:
+            datum_hash = None
+        self.transactions.setdefault(
+            transaction_hash,
+            {
+                "transaction_hash": transaction_hash,
+                "block": self.block.id,
+                "block_index": block_index,
+            },
+        )
+        self.outputs[out_ref] = {
+            "transaction_hash": transaction_hash,
+            "output_index": index,
+            "address": to_db.add_address(tx_output.address).id,
+            "datum_hash": datum_hash,
+        }
+        self.output_values.append(
+            (out_ref, to_db.add_token(b"", b"").id, tx_output.amount.coin)
+        )
+        for policy_id, d in tx_output.amount.multi_asset.items():
+            for asset_name, amount in d.items():
+                self.output_values.append(
+                    (out_ref, to_db.add_token(policy_id, asset_name).id, amount)
+                )
+        return out_ref
+
+    def add_state(
+        self,
+        model: Type[OutputStateModel],
+        output: Union[TransactionOutput, OutRef],
+        **fields,
+    ):
+        """
+        Store a state that is attached to an output returned by `add_output`.
+        """
+        if not self.bulk:
+            state = model.create(transaction_output=output, **fields)
+            current_state.add_outputs([output.id])
+            return state
+        self.states[model].append((output, fields))
+
+    def get_or_create(self, model: Type[BaseModel], **fields) -> Tuple[BaseModel, bool]:
+        """
+        Get or create a row that is shared between outputs, such as params.
+        Created rows are recorded in the undo journal of the block.
+        """
+        row, created = model.get_or_create(**fields)
+        if created:
+            entry = {
+                "block": self.block.id,
+                "table_name": model._meta.table_name,
+                "row_id": row.id,
+            }
+            if self.bulk:
+                self.undo_entries.append(entry)
+            else:
+                UndoEntry.insert(entry).execute()
+        return row, created
+
+    def spend(self, inputs: List[OutRef]):
+        """
+        Mark the given inputs as spent in this block, if they are tracked outputs.
+        """
+        spent_inputs = self.tracked_outputs.spend(inputs)
+        if not spent_inputs:
+            return
+        if not self.bulk:
+            to_db.mark_spent(spent_inputs, self.block)
+            current_state.remove_spent(self.block)
+            return
+        self.spent_inputs.extend(spent_inputs)
+
+    def flush(self):
+        """
+        Write all buffered rows to the database.
+        """
+        if not self.bulk:
+            return
+        for batch in peewee.chunked(self.undo_entries, INSERT_BATCH_SIZE):
+            UndoEntry.insert_many(batch).execute()
+        Datum.insert_many(list(self.datums.values())).on_conflict_ignore().execute()
+        for datum_hash, row in self.datums.items():
+            to_db.datum_cache.put(datum_hash, Datum(**row))
+
+        for batch in peewee.chunked(self.transactions.values(), INSERT_BATCH_SIZE):
+            Transaction.insert_many(batch).execute()
+        transaction_ids = {}
+        for batch in peewee.chunked(self.transactions.keys(), INSERT_BATCH_SIZE):
+            transaction_ids.update(
+                Transaction.select(Transaction.transaction_hash, Transaction.id)
+                .where(Transaction.transaction_hash.in_(batch))
+                .tuples()
+            )
+
+        for batch in peewee.chunked(self.outputs.values(), INSERT_BATCH_SIZE):
+            TransactionOutput.insert_many(
+                [
+                    {**row, "transaction": transaction_ids[row["transaction_hash"]]}
+                    for row in batch
+                ]
+            ).execute()
+        output_ids = {}
+        for batch in peewee.chunked(transaction_ids.values(), INSERT_BATCH_SIZE):
+            for tx_hash, output_index, output_id in (
+                TransactionOutput.select(
+                    TransactionOutput.transaction_hash,
+                    TransactionOutput.output_index,
+                    TransactionOutput.id,
+                )
+                .where(TransactionOutput.transaction.in_(batch))
+                .tuples()
+            ):
+                output_ids[(tx_hash, output_index)] = output_id
+
+        for batch in peewee.chunked(self.output_values, INSERT_BATCH_SIZE):
+            TransactionOutputValue.insert_many(
+                [
+                    {
+                        "transaction_output": output_ids[out_ref],
+                        "token": token_id,
+                        "amount": amount,
+                    }
+                    for out_ref, token_id, amount in batch
+                ]
+            ).execute()
+        for model, states in self.states.items():
+            for batch in peewee.chunked(states, INSERT_BATCH_SIZE):
+                model.insert_many(
+                    [
+                        {**fields, "transaction_output": output_ids[out_ref]}
+                        for out_ref, fields in batch
+                    ]
+                ).execute()
+
+        current_state.add_outputs(output_ids.values())
+
+        # inputs may spend outputs created earlier in this block, so mark them last
+        # and all at once
+        to_db.mark_spent(self.spent_inputs, self.block)
+        current_state.remove_spent(self.block)
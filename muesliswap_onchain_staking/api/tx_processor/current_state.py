@@ -0,0 +1,118 @@
+"""
+Maintenance of the materialized current state tables (CurrentFarm and CurrentStakingPosition).
+A row exists for exactly those farm and staking states whose output is unspent.
+
+    python -m muesliswap_onchain_staking.api.tx_processor.current_state rebuild
+"""
+
+from typing import Iterable
+
+import fire
+import peewee
+
+from ..db_models import (
+    Block,
+    CurrentFarm,
+    CurrentStakingPosition,
+    FarmParams,
+    FarmState,
+    StakingParams,
+    StakingState,
+    TransactionOutput,
+    database,
+)
+
+BATCH_SIZE = 100
+
+
+def _unspent(query: peewee.ModelSelect, output_ids: Iterable[int]):
+    for batch in peewee.chunked(output_ids, BATCH_SIZE):
+        yield query.where(
+            TransactionOutput.id.in_(batch),
+            TransactionOutput.spent_in_block.is_null(),
+        )
+
+
+def add_outputs(output_ids: Iterable[int]):
+    """
+    Add the states attached to the given outputs, if they are unspent.
+    """
+    output_ids = list(output_ids)
+    for query in _unspent(
+        FarmState.select(
+            FarmState.transaction_output,
+            FarmState.id,
+            FarmState.farm_params,
+            FarmParams.pool_id,
+        )
+        .join(FarmParams)
+        .switch(FarmState)
+        .join(TransactionOutput),
+        output_ids,
+    ):
+        CurrentFarm.insert_from(
+            query,
+            [
+                CurrentFarm.transaction_output,
+                CurrentFarm.farm_state,
+                CurrentFarm.farm_params,
+                CurrentFarm.pool_id,
+            ],
+        ).on_conflict_ignore().execute()
+    for query in _unspent(
+        StakingState.select(
+            StakingState.transaction_output,
+            StakingState.id,
+            StakingState.staking_params,
+            StakingParams.owner,
+            StakingParams.pool_id,
+        )
+        .join(StakingParams)
+        .switch(StakingState)
+        .join(TransactionOutput),
+        output_ids,
+    ):
+        CurrentStakingPosition.insert_from(
+            query,
+            [
+                CurrentStakingPosition.transaction_output,
+                CurrentStakingPosition.staking_state,
+                CurrentStakingPosition.staking_params,
+                CurrentStakingPosition.owner,
+                CurrentStakingPosition.pool_id,
+            ],
+        ).on_conflict_ignore().execute()
+
+
+def remove_spent(block: Block):
+    """
+    Remove the states attached to the outputs spent in the given block.
+    """
+    spent_outputs = TransactionOutput.select(TransactionOutput.id).where(
+        TransactionOutput.spent_in_block == block
+    )
+    CurrentFarm.delete().where(
+        CurrentFarm.transaction_output.in_(spent_outputs)
+    ).execute()
+    CurrentStakingPosition.delete().where(
+        CurrentStakingPosition.transaction_output.in_(spent_outputs)
+    ).execute()
+
+
+def rebuild():
+    """
+    Recompute the current state tables from scratch, e.g. for databases created before they existed.
+    """
+    with database.atomic():
+        CurrentFarm.delete().execute()
+        CurrentStakingPosition.delete().execute()
+        add_outputs(
+            output_id
+            for (output_id,) in TransactionOutput.select(TransactionOutput.id)
+            .where(TransactionOutput.spent_in_block.is_null())
+            .tuples()
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire({"rebuild": rebuild})
@@ -0,0 +1,110 @@
+"""
+Maintenance of the farm state time series (FarmSnapshot), written along with every farm state.
+
+    python -m muesliswap_onchain_staking.api.tx_processor.farm_history rebuild
+"""
+
+from typing import List, Tuple
+
+import fire
+import peewee
+
+from ..db_models import (
+    FarmCumulativeRewardPerToken,
+    FarmEmissionRate,
+    FarmParams,
+    FarmSnapshot,
+    FarmState,
+    database,
+)
+from ..rewards import to_posix_millis
+
+DAYS_IN_YEAR = 365
+BATCH_SIZE = 100
+
+
+def apr(emission_rate: int, amount_staked: int) -> str:
+    """
+    Reward tokens per staked token and year, empty if nothing is staked.
+    """
+    if amount_staked == 0:
+        return ""
+    return repr(emission_rate * DAYS_IN_YEAR / amount_staked)
+
+
+def snapshot_fields(
+    pool_id: str,
+    time: int,
+    amount_staked: int,
+    emission_rates: List[int],
+    cumulative_rewards_per_token: List[Tuple[int, int]],
+) -> dict:
+    """
+    The fields of the snapshot of a farm state, the time as POSIX time in milliseconds.
+    """
+    return {
+        "pool_id": pool_id,
+        "time": time,
+        "amount_staked": amount_staked,
+        "emission_rates": ";".join(str(rate) for rate in emission_rates),
+        "cumulative_rewards_per_token": ";".join(
+            f"{numerator}/{denominator}"
+            for numerator, denominator in cumulative_rewards_per_token
+        ),
+        "aprs": ";".join(apr(rate, amount_staked) for rate in emission_rates),
+    }
+
+
+def rebuild():
+    """
+    Recompute the snapshots from the stored farm states, e.g. for databases created before they existed.
+    """
+    with database.atomic():
+        FarmSnapshot.delete().execute()
+        states = (
+            FarmState.select(FarmState.transaction_output, FarmParams)
+            .join(FarmParams)
+            .order_by(FarmState.id)
+        )
+        for batch in peewee.chunked(states, BATCH_SIZE):
+            params_ids = [state.farm_params.id for state in batch]
+            emission_rates = {}
+            for row in (
+                FarmEmissionRate.select()
+                .where(FarmEmissionRate.farm_params.in_(params_ids))
+                .order_by(FarmEmissionRate.idx)
+            ):
+                emission_rates.setdefault(row.farm_params_id, []).append(
+                    row.emission_rate
+                )
+            cumulative = {}
+            for row in (
+                FarmCumulativeRewardPerToken.select()
+                .where(FarmCumulativeRewardPerToken.farm_params.in_(params_ids))
+                .order_by(FarmCumulativeRewardPerToken.idx)
+            ):
+                cumulative.setdefault(row.farm_params_id, []).append(
+                    (
+                        row.cumulative_reward_per_token_numerator,
+                        row.cumulative_reward_per_token_denominator,
+                    )
+                )
+            FarmSnapshot.insert_many(
+                [
+                    {
+                        "transaction_output": state.transaction_output_id,
+                        **snapshot_fields(
+                            state.farm_params.pool_id,
+                            to_posix_millis(state.farm_params.last_update_time),
+                            state.farm_params.amount_staked,
+                            emission_rates.get(state.farm_params.id, []),
+                            cumulative.get(state.farm_params.id, []),
+                        ),
+                    }
+                    for state in batch
+                ]
+            ).execute()
+
+
+if __name__ == "__main__":
+    fire.Fire({"rebuild": rebuild})
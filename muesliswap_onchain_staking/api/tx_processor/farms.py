@@ -1,7 +1,8 @@
 import pycardano
 
 from opshin.ledger.api_v2 import FinitePOSIXTime
-from . import from_db
+from . import farm_history, from_db
+from .block_writer import BlockWriter
 from .to_db import (
     add_output,
     add_address,
@@ -26,7 +27,7 @@ _LOGGER = logging.getLogger(__name__)
 
 def process_tx(
     tx: pycardano.Transaction,
-    block: Block,
+    writer: BlockWriter,
     block_index: int,
 ):
     """
@@ -36,11 +37,10 @@ def process_tx(
         if not output.amount.multi_asset.get(farm_nft_policy_id):
             continue
         _LOGGER.info(f"Transaction contains farm nft {tx.id.payload.hex()}")
-        farm_output = add_output(
+        farm_output = writer.add_output(
             output,
             i,
             tx.id.payload.hex(),
-            block,
             block_index,
         )
         try:
@@ -61,7 +61,8 @@ def process_tx(
                 utxo_assets[f"{str(sh)}.{str(an)}"] = amount
         utxo_assets["lovelace"] = output.amount.coin
 
-        db_farm_state_params = db_farms.FarmParams.get_or_create(
+        db_farm_state_params = writer.get_or_create(
+            db_farms.FarmParams,
             pool_id=farm_state_nft_name.payload.hex(),
             stake_token=add_token_token(onchain_farm_state_params.stake_token),
             farm_type=str(onchain_farm_state.farm_type),
@@ -69,13 +70,15 @@ def process_tx(
             amount_staked=onchain_farm_state.amount_staked,
         )[0]
         for i, reward_token in enumerate(onchain_farm_state_params.reward_tokens):
-            db_farms.FarmRewardToken.get_or_create(
+            writer.get_or_create(
+                db_farms.FarmRewardToken,
                 farm_params=db_farm_state_params,
                 token=add_token_token(reward_token),
                 idx=i,
             )
         for i, emission_rate in enumerate(onchain_farm_state.emission_rates):
-            db_farms.FarmEmissionRate.get_or_create(
+            writer.get_or_create(
+                db_farms.FarmEmissionRate,
                 farm_params=db_farm_state_params,
                 emission_rate=emission_rate,
                 idx=i,
@@ -83,13 +86,29 @@ def process_tx(
         for i, cumulative_reward_per_token in enumerate(
             onchain_farm_state.cumulative_rewards_per_token
         ):
-            db_farms.FarmCumulativeRewardPerToken.get_or_create(
+            writer.get_or_create(
+                db_farms.FarmCumulativeRewardPerToken,
                 farm_params=db_farm_state_params,
                 cumulative_reward_per_token_numerator=cumulative_reward_per_token.numerator,
                 cumulative_reward_per_token_denominator=cumulative_reward_per_token.denominator,
                 idx=i,
             )
-        _db_farm_state = db_farms.FarmState.create(
-            transaction_output=farm_output,
+        _db_farm_state = writer.add_state(
+            db_farms.FarmState,
+            farm_output,
             farm_params=db_farm_state_params,
         )
+        writer.add_state(
+            db_farms.FarmSnapshot,
+            farm_output,
+            **farm_history.snapshot_fields(
+                pool_id=farm_state_nft_name.payload.hex(),
+                time=onchain_farm_state.last_update_time,
+                amount_staked=onchain_farm_state.amount_staked,
+                emission_rates=onchain_farm_state.emission_rates,
+                cumulative_rewards_per_token=[
+                    (f.numerator, f.denominator)
+                    for f in onchain_farm_state.cumulative_rewards_per_token
+                ],
+            ),
+        )
@@ -1,5 +1,6 @@
 import pycardano
 
+from .block_writer import BlockWriter
 from .to_db import (
     add_output,
     add_address,
@@ -23,7 +24,7 @@ _LOGGER = logging.getLogger(__name__)
 
 def process_tx(
     tx: pycardano.Transaction,
-    block: Block,
+    writer: BlockWriter,
     block_index: int,
 ):
     """
@@ -32,11 +33,10 @@ def process_tx(
     for i, output in enumerate(tx.transaction_body.outputs):
         if output.address == staking_address:
             _LOGGER.info(f"Staking transaction: {tx.id.payload.hex()}")
-            staking_output = add_output(
+            staking_output = writer.add_output(
                 output,
                 i,
                 tx.id.payload.hex(),
-                block,
                 block_index,
             )
             try:
@@ -53,20 +53,23 @@ def process_tx(
                     utxo_assets[f"{str(sh)}.{str(an)}"] = amount
             utxo_assets["lovelace"] = output.amount.coin
 
-            db_staking_params = db_staking.StakingParams.get_or_create(
+            db_staking_params = writer.get_or_create(
+                db_staking.StakingParams,
                 owner = add_address(from_address(onchain_staking_state.owner)),
                 pool_id = onchain_staking_state.pool_id.hex(),
                 staked_since = to_datetime(onchain_staking_state.staked_since),
                 batching_output_index = onchain_staking_state.batching_output_index,
             )[0]
             for i, cumulative_pool_rpt in enumerate(onchain_staking_state.cumulative_pool_rpts_at_start):
-                db_staking.StakingCumulativePoolRptsAtStart.get_or_create(
+                writer.get_or_create(
+                    db_staking.StakingCumulativePoolRptsAtStart,
                     staking_params = db_staking_params,
                     cumulative_pool_rpts_at_start_numerator = cumulative_pool_rpt.numerator,
                     cumulative_pool_rpts_at_start_denominator = cumulative_pool_rpt.denominator,
                     index = i,
                 )
-            _db_staking_state = db_staking.StakingState.create(
-                transaction_output=staking_output,
+            _db_staking_state = writer.add_state(
+                db_staking.StakingState,
+                staking_output,
                 staking_params=db_staking_params,
             )
\ No newline at end of file
@@ -1,8 +1,10 @@
-from typing import Union
+from typing import List, Tuple, Union
 
 import cbor2
 import datetime
 
+import peewee
+
 import pycardano
 from opshin import prelude
 
@@ -15,13 +17,53 @@ from ..db_models import (
     Block,
     Transaction,
 )
+from ..util import address_credentials
+from .lookup_cache import LRUCache
+
+# rows that were already looked up, the same tokens and script addresses occur over and over
+token_cache: LRUCache[Token] = LRUCache(maxsize=10_000)
+address_cache: LRUCache[Address] = LRUCache(maxsize=100_000)
+datum_cache: LRUCache[Datum] = LRUCache(maxsize=10_000)
+
+
+def clear_caches(reset_stats: bool = False):
+    """
+    Clear the lookup caches.
+    Needs to be called whenever stored rows may have been removed,
+    i.e. after a rollback or when the transaction writing a block failed.
+    """
+    for cache in (token_cache, address_cache, datum_cache):
+        cache.clear(reset_stats)
+
+
+def cache_stats() -> dict:
+    """
+    Hit and miss counts of the lookup caches.
+    """
+    return {
+        "token": token_cache.stats(),
+        "address": address_cache.stats(),
+        "datum": datum_cache.stats(),
+    }
 
 
 def add_address_raw(address: bytes) -> Address:
     """
     Store the address in the database.
     """
-    return Address.get_or_create(address_raw=address.hex())[0]
+    cached = address_cache.get(address)
+    if cached is not None:
+        return cached
+    payment_credential, stake_credential = address_credentials(address)
+    db_address = Address.get_or_create(
+        address_raw=address.hex(),
+        defaults={
+            "payment_credential": payment_credential,
+            "stake_credential": stake_credential,
+        },
+    )[0]
+    address_cache.put(address, db_address)
+    return db_address
 
 
 def add_address(address: pycardano.Address) -> Address:
@@ -31,14 +73,27 @@ def add_address(address: pycardano.Address) -> Address:
     return add_address_raw(address.to_primitive())
 
 
+def serialize_datum(datum: pycardano.Datum) -> Tuple[str, bytes]:
+    """
+    Compute the hash and the CBOR encoding under which the datum is stored.
+    """
+    return (
+        pycardano.datum_hash(datum).to_primitive().hex(),
+        cbor2.dumps(datum, default=pycardano.default_encoder),
+    )
+
+
 def add_datum(datum: pycardano.Datum) -> Datum:
     """
     Store the datum in the database.
     """
-    return Datum.get_or_create(
-        hash=pycardano.datum_hash(datum).to_primitive().hex(),
-        data=cbor2.dumps(datum, default=pycardano.default_encoder),
-    )[0]
+    datum_hash, data = serialize_datum(datum)
+    cached = datum_cache.get(datum_hash)
+    if cached is not None:
+        return cached
+    db_datum = Datum.get_or_create(hash=datum_hash, data=data)[0]
+    datum_cache.put(datum_hash, db_datum)
+    return db_datum
 
 
 def add_token_token(token: prelude.Token) -> Token:
@@ -59,10 +114,15 @@ def add_token(
         policy_id = policy_id.payload
     if isinstance(asset_name, pycardano.AssetName):
         asset_name = asset_name.payload
-    return Token.get_or_create(
+    cached = token_cache.get((policy_id, asset_name))
+    if cached is not None:
+        return cached
+    token = Token.get_or_create(
         policy_id=policy_id.hex(),
         asset_name=asset_name.hex(),
     )[0]
+    token_cache.put((policy_id, asset_name), token)
+    return token
 
 
 def add_transaction(
@@ -120,8 +180,33 @@ def add_output(
     return output
 
 
+def mark_spent_query(
+    spent_inputs: List[Tuple[str, int]], block: Union[Block, int]
+) -> peewee.ModelUpdate:
+    """
+    Update marking the outputs referenced by the given (transaction hash, output index) pairs as spent.
+    """
+    return TransactionOutput.update(spent_in_block=block).where(
+        # SQLite only uses the index for the row values with a condition on its first column
+        TransactionOutput.transaction_hash.in_(list({h for h, _ in spent_inputs})),
+        peewee.Tuple(
+            TransactionOutput.transaction_hash, TransactionOutput.output_index
+        ).in_(spent_inputs),
+    )
+
+
+def mark_spent(spent_inputs: List[Tuple[str, int]], block: Block):
+    """
+    Mark the outputs referenced by the given (transaction hash, output index) pairs as spent.
+    """
+    for batch in peewee.chunked(spent_inputs, 100):
+        mark_spent_query(batch, block).execute()
+
+
 def to_datetime(timestamp: int) -> datetime.datetime:
     """
-    Convert a timestamp to a datetime object.
+    Convert a POSIX timestamp in milliseconds to a naive datetime in UTC, as stored in the database.
     """
-    return datetime.datetime.fromtimestamp(timestamp / 1000)
\ No newline at end of file
+    return datetime.datetime.fromtimestamp(
+        timestamp / 1000, tz=datetime.timezone.utc
+    ).replace(tzinfo=None)
\ No newline at end of file
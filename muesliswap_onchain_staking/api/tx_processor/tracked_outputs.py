@@ -0,0 +1,60 @@
+from collections import Counter
+from typing import Iterable, List, Set, Tuple
+
+from ..db_models import TransactionOutput
+
+OutRef = Tuple[str, int]
+
+
+class TrackedOutputs:
+    """
+    In-memory set of the unspent outputs stored in the database.
+    Almost no input on chain spends one of them, so this avoids querying the database for every input.
+    """
+
+    def __init__(self):
+        self.out_refs: Set[OutRef] = set()
+        # number of tracked outputs per transaction hash
+        self.tx_hashes: Counter[str] = Counter()
+
+    def load(self):
+        """
+        (Re-)load the unspent outputs from the database, e.g. at startup or after a rollback.
+        """
+        self.out_refs = set(
+            TransactionOutput.select(
+                TransactionOutput.transaction_hash, TransactionOutput.output_index
+            )
+            .where(TransactionOutput.spent_in_block.is_null())
+            .tuples()
+        )
+        self.tx_hashes = Counter(h for h, _ in self.out_refs)
+
+    def add(self, out_ref: OutRef):
+        if out_ref not in self.out_refs:
+            self.out_refs.add(out_ref)
+            self.tx_hashes[out_ref[0]] += 1
+
+    def spend(self, inputs: Iterable[OutRef]) -> List[OutRef]:
+        """
+        Remove the given inputs from the set and return those that were tracked.
+        """
+        spent = [i for i in set(inputs) if i in self.out_refs]
+        for out_ref in spent:
+            self.out_refs.remove(out_ref)
+            self.tx_hashes[out_ref[0]] -= 1
+            if not self.tx_hashes[out_ref[0]]:
+                del self.tx_hashes[out_ref[0]]
+        return spent
+
+    def spends_any(self, tx_hashes: Iterable[str]) -> bool:
+        """
+        Whether any of the given transactions has a tracked output.
+        """
+        return any(h in self.tx_hashes for h in tx_hashes)
+
+    def __contains__(self, out_ref: OutRef) -> bool:
+        return out_ref in self.out_refs
+
+    def __len__(self) -> int:
+        return len(self.out_refs)
@@ -1,4 +1,5 @@
 import dataclasses
+from typing import Optional, Tuple
 
 import pycardano
 
@@ -32,3 +33,32 @@ class FixedTxHashTransaction:
     @property
     def auxiliary_data(self):
         return self.transaction.auxiliary_data
+
+
+@dataclasses.dataclass
+class UndecodedTransaction:
+    """
+    Transaction that was not decoded because it did not pass the pre-filter.
+    It is only relevant if it spends one of the tracked outputs.
+    """
+
+    hash: str
+    cbor: str
+    input_tx_hashes: set[str]
+
+
+def address_credentials(address: bytes) -> Tuple[Optional[str], Optional[str]]:
+    """
+    The hex encoded payment and staking credential hashes of a Shelley address (CIP-19), if present.
+    Pointer addresses reference their staking credential by a chain pointer, Byron addresses have neither.
+    """
+    if not address:
+        return None, None
+    address_type = address[0] >> 4
+    if address_type <= 3 and len(address) == 57:
+        return address[1:29].hex(), address[29:57].hex()
+    if address_type <= 7:
+        return address[1:29].hex(), None
+    if address_type in (14, 15):
+        return None, address[1:29].hex()
+    return None, None
@@ -17,7 +17,11 @@ from muesliswap_onchain_staking.utils.contracts import get_contract, module_name
 
 
 def build_compressed(
-    type: str, script: Union[Path, str], cli_options=("--cf",), args=()
+    type: str,
+    script: Union[Path, str],
+    cli_options=("--cf",),
+    args=(),
+    recursion_limit: int = 3000,
 ):
     script = Path(script)
     command = [
@@ -30,7 +34,7 @@ def build_compressed(
         script,
         *args,
         "--recursion-limit",
-        "3000",
+        str(recursion_limit),
     ]
     subprocess.run(command)
 
@@ -87,6 +91,8 @@ def main():
             ).hex(),
         ],
         cli_options=("-fconstant-folding", "-fallow-isinstance-anything", "-fforce-three-params"),
+        # the loops over the batched orders nest deeper than the other contracts
+        recursion_limit=20000,
     )
     _, _, staking_address = get_contract(module_name(staking), compressed=True)
 
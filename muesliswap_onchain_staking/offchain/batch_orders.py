@@ -0,0 +1,401 @@
+import fire
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+
+from muesliswap_onchain_staking.onchain import batching, staking, farm_nft
+from muesliswap_onchain_staking.onchain.util import floor_scale_fraction
+from muesliswap_onchain_staking.utils.network import show_tx, context
+from muesliswap_onchain_staking.utils import get_signing_info, network, from_address
+from muesliswap_onchain_staking.utils.contracts import get_contract, module_name
+from muesliswap_onchain_staking.offchain.util import (
+    with_min_lovelace,
+    sorted_utxos,
+    amount_of_token_in_value,
+    adjust_to_min_fee,
+    asset_from_script_hash,
+    asset_from_token,
+    build_largest_batch,
+)
+from muesliswap_onchain_staking.onchain.util import STAKE_NFT_NAME
+from pycardano import (
+    TransactionBuilder,
+    AuxiliaryData,
+    AlonzoMetadata,
+    Metadata,
+    TransactionOutput,
+    Redeemer,
+    Value,
+    UTxO,
+    Transaction,
+    AssetName,
+    DeserializeException,
+    ChainContext,
+)
+
+# upper bound of orders per transaction, batches are shrunk further to fit the protocol limits
+MAX_ORDERS_PER_TX = 30
+
+
+@dataclass
+class PendingOrder:
+    utxo: UTxO
+    order: Union[batching.StakeOrder, batching.UnstakeOrder]
+    pool_id: bytes
+    # the staking position spent by an unstake order
+    position: Optional[UTxO] = None
+
+    @property
+    def is_stake(self) -> bool:
+        return isinstance(self.order, batching.StakeOrder)
+
+
+def _out_ref(u: UTxO) -> tuple:
+    return u.input.transaction_id.payload, u.input.index
+
+
+def pending_orders(
+    batching_utxos: List[UTxO], staking_utxos: List[UTxO]
+) -> List[PendingOrder]:
+    """
+    The stake and unstake orders among the order UTxOs, in the order in which they are spent by a transaction.
+    Unstake orders are skipped unless their staking position is among the staking UTxOs
+    and not already claimed by an earlier order.
+    """
+    positions = {_out_ref(u): u for u in staking_utxos}
+    claimed = set()
+    orders = []
+    for u in sorted_utxos(batching_utxos):
+        if u.output.datum is None:
+            continue
+        try:
+            order = batching.StakeOrder.from_cbor(u.output.datum.cbor)
+            orders.append(PendingOrder(u, order, order.pool_id))
+            continue
+        except DeserializeException:
+            pass
+        try:
+            order = batching.UnstakeOrder.from_cbor(u.output.datum.cbor)
+        except DeserializeException:
+            continue
+        ref = (order.staking_position.id.tx_id, order.staking_position.idx)
+        position = positions.get(ref)
+        if position is None or ref in claimed:
+            continue
+        try:
+            position_datum = staking.StakingPosition.from_cbor(
+                position.output.datum.cbor
+            )
+        except DeserializeException:
+            continue
+        claimed.add(ref)
+        orders.append(PendingOrder(u, order, position_datum.pool_id, position))
+    return orders
+
+
+def find_farms(staking_utxos: List[UTxO], farm_nft_policy_id) -> Dict[bytes, UTxO]:
+    """
+    The farm UTxOs by pool ID, i.e. the UTxOs with a farm state holding the farm NFT of its pool.
+    """
+    farms = {}
+    for u in staking_utxos:
+        if u.output.datum is None:
+            continue
+        try:
+            pool_id = staking.FarmState.from_cbor(u.output.datum.cbor).params.pool_id
+        except DeserializeException:
+            continue
+        farm_nfts = u.output.amount.multi_asset.get(farm_nft_policy_id, {})
+        if farm_nfts.get(AssetName(pool_id), 0) == 1:
+            farms[pool_id] = u
+    return farms
+
+
+def find_farm(
+    staking_utxos: List[UTxO], farm_nft_policy_id, pool_id: bytes
+) -> Optional[UTxO]:
+    """
+    The farm UTxO holding the farm NFT of the pool, if any.
+    """
+    return find_farms(staking_utxos, farm_nft_policy_id).get(pool_id)
+
+
+def build_order_batch(
+    orders: List[PendingOrder],
+    farm_input: UTxO,
+    payment_utxos: List[UTxO],
+    payment_skey,
+    payment_address,
+    current_time: int,
+    chain_context: Optional[ChainContext] = None,
+) -> Transaction:
+    """
+    Build and sign a transaction applying the stake and unstake orders to the farm.
+    Output 0 is the updated farm, followed by one output per order in the order of the order inputs:
+    a new staking position for a stake order, the payment of the position and its rewards to the
+    owner for an unstake order. The rewards are paid from the payment UTxOs.
+    """
+    chain_context = chain_context or context
+    batching_script, _, _ = get_contract(module_name(batching), compressed=True)
+    staking_script, staking_policy_id, staking_address = get_contract(
+        module_name(staking), compressed=True
+    )
+    prev_farm_datum = staking.FarmState.from_cbor(farm_input.output.datum.cbor)
+
+    position_utxos = [o.position for o in orders if not o.is_stake]
+    tx_inputs = sorted_utxos(
+        [o.utxo for o in orders] + position_utxos + [farm_input] + payment_utxos
+    )
+    orders = sorted(orders, key=lambda o: tx_inputs.index(o.utxo))
+    order_input_indices = [tx_inputs.index(o.utxo) for o in orders]
+    # the staking position inputs are aligned with the order inputs, stake orders have none
+    staking_position_input_indices = [
+        -1 if o.is_stake else tx_inputs.index(o.position) for o in orders
+    ]
+    farm_input_index = tx_inputs.index(farm_input)
+    order_output_indices = [i + 1 for i in range(len(orders))]
+    staking_position_output_indices = [
+        output_index
+        for o, output_index in zip(orders, order_output_indices)
+        if o.is_stake
+    ]
+    amounts = [
+        amount_of_token_in_value(
+            prev_farm_datum.params.stake_token,
+            (o.utxo if o.is_stake else o.position).output.amount,
+        )
+        for o in orders
+    ]
+    amount_staked = prev_farm_datum.amount_staked + sum(
+        amount if o.is_stake else -amount for o, amount in zip(orders, amounts)
+    )
+
+    # construct redeemers
+    batching_apply_redeemers = [
+        Redeemer(
+            batching.ApplyOrder(
+                farm_input_index=farm_input_index,
+                staking_position_output_index=output_index,
+            )
+        )
+        for output_index in order_output_indices
+    ]
+    farm_apply_redeemer = Redeemer(
+        staking.ApplyOrders(
+            farm_input_index=farm_input_index,
+            farm_output_index=0,
+            order_input_indices=order_input_indices,
+            staking_position_input_indices=staking_position_input_indices,
+            order_output_indices=order_output_indices,
+            current_time=current_time,
+        )
+    )
+    staking_unstake_redeemers = [
+        Redeemer(
+            staking.UnstakePosition(
+                farm_input_index=farm_input_index,
+                staking_position_input_index=position_input_index,
+                unstaking_order_input_index=order_input_index,
+                payment_output_index=output_index,
+            )
+        )
+        for o, order_input_index, position_input_index, output_index in zip(
+            orders,
+            order_input_indices,
+            staking_position_input_indices,
+            order_output_indices,
+        )
+        if not o.is_stake
+    ]
+    mint_apply_redeemer = Redeemer(
+        staking.MintApplyOrder(
+            farm_input_index=farm_input_index,
+            staking_position_output_indices=staking_position_output_indices,
+        )
+    )
+
+    # construct output datums
+    new_cumulative_pool_rpts = staking.compute_updated_cumulative_rewards_per_token(
+        prev_cum_rpts=prev_farm_datum.cumulative_rewards_per_token,
+        emission_rates=prev_farm_datum.emission_rates,
+        amount_staked=prev_farm_datum.amount_staked,
+        last_update_time=prev_farm_datum.last_update_time,
+        current_time=current_time,
+    )
+    farm_datum = staking.FarmState(
+        params=prev_farm_datum.params,
+        farm_type=prev_farm_datum.farm_type,
+        emission_rates=prev_farm_datum.emission_rates,
+        last_update_time=current_time,
+        amount_staked=amount_staked,
+        cumulative_rewards_per_token=new_cumulative_pool_rpts,
+    )
+
+    # construct outputs
+    farm_output = TransactionOutput(
+        address=staking_address,
+        amount=farm_input.output.amount,
+        datum=farm_datum,
+    )
+    order_outputs = []
+    for o, amount, output_index in zip(orders, amounts, order_output_indices):
+        if o.is_stake:
+            order_outputs.append(
+                with_min_lovelace(
+                    TransactionOutput(
+                        address=staking_address,
+                        amount=o.utxo.output.amount
+                        + Value(
+                            multi_asset=asset_from_script_hash(
+                                staking_policy_id, STAKE_NFT_NAME, 1
+                            )
+                        ),
+                        datum=staking.StakingPosition(
+                            owner=o.order.owner,
+                            pool_id=o.order.pool_id,
+                            staked_since=current_time,
+                            batching_output_index=output_index,
+                            cumulative_pool_rpts_at_start=new_cumulative_pool_rpts,
+                        ),
+                    ),
+                    chain_context,
+                )
+            )
+            continue
+        position_datum = staking.StakingPosition.from_cbor(o.position.output.datum.cbor)
+        reward_amounts = [
+            floor_scale_fraction(new_crpt, amount)
+            - floor_scale_fraction(start_crpt, amount)
+            for new_crpt, start_crpt in zip(
+                new_cumulative_pool_rpts,
+                position_datum.cumulative_pool_rpts_at_start,
+            )
+        ]
+        reward_value = sum(
+            [
+                Value(multi_asset=asset_from_token(tk, am))
+                for tk, am in zip(prev_farm_datum.params.reward_tokens, reward_amounts)
+                if am > 0
+            ],
+            Value(),
+        )
+        order_outputs.append(
+            TransactionOutput(
+                address=from_address(o.order.owner),
+                amount=o.position.output.amount + reward_value,
+            )
+        )
+
+    # build the transaction
+    builder = TransactionBuilder(chain_context)
+    builder.auxiliary_data = AuxiliaryData(
+        data=AlonzoMetadata(metadata=Metadata({674: {"msg": ["Batch Apply Orders"]}}))
+    )
+    # - add outputs
+    builder.add_output(with_min_lovelace(farm_output, chain_context))
+    for o in order_outputs:
+        builder.add_output(o)
+    builder.validity_start = chain_context.last_block_slot - 50
+    builder.ttl = chain_context.last_block_slot + 100
+    if staking_position_output_indices:
+        builder.mint = asset_from_script_hash(
+            staking_policy_id, STAKE_NFT_NAME, len(staking_position_output_indices)
+        )
+    # - add inputs
+    for u in payment_utxos:
+        builder.add_input(u)
+    # - add script inputs
+    builder.add_script_input(
+        farm_input,
+        staking_script,
+        None,
+        farm_apply_redeemer,
+    )
+    for u, r in zip(position_utxos, staking_unstake_redeemers):
+        builder.add_script_input(
+            u,
+            staking_script,
+            None,
+            r,
+        )
+    for o, r in zip(orders, batching_apply_redeemers):
+        builder.add_script_input(
+            o.utxo,
+            batching_script,
+            None,
+            r,
+        )
+    if staking_position_output_indices:
+        builder.add_minting_script(staking_script, mint_apply_redeemer)
+
+    # sign the transaction
+    signed_tx = builder.build_and_sign(
+        signing_keys=[payment_skey],
+        change_address=payment_address,
+    )
+    # pycardano adds the change output last, it pays for the difference
+    return adjust_to_min_fee(signed_tx, [payment_skey], chain_context)
+
+
+def main(
+    wallet: str = "batcher",
+    pool_id: Optional[str] = None,
+    max_orders: int = MAX_ORDERS_PER_TX,
+    stakes: bool = True,
+    unstakes: bool = True,
+):
+    """
+    Apply up to max_orders pending stake and unstake orders of a farm in one transaction, as many as
+    fit the protocol limits. Without a pool ID (hex), the farm with the most pending orders is batched.
+    """
+    _, _, batching_address = get_contract(module_name(batching), compressed=True)
+    _, _, staking_address = get_contract(module_name(staking), compressed=True)
+    _, farm_nft_policy_id, _ = get_contract(module_name(farm_nft), compressed=True)
+
+    _, payment_skey, payment_address = get_signing_info(wallet, network=network)
+    payment_utxos = context.utxos(payment_address)
+
+    staking_utxos = context.utxos(staking_address)
+    orders = [
+        o
+        for o in pending_orders(context.utxos(batching_address), staking_utxos)
+        if (stakes if o.is_stake else unstakes)
+    ]
+    if pool_id is not None:
+        pool = bytes.fromhex(pool_id)
+    elif orders:
+        pool = Counter(o.pool_id for o in orders).most_common(1)[0][0]
+    else:
+        pool = None
+    orders = [o for o in orders if o.pool_id == pool]
+    if not orders:
+        print("No pending orders.")
+        return
+
+    farm_input = find_farm(staking_utxos, farm_nft_policy_id, pool)
+    if farm_input is None:
+        raise ValueError(f"No farm UTxO found for pool {pool.hex()}.")
+
+    current_time = int(datetime.now().timestamp() * 1000)
+    signed_tx = build_largest_batch(
+        lambda count: build_order_batch(
+            orders[:count],
+            farm_input,
+            payment_utxos,
+            payment_skey,
+            payment_address,
+            current_time,
+        ),
+        min(max_orders, len(orders)),
+        context,
+    )
+
+    # submit the transaction
+    context.submit_tx(signed_tx)
+
+    show_tx(signed_tx)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,428 @@
+"""
+Resident batcher applying the pending orders of all farms as soon as they are confirmed.
+
+Instead of fetching all UTxOs of the batching and staking addresses for every batch, it keeps an
+`OrderBook` index, which is loaded once and then updated from the blocks of the ogmios chain sync.
+After every block, the farms with the most pending orders are batched concurrently by the
+workers, one farm per worker. Each worker pays the fees and rewards from its own wallet,
+so that the batches of different farms never compete for the same inputs. A worker skips the
+unstake orders of farms whose reward tokens its wallet does not hold, the wallets are checked
+for that whenever the index is loaded.
+
+Batches are chained: each one spends the farm output of the previous, still unconfirmed batch of
+the worker, so that several batches of a farm can make it into one block. The unconfirmed outputs
+are tracked by a `ChainedContext` per worker. A batch is forgotten once a block contains it.
+If the farm input of the oldest unconfirmed batch is spent by another transaction, the batch
+expires or the node rejects a batch, all chained batches of the worker are dropped, as none of
+them can be confirmed anymore. The same happens to all chains on a rollback behind the last
+applied block, but not on the rollback to the intersection that follows every (re)connect.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+import fire
+from opshin.prelude import Token
+from pycardano import ChainContext, Transaction, UTxO, Value
+
+from muesliswap_onchain_staking.api import ogmios_iterator
+from muesliswap_onchain_staking.api.config import SECURITY_PARAMETER
+from muesliswap_onchain_staking.api.tx_filter import TxPreFilter, default_tx_filter
+from muesliswap_onchain_staking.api.util import UndecodedTransaction
+from muesliswap_onchain_staking.onchain import batching, staking, farm_nft
+from muesliswap_onchain_staking.utils.network import context, ogmios_url
+from muesliswap_onchain_staking.utils import get_signing_info, network
+from muesliswap_onchain_staking.utils.contracts import get_contract, module_name
+from muesliswap_onchain_staking.offchain.batch_orders import (
+    MAX_ORDERS_PER_TX,
+    build_order_batch,
+)
+from muesliswap_onchain_staking.offchain.chaining import ChainedContext, tx_output_utxo
+from muesliswap_onchain_staking.offchain.order_book import OrderBook, OutRef, out_ref
+from muesliswap_onchain_staking.offchain.util import (
+    amount_of_token_in_value,
+    build_largest_batch,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# upper bound of unconfirmed batches chained on each other
+MAX_CHAINED_BATCHES = 5
+
+
+@dataclass
+class SubmittedBatch:
+    pool_id: bytes
+    tx: Transaction
+    # the farm UTxO spent by the batch
+    farm: OutRef
+    # the orders applied by the batch
+    orders: Set[OutRef]
+
+    @property
+    def ttl(self) -> int:
+        return self.tx.transaction_body.ttl
+
+    @property
+    def farm_output(self) -> UTxO:
+        return tx_output_utxo(self.tx, 0)
+
+
+def _token_names(tokens: List[Token]) -> str:
+    return ", ".join(f"{t.policy_id.hex()}.{t.token_name.hex()}" for t in tokens)
+
+
+class BatchWorker:
+    """
+    Chains the batches of one farm at a time, paying from the wallet of the worker.
+    """
+
+    def __init__(
+        self,
+        wallet: str,
+        base_context: ChainContext,
+        max_orders: int = MAX_ORDERS_PER_TX,
+        max_chained: int = MAX_CHAINED_BATCHES,
+    ):
+        self.wallet = wallet
+        _, self.payment_skey, self.payment_address = get_signing_info(
+            wallet, network=network
+        )
+        self.max_orders = max_orders
+        self.max_chained = max_chained
+        self.context = ChainedContext(base_context, ogmios_url)
+        # unconfirmed batches, each spending the farm output of the previous one
+        self.submitted: List[SubmittedBatch] = []
+
+    @property
+    def pool_id(self) -> Optional[bytes]:
+        """
+        The farm of the unconfirmed batches, if any.
+        """
+        return self.submitted[0].pool_id if self.submitted else None
+
+    def missing_reward_tokens(
+        self, farm: UTxO, payment_utxos: List[UTxO]
+    ) -> List[Token]:
+        """
+        The reward tokens of the farm that the wallet does not hold, so it can not pay out unstake orders.
+        """
+        held = sum([u.output.amount for u in payment_utxos], Value())
+        reward_tokens = staking.FarmState.from_cbor(
+            farm.output.datum.cbor
+        ).params.reward_tokens
+        return [t for t in reward_tokens if amount_of_token_in_value(t, held) == 0]
+
+    def check_wallet(self, book: OrderBook):
+        """
+        Log the farms whose orders the wallet can not batch with its current holdings.
+        """
+        payment_utxos = self.context.utxos(self.payment_address)
+        if not payment_utxos:
+            _LOGGER.error(
+                f"Wallet {self.wallet} at {self.payment_address} is empty, it can not pay for any batch"
+            )
+            return
+        for pool_id in book.farms:
+            missing = self.missing_reward_tokens(book.farm(pool_id), payment_utxos)
+            if missing:
+                _LOGGER.error(
+                    f"Wallet {self.wallet} holds none of the reward tokens {_token_names(missing)} "
+                    f"of pool {pool_id.hex()}, it will skip the unstake orders of the pool"
+                )
+
+    def reconcile(self, slot: int, tx_ids: Set[bytes], spent: Set[OutRef]):
+        """
+        Forget the batches confirmed by the latest block, given the ids of its transactions
+        and the UTxOs of the index it spent, and drop the batches that can not be confirmed anymore.
+        """
+        while self.submitted and self.submitted[0].tx.id.payload in tx_ids:
+            batch = self.submitted.pop(0)
+            self.context.forget(batch.tx)
+            _LOGGER.info(f"Batch {batch.tx.id} of pool {batch.pool_id.hex()} confirmed")
+        if not self.submitted:
+            return
+        oldest = self.submitted[0]
+        if oldest.farm in spent:
+            _LOGGER.warning(
+                f"Farm input of batch {oldest.tx.id} spent by another transaction"
+            )
+        elif slot > oldest.ttl:
+            _LOGGER.warning(f"Batch {oldest.tx.id} expired unconfirmed")
+        else:
+            return
+        self.drop_chain()
+
+    def drop_chain(self):
+        """
+        Forget all unconfirmed batches, the next batch spends the farm output in the index again.
+        """
+        if not self.submitted:
+            return
+        _LOGGER.warning(
+            f"Dropping {len(self.submitted)} unconfirmed batches of {self.wallet}"
+        )
+        for batch in self.submitted:
+            self.context.forget(batch.tx)
+        self.submitted = []
+
+    def batch(self, book: OrderBook, pools: Sequence[bytes]) -> List[Transaction]:
+        """
+        Submit batches for the first of the pools that can be batched, each chained on the previous
+        one, until no orders are left or `max_chained` batches are unconfirmed.
+        """
+        submitted = []
+        for pool_id in pools:
+            while len(self.submitted) < self.max_chained:
+                signed_tx = self._submit_batch(book, pool_id)
+                if signed_tx is None:
+                    break
+                submitted.append(signed_tx)
+            if self.submitted:
+                break
+        return submitted
+
+    def _submit_batch(self, book: OrderBook, pool_id: bytes) -> Optional[Transaction]:
+        """
+        Submit a batch of the orders of the pool that are not applied by an unconfirmed batch,
+        spending the farm output of the latest unconfirmed batch if any.
+        """
+        applied = set().union(*(batch.orders for batch in self.submitted))
+        orders = [
+            o for o in book.pending_orders(pool_id) if out_ref(o.utxo) not in applied
+        ]
+        if not orders:
+            return None
+        if self.submitted:
+            farm_input = self.submitted[-1].farm_output
+        else:
+            farm_input = book.farm(pool_id)
+        last_update_time = staking.FarmState.from_cbor(
+            farm_input.output.datum.cbor
+        ).last_update_time
+        # the update times of chained batches must be strictly increasing
+        current_time = max(int(datetime.now().timestamp() * 1000), last_update_time + 1)
+        try:
+            payment_utxos = self.context.utxos(self.payment_address)
+            missing = self.missing_reward_tokens(farm_input, payment_utxos)
+            if missing and not all(o.is_stake for o in orders):
+                _LOGGER.error(
+                    f"Wallet {self.wallet} holds none of the reward tokens {_token_names(missing)} "
+                    f"of pool {pool_id.hex()}, skipping its unstake orders"
+                )
+                orders = [o for o in orders if o.is_stake]
+                if not orders:
+                    return None
+            signed_tx = build_largest_batch(
+                lambda count: build_order_batch(
+                    orders[:count],
+                    farm_input,
+                    payment_utxos,
+                    self.payment_skey,
+                    self.payment_address,
+                    current_time,
+                    self.context,
+                ),
+                min(self.max_orders, len(orders)),
+                self.context,
+            )
+        except Exception:
+            # e.g. an order that can not be applied or a wallet that can not pay for the batch,
+            # the other farms are still batched
+            _LOGGER.exception(
+                f"Could not batch the orders of pool {pool_id.hex()} with wallet {self.wallet}"
+            )
+            return None
+        try:
+            self.context.submit_tx(signed_tx)
+        except Exception as e:
+            # the node may have dropped an unconfirmed batch this one is chained on,
+            # so none of the chained batches can be trusted anymore
+            _LOGGER.warning(
+                f"Batch {signed_tx.id} of pool {pool_id.hex()} rejected: {e}"
+            )
+            self.drop_chain()
+            return None
+        inputs = {
+            (i.transaction_id.payload, i.index)
+            for i in signed_tx.transaction_body.inputs
+        }
+        batch = SubmittedBatch(
+            pool_id,
+            signed_tx,
+            out_ref(farm_input),
+            {out_ref(o.utxo) for o in orders} & inputs,
+        )
+        self.submitted.append(batch)
+        _LOGGER.info(
+            f"Submitted batch {signed_tx.id} of pool {pool_id.hex()} by {self.wallet} "
+            f"with {len(batch.orders)} of {len(orders)} pending orders, "
+            f"{len(self.submitted)} unconfirmed"
+        )
+        return signed_tx
+
+
+class Batcher:
+    def __init__(
+        self,
+        wallets: Sequence[str] = ("batcher",),
+        max_orders: int = MAX_ORDERS_PER_TX,
+        tx_filter: Optional[TxPreFilter] = None,
+        max_chained: int = MAX_CHAINED_BATCHES,
+    ):
+        _, _, self.batching_address = get_contract(
+            module_name(batching), compressed=True
+        )
+        _, _, self.staking_address = get_contract(module_name(staking), compressed=True)
+        _, farm_nft_policy_id, _ = get_contract(module_name(farm_nft), compressed=True)
+        self.tx_filter = tx_filter
+        self.book = OrderBook(
+            farm_nft_policy_id,
+            self.batching_address,
+            self.staking_address,
+            journal_size=SECURITY_PARAMETER,
+        )
+        self.workers = [
+            BatchWorker(wallet, context, max_orders, max_chained) for wallet in wallets
+        ]
+        self._executor = ThreadPoolExecutor(len(self.workers))
+        # the last block applied to the index, to resume the chain sync from
+        self.point: Optional[ogmios_iterator.Point] = None
+
+    def load(self):
+        """
+        (Re-)load the index from the current UTxOs and resume the chain sync at the current tip.
+        """
+        tip = ogmios_iterator.query_tip(ogmios_url)
+        slot = tip.slot if isinstance(tip, ogmios_iterator.Point) else 0
+        # fetched after the tip, so that the blocks following the tip can be applied again
+        utxos = context.utxos(self.batching_address) + context.utxos(
+            self.staking_address
+        )
+        self.book.load(utxos, slot)
+        self.point = tip if isinstance(tip, ogmios_iterator.Point) else None
+        _LOGGER.info(
+            f"Loaded {len(self.book.farms)} farms, {len(self.book.positions)} staking positions "
+            f"and {sum(len(o) for o in self.book.orders.values())} orders at slot {slot}"
+        )
+        for worker in self.workers:
+            worker.check_wallet(self.book)
+
+    def start_points(self) -> List[ogmios_iterator.Point]:
+        return [self.point] if self.point is not None else []
+
+    def _block_txs(
+        self, block: dict, tx_ids: Set[bytes]
+    ) -> Iterator[Tuple[bytes, Transaction]]:
+        # decoded lazily, so that outputs created earlier in the block are already indexed
+        for tx in ogmios_iterator.txs_from_block(block, self.tx_filter):
+            if isinstance(tx, UndecodedTransaction):
+                if not self.book.spends_any(tx.input_tx_hashes):
+                    continue
+                tx = ogmios_iterator.decode_tx(tx.hash, tx.cbor)
+                if tx is None:
+                    continue
+            tx_ids.add(tx.id.payload)
+            yield tx.id.payload, tx.transaction
+
+    def handle_operation(self, operation: ogmios_iterator.NextBlockResult):
+        """
+        Apply a rollback or a new block to the index, then batch if possible.
+        """
+        if isinstance(operation, ogmios_iterator.Rollback):
+            if isinstance(operation.tip, ogmios_iterator.Origin):
+                slot, point = None, None
+            else:
+                slot, point = operation.tip.slot, operation.tip
+            # ogmios answers every intersection with a rollback to it, which undoes nothing
+            behind_tip = self.point is not None and (
+                slot is None or slot < self.point.slot
+            )
+            if self.book.roll_back(slot):
+                self.point = point
+            else:
+                _LOGGER.info(f"Rollback to slot {slot} beyond the journal, reloading")
+                self.load()
+            if behind_tip:
+                # the rolled back blocks may have confirmed batches that the chains build on
+                for worker in self.workers:
+                    worker.drop_chain()
+            return
+        tip = ogmios_iterator.tip_from_block(operation.block)
+        tx_ids = set()
+        changes = self.book.roll_forward(
+            tip.slot, self._block_txs(operation.block, tx_ids)
+        )
+        self.point = ogmios_iterator.Point(slot=tip.slot, id=tip.id)
+        spent = {out_ref(u) for u in changes.removed}
+        for worker in self.workers:
+            worker.reconcile(tip.slot, tx_ids, spent)
+        self.batch()
+
+    def batch(self) -> List[Transaction]:
+        """
+        Let all workers submit their batches concurrently. Workers with unconfirmed batches continue
+        their farm, the other farms are dealt out to the idle workers by their number of pending
+        orders. Each farm goes to at most one worker, which tries its farms in turn until one can
+        be batched.
+        """
+        busy = {w.pool_id for w in self.workers if w.pool_id is not None}
+        idle = [w for w in self.workers if w.pool_id is None]
+        pools = [p for p in self.book.pools_by_pending_orders() if p not in busy]
+        assignments = [(w, [w.pool_id]) for w in self.workers if w.pool_id is not None]
+        assignments += [
+            (w, pools[i :: len(idle)])
+            for i, w in enumerate(idle)
+            if pools[i :: len(idle)]
+        ]
+        results = self._executor.map(
+            lambda assignment: assignment[0].batch(self.book, assignment[1]),
+            assignments,
+        )
+        return [tx for txs in results for tx in txs]
+
+    async def run(self, in_flight: int = 100):
+        """
+        Follow the chain with the asyncio ogmios client, which reconnects on connection loss.
+        """
+        await asyncio.to_thread(self.load)
+        iterator = ogmios_iterator.AsyncOgmiosIterator(
+            ogmios_url, self.start_points, in_flight=in_flight
+        )
+        async for operation in iterator.iterate_blocks():
+            await asyncio.to_thread(self.handle_operation, operation)
+
+
+def main(
+    wallets: Union[str, Tuple[str, ...]] = "batcher",
+    max_orders: int = MAX_ORDERS_PER_TX,
+    in_flight: int = 100,
+    prefilter: bool = True,
+    max_chained: int = MAX_CHAINED_BATCHES,
+):
+    """
+    Run the batcher until interrupted, with one worker per wallet (comma separated),
+    so that as many farms are batched concurrently.
+    With prefilter, only transactions that may be relevant are fully decoded.
+    Up to max_chained batches of a worker are submitted before the first of them is confirmed.
+    """
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    if isinstance(wallets, str):
+        wallets = tuple(wallets.split(","))
+    batcher = Batcher(
+        wallets,
+        max_orders,
+        tx_filter=default_tx_filter() if prefilter else None,
+        max_chained=max_chained,
+    )
+    asyncio.run(batcher.run(in_flight=in_flight))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,177 @@
+"""
+Chaining of transactions on the outputs of submitted, not yet confirmed transactions.
+
+The node accepts transactions spending outputs of transactions in its mempool, but the UTxO
+queries of the chain context only return confirmed outputs and ogmios can only evaluate the
+scripts of such transactions if the unconfirmed inputs are passed along.
+"""
+
+import json
+from typing import Dict, List, Set, Tuple, Union
+
+import websocket
+from pycardano import (
+    Address,
+    ChainContext,
+    ExecutionUnits,
+    RawCBOR,
+    Transaction,
+    TransactionFailedException,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+)
+
+OutRef = Tuple[bytes, int]
+
+
+def _out_ref(i: TransactionInput) -> OutRef:
+    return i.transaction_id.payload, i.index
+
+
+def tx_output_utxo(tx: Transaction, index: int) -> UTxO:
+    """
+    The UTxO created by the output of the transaction, with its datum as RawCBOR like in the UTxOs
+    returned by the chain context.
+    """
+    output = tx.transaction_body.outputs[index]
+    return UTxO(
+        TransactionInput(tx.id, index),
+        TransactionOutput(
+            output.address,
+            output.amount,
+            datum_hash=output.datum_hash,
+            datum=RawCBOR(output.datum.to_cbor()) if output.datum is not None else None,
+            script=output.script,
+        ),
+    )
+
+
+def to_ogmios_utxo(u: UTxO) -> dict:
+    """
+    The UTxO in the format of ogmios v6.
+    """
+    value = {"ada": {"lovelace": u.output.amount.coin}}
+    for policy_id, assets in u.output.amount.multi_asset.items():
+        value[policy_id.payload.hex()] = {
+            name.payload.hex(): amount for name, amount in assets.items()
+        }
+    utxo = {
+        "transaction": {"id": u.input.transaction_id.payload.hex()},
+        "index": u.input.index,
+        "address": str(u.output.address),
+        "value": value,
+    }
+    if u.output.datum is not None:
+        utxo["datum"] = u.output.datum.cbor.hex()
+    elif u.output.datum_hash is not None:
+        utxo["datumHash"] = u.output.datum_hash.payload.hex()
+    if u.output.script is not None:
+        raise ValueError("Chaining on outputs with reference scripts is not supported.")
+    return utxo
+
+
+class ChainedContext(ChainContext):
+    """
+    Chain context on top of another one, in which the outputs of the transactions submitted through
+    it are spendable and their inputs are spent until they are forgotten, i.e. confirmed or dropped.
+    Scripts are evaluated by ogmios at `ogmios_url`.
+    """
+
+    def __init__(self, base: ChainContext, ogmios_url: str):
+        self.base = base
+        self.ogmios_url = ogmios_url
+        self.pending: Dict[OutRef, UTxO] = {}
+        self.spent: Set[OutRef] = set()
+
+    @property
+    def protocol_param(self):
+        return self.base.protocol_param
+
+    @property
+    def genesis_param(self):
+        return self.base.genesis_param
+
+    @property
+    def network(self):
+        return self.base.network
+
+    @property
+    def epoch(self) -> int:
+        return self.base.epoch
+
+    @property
+    def last_block_slot(self) -> int:
+        return self.base.last_block_slot
+
+    def utxos(self, address: Union[str, Address]) -> List[UTxO]:
+        address = Address.from_primitive(str(address))
+        return [
+            u for u in self.base.utxos(address) if _out_ref(u.input) not in self.spent
+        ] + [u for u in self.pending.values() if u.output.address == address]
+
+    def submit_tx_cbor(self, cbor: Union[bytes, str]):
+        return self.base.submit_tx_cbor(cbor)
+
+    def submit_tx(self, tx: Transaction):
+        """
+        Submit the transaction and make its outputs spendable.
+        """
+        self.base.submit_tx(tx)
+        for i in tx.transaction_body.inputs:
+            self.pending.pop(_out_ref(i), None)
+            self.spent.add(_out_ref(i))
+        for index in range(len(tx.transaction_body.outputs)):
+            u = tx_output_utxo(tx, index)
+            self.pending[_out_ref(u.input)] = u
+
+    def forget(self, tx: Transaction):
+        """
+        Stop tracking a submitted transaction, once it is confirmed or will not be anymore.
+        """
+        for i in tx.transaction_body.inputs:
+            self.spent.discard(_out_ref(i))
+        for index in range(len(tx.transaction_body.outputs)):
+            self.pending.pop((tx.id.payload, index), None)
+
+    def evaluate_tx_cbor(self, cbor: Union[bytes, str]) -> Dict[str, ExecutionUnits]:
+        if isinstance(cbor, str):
+            cbor = bytes.fromhex(cbor)
+        tx = Transaction.from_cbor(cbor)
+        unconfirmed = [
+            self.pending[_out_ref(i)]
+            for i in tx.transaction_body.inputs
+            if _out_ref(i) in self.pending
+        ]
+        if not unconfirmed:
+            return self.base.evaluate_tx_cbor(cbor)
+        return self._evaluate(cbor, unconfirmed)
+
+    def _evaluate(
+        self, cbor: bytes, additional_utxos: List[UTxO]
+    ) -> Dict[str, ExecutionUnits]:
+        request = {
+            "jsonrpc": "2.0",
+            "method": "evaluateTransaction",
+            "params": {
+                "transaction": {"cbor": cbor.hex()},
+                "additionalUtxo": [to_ogmios_utxo(u) for u in additional_utxos],
+            },
+        }
+        ws = websocket.WebSocket()
+        ws.connect(self.ogmios_url)
+        try:
+            ws.send(json.dumps(request))
+            response = json.loads(ws.recv())
+        finally:
+            ws.close()
+        if "error" in response:
+            raise TransactionFailedException(
+                f"Failed to evaluate transaction: {response['error']}"
+            )
+        return {
+            f"{r['validator']['purpose']}:{r['validator']['index']}": ExecutionUnits(
+                mem=r["budget"]["memory"], steps=r["budget"]["cpu"]
+            )
+            for r in response["result"]
+        }
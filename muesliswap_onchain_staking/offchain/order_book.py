@@ -0,0 +1,270 @@
+"""
+In-memory index of the pending orders, farms and staking positions, kept up to date from the chain.
+
+The index is loaded once from the UTxOs of the batching and staking addresses and then updated
+with the transactions of every block. Changes are journaled per block, so that rollbacks up to
+`journal_size` blocks deep can be undone without reloading.
+Applying a transaction is idempotent, so blocks that are already reflected in the loaded UTxOs
+may be applied again, e.g. the blocks following the intersection with the chain.
+"""
+
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+from muesliswap_onchain_staking.onchain import batching, staking
+from muesliswap_onchain_staking.offchain.batch_orders import PendingOrder
+from pycardano import (
+    Address,
+    AssetName,
+    DeserializeException,
+    RawCBOR,
+    ScriptHash,
+    Transaction,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+)
+
+OutRef = Tuple[bytes, int]
+
+
+def out_ref(u: UTxO) -> OutRef:
+    return u.input.transaction_id.payload, u.input.index
+
+
+def _datum_cbor(output: TransactionOutput) -> Optional[bytes]:
+    # UTxOs from the chain context carry RawCBOR datums, outputs of decoded transactions RawPlutusData
+    if output.datum is None:
+        return None
+    if isinstance(output.datum, RawCBOR):
+        return output.datum.cbor
+    return output.datum.to_cbor()
+
+
+@dataclass
+class BlockChanges:
+    """
+    The UTxOs added to and removed from the index by a block.
+    """
+
+    slot: int
+    added: List[OutRef] = field(default_factory=list)
+    removed: List[UTxO] = field(default_factory=list)
+
+
+class OrderBook:
+    """
+    Pending orders by pool ID, farm UTxOs by the pool ID of their farm NFT
+    and staking positions by output reference.
+    """
+
+    def __init__(
+        self,
+        farm_nft_policy_id: ScriptHash,
+        batching_address: Address,
+        staking_address: Address,
+        journal_size: int = 2160,
+    ):
+        self.farm_nft_policy_id = farm_nft_policy_id
+        self.batching_address = batching_address
+        self.staking_address = staking_address
+        self.utxos: Dict[OutRef, UTxO] = {}
+        self.farms: Dict[bytes, OutRef] = {}
+        self.positions: Dict[OutRef, bytes] = {}
+        self.orders: Dict[bytes, Dict[OutRef, PendingOrder]] = {}
+        self._pools: Dict[OutRef, bytes] = {}
+        # number of indexed outputs per transaction hash, to skip transactions spending none of them
+        self._tx_hashes: Counter[str] = Counter()
+        self._journal: Deque[BlockChanges] = deque(maxlen=journal_size)
+        # earliest slot that can be rolled back to
+        self._horizon = 0
+
+    def load(self, utxos: Iterable[UTxO], slot: int):
+        """
+        (Re-)load the index from the UTxOs of the batching and staking addresses,
+        which reflect at least the blocks up to the slot.
+        """
+        self.utxos.clear()
+        self.farms.clear()
+        self.positions.clear()
+        self.orders.clear()
+        self._pools.clear()
+        self._tx_hashes.clear()
+        self._journal.clear()
+        self._horizon = slot
+        for u in self._staking_first(utxos):
+            self.add(u)
+
+    def _staking_first(self, utxos: Iterable[UTxO]) -> List[UTxO]:
+        # unstake orders are indexed by the pool of their staking position
+        return sorted(utxos, key=lambda u: u.output.address != self.staking_address)
+
+    def add(self, u: UTxO) -> bool:
+        """
+        Index the UTxO, returns whether it is a farm, staking position or order.
+        """
+        ref = out_ref(u)
+        if ref in self.utxos:
+            return False
+        datum_cbor = _datum_cbor(u.output)
+        if datum_cbor is None:
+            return False
+        u = UTxO(
+            u.input,
+            TransactionOutput(
+                u.output.address,
+                u.output.amount,
+                datum=RawCBOR(datum_cbor),
+                script=u.output.script,
+            ),
+        )
+        if u.output.address == self.staking_address:
+            datum = self._staking_datum(datum_cbor)
+            if isinstance(datum, staking.FarmState):
+                pool_id = datum.params.pool_id
+                farm_nfts = u.output.amount.multi_asset.get(self.farm_nft_policy_id, {})
+                if farm_nfts.get(AssetName(pool_id), 0) != 1:
+                    return False
+                self.farms[pool_id] = ref
+            elif isinstance(datum, staking.StakingPosition):
+                pool_id = datum.pool_id
+                self.positions[ref] = pool_id
+            else:
+                return False
+        elif u.output.address == self.batching_address:
+            order = self._order(datum_cbor)
+            if order is None:
+                return False
+            if isinstance(order, batching.StakeOrder):
+                pool_id = order.pool_id
+            else:
+                position = (order.staking_position.id.tx_id, order.staking_position.idx)
+                pool_id = self.positions.get(position)
+                if pool_id is None:
+                    # the staking position was already spent
+                    return False
+            self.orders.setdefault(pool_id, {})[ref] = PendingOrder(u, order, pool_id)
+        else:
+            return False
+        self.utxos[ref] = u
+        self._pools[ref] = pool_id
+        self._tx_hashes[ref[0].hex()] += 1
+        return True
+
+    @staticmethod
+    def _decode(datum_cbor: bytes, datum_types: tuple):
+        for datum_type in datum_types:
+            try:
+                return datum_type.from_cbor(datum_cbor)
+            except DeserializeException:
+                pass
+        return None
+
+    @classmethod
+    def _staking_datum(cls, datum_cbor: bytes):
+        return cls._decode(datum_cbor, (staking.FarmState, staking.StakingPosition))
+
+    @classmethod
+    def _order(cls, datum_cbor: bytes):
+        return cls._decode(datum_cbor, (batching.StakeOrder, batching.UnstakeOrder))
+
+    def remove(self, ref: OutRef) -> Optional[UTxO]:
+        """
+        Remove the UTxO from the index, returns it if it was indexed.
+        """
+        u = self.utxos.pop(ref, None)
+        if u is None:
+            return None
+        pool_id = self._pools.pop(ref)
+        if self.farms.get(pool_id) == ref:
+            del self.farms[pool_id]
+        self.positions.pop(ref, None)
+        pool_orders = self.orders.get(pool_id, {})
+        if pool_orders.pop(ref, None) is not None and not pool_orders:
+            del self.orders[pool_id]
+        tx_hash = ref[0].hex()
+        self._tx_hashes[tx_hash] -= 1
+        if not self._tx_hashes[tx_hash]:
+            del self._tx_hashes[tx_hash]
+        return u
+
+    def spends_any(self, tx_hashes: Iterable[str]) -> bool:
+        """
+        Whether any of the given transactions (hex encoded hashes) has an indexed output.
+        """
+        return any(tx_hash in self._tx_hashes for tx_hash in tx_hashes)
+
+    def apply_tx(self, tx_id: bytes, tx: Transaction, changes: BlockChanges):
+        if not tx.valid:
+            # failed script validation, only the collateral is spent
+            return
+        for i in tx.transaction_body.inputs:
+            u = self.remove((i.transaction_id.payload, i.index))
+            if u is not None:
+                changes.removed.append(u)
+        for index, output in enumerate(tx.transaction_body.outputs):
+            u = UTxO(TransactionInput.from_primitive([tx_id, index]), output)
+            if self.add(u):
+                changes.added.append(out_ref(u))
+
+    def roll_forward(
+        self, slot: int, txs: Iterable[Tuple[bytes, Transaction]]
+    ) -> BlockChanges:
+        """
+        Apply the transactions of a block, given with their ids.
+        """
+        changes = BlockChanges(slot)
+        for tx_id, tx in txs:
+            self.apply_tx(tx_id, tx, changes)
+        if len(self._journal) == self._journal.maxlen:
+            self._horizon = self._journal[0].slot
+        self._journal.append(changes)
+        return changes
+
+    def roll_back(self, slot: Optional[int]) -> bool:
+        """
+        Undo the blocks after the slot (all blocks for None), returns False if they are
+        not all journaled anymore and the index needs to be reloaded.
+        """
+        while self._journal and (slot is None or self._journal[-1].slot > slot):
+            changes = self._journal.pop()
+            for ref in reversed(changes.added):
+                self.remove(ref)
+            for u in self._staking_first(changes.removed):
+                self.add(u)
+        return slot is not None and slot >= self._horizon
+
+    def farm(self, pool_id: bytes) -> Optional[UTxO]:
+        ref = self.farms.get(pool_id)
+        return self.utxos[ref] if ref is not None else None
+
+    def pending_orders(self, pool_id: bytes) -> List[PendingOrder]:
+        """
+        The pending orders of the pool in the order in which they are spent by a transaction,
+        with the staking positions of unstake orders. Only the first order unstaking a position is kept.
+        """
+        orders = []
+        claimed = set()
+        for ref in sorted(self.orders.get(pool_id, {})):
+            o = self.orders[pool_id][ref]
+            if isinstance(o.order, batching.UnstakeOrder):
+                position = (
+                    o.order.staking_position.id.tx_id,
+                    o.order.staking_position.idx,
+                )
+                if position not in self.positions or position in claimed:
+                    continue
+                claimed.add(position)
+                o = PendingOrder(o.utxo, o.order, pool_id, self.utxos[position])
+            orders.append(o)
+        return orders
+
+    def pools_by_pending_orders(self) -> List[bytes]:
+        """
+        The pools with pending orders and a farm, the pool with the most pending orders first.
+        """
+        return sorted(
+            (pool_id for pool_id in self.orders if pool_id in self.farms),
+            key=lambda pool_id: -len(self.orders[pool_id]),
+        )
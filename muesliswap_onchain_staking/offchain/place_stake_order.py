@@ -1,6 +1,7 @@
 import fire
+from typing import Optional
 
-from muesliswap_onchain_staking.onchain import batching, staking
+from muesliswap_onchain_staking.onchain import batching, staking, farm_nft
 from muesliswap_onchain_staking.utils.network import show_tx, context
 from muesliswap_onchain_staking.utils import get_signing_info, network, to_address
 from muesliswap_onchain_staking.utils.contracts import get_contract, module_name
@@ -9,6 +10,7 @@ from muesliswap_onchain_staking.offchain.util import (
     asset_from_token,
     with_min_lovelace,
 )
+from muesliswap_onchain_staking.offchain.batch_orders import find_farms
 from pycardano import (
     TransactionBuilder,
     AuxiliaryData,
@@ -26,23 +28,30 @@ def main(
         "672ae1e79585ad1543ef6b4b6c8989a17adcea3040f77ede128d9217.6d7565736c69"
     ),
     stake_amount: int = 100,
+    pool_id: Optional[str] = None,
 ):
+    """
+    Place an order to stake in the farm of the pool ID (hex), which may be omitted if there is only one farm.
+    """
     _, _, stake_order_batching = get_contract(module_name(batching), compressed=True)
     _, payment_skey, payment_address = get_signing_info(wallet, network=network)
     payment_utxos = context.utxos(payment_address)
 
-    # determine pool id from existing pool
+    # determine pool id from existing farms
     _, _, staking_address = get_contract(module_name(staking), compressed=True)
-    staking_utxos = context.utxos(staking_address)
-    if len(staking_utxos) != 1:
+    _, farm_nft_policy_id, _ = get_contract(module_name(farm_nft), compressed=True)
+    farms = find_farms(context.utxos(staking_address), farm_nft_policy_id)
+    if pool_id is not None:
+        pool_id = bytes.fromhex(pool_id)
+        if pool_id not in farms:
+            raise ValueError(f"No farm UTxO found for pool {pool_id.hex()}.")
+    elif len(farms) == 1:
+        pool_id = next(iter(farms))
+    else:
         raise ValueError(
-            f"Expected exactly one staking UTxO (farm), found {len(staking_utxos)}."
+            f"Expected exactly one farm, found {len(farms)}, choose a pool ID out of "
+            f"{', '.join(p.hex() for p in farms)}."
         )
-    farm_input = staking_utxos[0]
-    farm_datum = staking.FarmState.from_cbor(
-        farm_input.output.datum.cbor
-    )
-    pool_id = farm_datum.params.pool_id
 
     # construct the stake order datum
     stake_order_datum = batching.StakeOrder(
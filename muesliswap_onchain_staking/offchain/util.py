@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import Callable, List, Union
 
 import pycardano
 
@@ -13,8 +13,14 @@ from pycardano import (
     VerificationKeyWitness,
     SigningKey,
     ExtendedSigningKey,
+    RedeemerMap,
+    InvalidTransactionException,
 )
 
+# share of the protocol limits on transaction size and execution units that a batch may use,
+# leaving room for the fee adjustment and for differences between estimation and validation
+TX_LIMIT_MARGIN = 0.9
+
 
 def token_from_string(token: str) -> Token:
     if token == "lovelace":
@@ -71,7 +77,8 @@ def adjust_for_wrong_fee(
     new_value = pycardano.transaction.Value(
         coin=tx_signed.transaction_body.outputs[-1].amount.coin
         - output_offset
-        - fee_offset
+        - fee_offset,
+        multi_asset=tx_signed.transaction_body.outputs[-1].amount.multi_asset,
     )
     tx_signed.transaction_body.outputs[-1].amount = new_value
     tx_signed.transaction_body.fee += fee_offset
@@ -88,6 +95,32 @@ def adjust_for_wrong_fee(
     )
 
 
+def adjust_to_min_fee(
+    tx_signed: Transaction,
+    signing_keys: List[Union[SigningKey, ExtendedSigningKey]],
+    context: pycardano.ChainContext,
+) -> Transaction:
+    """
+    Raise the fee to the minimum fee of the final transaction, paying the difference from the change output.
+    pycardano estimates the fee on inline datums with their lists encoded as definite-length arrays,
+    but serializes them as indefinite-length arrays, one byte longer each.
+    """
+    redeemers = tx_signed.transaction_witness_set.redeemer or []
+    if isinstance(redeemers, RedeemerMap):
+        redeemers = redeemers.values()
+    min_fee = pycardano.fee(
+        context,
+        len(tx_signed.to_cbor()),
+        sum(r.ex_units.steps for r in redeemers),
+        sum(r.ex_units.mem for r in redeemers),
+    )
+    return adjust_for_wrong_fee(
+        tx_signed,
+        signing_keys,
+        fee_offset=max(0, min_fee - tx_signed.transaction_body.fee),
+    )
+
+
 def remove_zero_values(v: Value) -> Value:
     """
     Removes keys from the inner dictionaries where the value is 0.
@@ -109,3 +142,46 @@ def remove_zero_values(v: Value) -> Value:
         del v.multi_asset[asset_key]
 
     return v
+
+
+def tx_limit_usage(tx: Transaction, context: pycardano.ChainContext) -> float:
+    """
+    The largest share of the protocol limits on size, memory and steps that the transaction uses.
+    """
+    params = context.protocol_param
+    redeemers = tx.transaction_witness_set.redeemer or []
+    if isinstance(redeemers, RedeemerMap):
+        redeemers = redeemers.values()
+    ex_units = [r.ex_units for r in redeemers if r.ex_units is not None]
+    return max(
+        len(tx.to_cbor()) / params.max_tx_size,
+        sum(u.mem for u in ex_units) / params.max_tx_ex_mem,
+        sum(u.steps for u in ex_units) / params.max_tx_ex_steps,
+    )
+
+
+def build_largest_batch(
+    build: Callable[[int], Transaction],
+    count: int,
+    context: pycardano.ChainContext,
+) -> Transaction:
+    """
+    Build the transaction for the first `n` orders with the largest `n` up to `count`
+    that stays within TX_LIMIT_MARGIN of the protocol limits.
+    The batch is shrunk in proportion to how far a built transaction exceeds the limits.
+    """
+    while True:
+        try:
+            tx = build(count)
+            usage = tx_limit_usage(tx, context)
+        except InvalidTransactionException:
+            # the builder rejects transactions exceeding the size limit
+            tx, usage = None, None
+        if tx is not None and usage <= TX_LIMIT_MARGIN:
+            return tx
+        if count == 1:
+            raise ValueError("A single order exceeds the transaction limits.")
+        if usage is None:
+            count //= 2
+        else:
+            count = max(1, min(count - 1, int(count * TX_LIMIT_MARGIN / usage)))
@@ -92,22 +92,36 @@ def validator(
             r: MintApplyOrder = redeemer
             farm_input = tx_info.inputs[r.farm_input_index].resolved
             assert farm_input.address == address, "Invalid farm input."
-            staking_position_output = tx_info.outputs[r.staking_position_output_index]
-            assert (
-                staking_position_output.address == address
-            ), "Stake not going to staking contract."
             farm_datum: FarmState = resolve_datum_unsafe(
                 farm_input, tx_info
             )  # TODO: check if this is safe
             assert isinstance(farm_datum, FarmState), "Invalid farm datum."
-            staking_datum: StakingPosition = resolve_datum_unsafe(
-                staking_position_output, tx_info
-            )
-            assert (
-                staking_datum.batching_output_index == r.staking_position_output_index
-            ), "Invalid batching output index provided."
-            check_mint_exactly_one_with_name(
-                tx_info.mint, purpose.policy_id, STAKE_NFT_NAME
+
+            # Idea: strictly ascending output indices, each output holding exactly one of the minted NFTs
+            prev_output_index = -1
+            for output_index in r.staking_position_output_indices:
+                assert (
+                    output_index > prev_output_index
+                ), "Staking position outputs not in strictly ascending order."
+                prev_output_index = output_index
+                staking_position_output = tx_info.outputs[output_index]
+                assert (
+                    staking_position_output.address == address
+                ), "Stake not going to staking contract."
+                staking_datum: StakingPosition = resolve_datum_unsafe(
+                    staking_position_output, tx_info
+                )
+                assert (
+                    staking_datum.batching_output_index == output_index
+                ), "Invalid batching output index provided."
+                check_correct_stake_factory_nft(
+                    staking_position_output, purpose.policy_id
+                )
+            check_mint_exactly_n_with_name(
+                tx_info.mint,
+                len(r.staking_position_output_indices),
+                purpose.policy_id,
+                STAKE_NFT_NAME,
             )
 
             # TODO: check time etc. of initialization -> not necessary since already checked in farm/staking contract (which we ensure above is spent)
@@ -263,7 +277,10 @@ def validator(
                         no_unstakes += 1
 
                         assert (
-                            od.staking_position == tx_info.inputs[in_idx].out_ref
+                            od.staking_position
+                            == tx_info.inputs[
+                                r.staking_position_input_indices[i]
+                            ].out_ref
                         ), "Invalid reference to staking position."
                         assert (
                             staking_position_input.address == address
@@ -275,6 +292,9 @@ def validator(
 
                         # check that owner cannot claim more than expected reward
                         payment_output = tx_info.outputs[out_idx]
+                        assert (
+                            payment_output.address == od.owner
+                        ), "Payment not going to owner."
                         expected_reward_amounts = [
                             floor_scale_fraction(
                                 new_cumulative_pool_rpts[i], unstaked_amount
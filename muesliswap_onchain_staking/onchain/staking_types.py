@@ -71,6 +71,7 @@ class ApplyOrders(PlutusData):
     farm_input_index: int
     farm_output_index: int
     order_input_indices: List[int]
+    # aligned with the order inputs, the entries of stake orders are not used
     staking_position_input_indices: List[int]
     order_output_indices: List[int]
     # license_input_index: int  # TODO: support/require licenses
@@ -105,9 +106,13 @@ class UnstakePosition(PlutusData):
 
 @dataclass
 class MintApplyOrder(PlutusData):
+    """
+    Redeemer for minting one stake NFT for each staking position created by a batch of orders.
+    """
+
     CONSTR_ID = 4
     farm_input_index: int
-    staking_position_output_index: int
+    staking_position_output_indices: List[int]
 
 
 @dataclass
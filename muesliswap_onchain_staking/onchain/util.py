@@ -357,3 +357,13 @@ def floor_scale_fraction(f: Fraction, s: int) -> int:
     Returns floor(f * s)
     """
     return (f.numerator * s) // f.denominator
+
+
+def add_fraction(a: Fraction, b: Fraction) -> Fraction:
+    """
+    Returns a + b, not normalized
+    """
+    return Fraction(
+        a.numerator * b.denominator + b.numerator * a.denominator,
+        a.denominator * b.denominator,
+    )
@@ -71,17 +71,16 @@ def to_dcert(c: pycardano.Certificate) -> DCert:
 
 def multiasset_to_value(ma: pycardano.MultiAsset) -> Value:
     return {
-        PolicyId(policy_id): {
-            TokenName(asset_name): quantity for asset_name, quantity in asset
+        PolicyId(policy_id.payload): {
+            TokenName(asset_name.payload): quantity
+            for asset_name, quantity in asset.items()
         }
-        for policy_id, asset in ma.to_shallow_primitive().items()
+        for policy_id, asset in ma.items()
     }
 
 
 def value_to_value(v: pycardano.Value):
-    ma = multiasset_to_value(v.multi_asset)
-    ma[b""][b""] = v.coin
-    return ma
+    return {b"": {b"": v.coin}, **multiasset_to_value(v.multi_asset)}
 
 
 def to_payment_credential(
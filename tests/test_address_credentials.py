@@ -0,0 +1,31 @@
+import peewee
+
+from muesliswap_onchain_staking.api import chain_querier
+from muesliswap_onchain_staking.api.db_models import Address
+from muesliswap_onchain_staking.api.tx_processor.address_credentials import BATCH_SIZE
+
+BASE_ADDRESS = "00" + "01" * 28 + "02" * 28
+
+
+def byron_address(i: int) -> str:
+    return "82d818582183581c" + f"{i:056x}" + "a0001a00000000"
+
+
+def test_startup_decomposes_addresses_after_undecomposable_ones(sqlite_database):
+    # a whole batch of addresses without credentials precedes the one with credentials
+    for batch in peewee.chunked(range(BATCH_SIZE), 100):
+        Address.insert_many(
+            [(byron_address(i),) for i in batch], fields=[Address.address_raw]
+        ).execute()
+    Address.create(address_raw=BASE_ADDRESS)
+    for _ in range(2):
+        chain_querier.prepare_database()
+        address = Address.get(Address.address_raw == BASE_ADDRESS)
+        assert (address.payment_credential, address.stake_credential) == (
+            "01" * 28,
+            "02" * 28,
+        )
+    assert (
+        Address.select().where(Address.payment_credential.is_null()).count()
+        == BATCH_SIZE
+    )
@@ -0,0 +1,86 @@
+"""
+Fitting batches of orders to the protocol limits.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from pycardano import (
+    ExecutionUnits,
+    InvalidTransactionException,
+    Redeemer,
+    RedeemerTag,
+    Transaction,
+    TransactionBody,
+    TransactionWitnessSet,
+    Unit,
+)
+
+from muesliswap_onchain_staking.offchain.util import (
+    TX_LIMIT_MARGIN,
+    build_largest_batch,
+    tx_limit_usage,
+)
+
+CONTEXT = SimpleNamespace(
+    protocol_param=SimpleNamespace(
+        max_tx_size=16384, max_tx_ex_mem=14_000_000, max_tx_ex_steps=10_000_000_000
+    )
+)
+
+
+class FakeBuilder:
+    """
+    Builds a transaction for `n` orders whose execution units grow linearly with `n`,
+    recording the number of orders of every attempt.
+    """
+
+    def __init__(self, base_mem: int, mem_per_order: int, max_orders: int = None):
+        self.base_mem = base_mem
+        self.mem_per_order = mem_per_order
+        self.max_orders = max_orders
+        self.attempts = []
+
+    def __call__(self, n: int) -> Transaction:
+        self.attempts.append(n)
+        if self.max_orders is not None and n > self.max_orders:
+            raise InvalidTransactionException("Transaction size exceeds the max limit")
+        redeemer = Redeemer(
+            Unit(), ExecutionUnits(self.base_mem + n * self.mem_per_order, 1_000_000)
+        )
+        redeemer.tag = RedeemerTag.SPEND
+        redeemer.index = 0
+        return Transaction(
+            TransactionBody(inputs=[], outputs=[], fee=0),
+            TransactionWitnessSet(redeemer=[redeemer]),
+        )
+
+
+def test_shrinks_until_within_margin():
+    build = FakeBuilder(base_mem=4_000_000, mem_per_order=1_000_000)
+    tx = build_largest_batch(build, 30, CONTEXT)
+    assert tx_limit_usage(tx, CONTEXT) <= TX_LIMIT_MARGIN
+    # the fixed overhead makes the proportional estimate overshoot, so it takes a few rounds
+    assert build.attempts == [30, 11, 9, 8]
+    # one more order would exceed the margin
+    assert tx_limit_usage(build(9), CONTEXT) > TX_LIMIT_MARGIN
+
+
+def test_halves_when_the_builder_rejects_the_size():
+    build = FakeBuilder(base_mem=0, mem_per_order=100_000, max_orders=10)
+    tx = build_largest_batch(build, 30, CONTEXT)
+    assert tx_limit_usage(tx, CONTEXT) <= TX_LIMIT_MARGIN
+    assert build.attempts == [30, 15, 7]
+
+
+def test_batch_within_limits_is_built_once():
+    build = FakeBuilder(base_mem=0, mem_per_order=100_000)
+    build_largest_batch(build, 30, CONTEXT)
+    assert build.attempts == [30]
+
+
+def test_single_order_exceeding_the_limits():
+    build = FakeBuilder(base_mem=14_000_000, mem_per_order=1_000_000)
+    with pytest.raises(ValueError):
+        build_largest_batch(build, 5, CONTEXT)
+    assert build.attempts[-1] == 1
@@ -0,0 +1,458 @@
+"""
+Mixed batches of stake and unstake orders, checked with the on-chain validators.
+"""
+
+import dataclasses
+
+import pycardano
+import pytest
+from opshin.prelude import (
+    FalseData,
+    FinitePOSIXTime,
+    LowerBoundPOSIXTime,
+    Minting,
+    POSIXTimeRange,
+    Spending,
+    Token,
+    TrueData,
+    TxInfo,
+    TxOutRef,
+    TxId,
+    UpperBoundPOSIXTime,
+    ScriptContext,
+)
+from opshin.std.fractions import Fraction
+from pycardano import (
+    Address,
+    ExecutionUnits,
+    MultiAsset,
+    Network,
+    PaymentSigningKey,
+    RawCBOR,
+    RedeemerMap,
+    RedeemerTag,
+    TransactionId,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+    Value,
+)
+from pycardano.backend.base import GenesisParameters, ProtocolParameters
+
+from muesliswap_onchain_staking.offchain.batch_orders import (
+    build_order_batch,
+    find_farm,
+    pending_orders,
+)
+from muesliswap_onchain_staking.onchain import (
+    batching,
+    farm_nft,
+    staking,
+    unstake_permission_nft,
+    util as onchain_util,
+)
+from muesliswap_onchain_staking.onchain.util import (
+    STAKE_NFT_NAME,
+    unstake_permission_nft_token_name,
+)
+from muesliswap_onchain_staking.utils.contracts import get_contract, module_name
+from muesliswap_onchain_staking.utils.to_script_context import (
+    multiasset_to_value,
+    to_address,
+    to_tx_id,
+    to_tx_in_info,
+    to_tx_out,
+    to_tx_out_ref,
+    value_to_value,
+)
+
+_, _, BATCHING_ADDRESS = get_contract(module_name(batching), compressed=True)
+_, STAKING_POLICY_ID, STAKING_ADDRESS = get_contract(
+    module_name(staking), compressed=True
+)
+_, FARM_NFT_POLICY_ID, _ = get_contract(module_name(farm_nft), compressed=True)
+_, UNSTAKE_PERMISSION_POLICY_ID, _ = get_contract(
+    module_name(unstake_permission_nft), compressed=True
+)
+
+SYSTEM_START = 1_666_656_000
+LAST_BLOCK_SLOT = 50_000_000
+# the validity interval of a batch spans the last block
+CURRENT_TIME = (SYSTEM_START + LAST_BLOCK_SLOT) * 1000
+POOL_ID = b"pool"
+STAKE_TOKEN = Token(bytes.fromhex("11" * 28), b"STAKE")
+REWARD_TOKEN = Token(bytes.fromhex("22" * 28), b"REWARD")
+PAYMENT_SKEY = PaymentSigningKey.generate()
+PAYMENT_ADDRESS = Address(
+    PAYMENT_SKEY.to_verification_key().hash(), network=Network.TESTNET
+)
+OWNER = to_address(
+    Address(
+        PaymentSigningKey.generate().to_verification_key().hash(),
+        network=Network.TESTNET,
+    )
+)
+START_RPT = Fraction(1, 3)
+# staked amounts of the stake orders and of the positions with unstake orders
+STAKES = [100, 200, 300]
+POSITIONS = [1000, 2000]
+
+
+class FakeChainContext(pycardano.ChainContext):
+    """
+    A chain context with the preview protocol parameters that charges the same execution units for every script.
+    """
+
+    def __init__(self, utxos: list[UTxO]):
+        self.utxo_list = utxos
+        self._protocol_param = ProtocolParameters(
+            **{f.name: None for f in dataclasses.fields(ProtocolParameters)}
+            | dict(
+                min_fee_constant=155381,
+                min_fee_coefficient=44,
+                key_deposit=2_000_000,
+                pool_deposit=500_000_000,
+                max_tx_size=16384,
+                max_val_size=5000,
+                price_mem=0.0577,
+                price_step=0.0000721,
+                max_tx_ex_mem=14_000_000,
+                max_tx_ex_steps=10_000_000_000,
+                collateral_percent=150,
+                max_collateral_inputs=3,
+                coins_per_utxo_word=4310,
+                coins_per_utxo_byte=4310,
+                cost_models={},
+            )
+        )
+
+    @property
+    def protocol_param(self) -> ProtocolParameters:
+        return self._protocol_param
+
+    @property
+    def genesis_param(self) -> GenesisParameters:
+        return GenesisParameters(system_start=SYSTEM_START, slot_length=1)
+
+    @property
+    def network(self) -> Network:
+        return Network.TESTNET
+
+    @property
+    def epoch(self) -> int:
+        return 100
+
+    @property
+    def last_block_slot(self) -> int:
+        return LAST_BLOCK_SLOT
+
+    def _utxos(self, address: str) -> list[UTxO]:
+        return [u for u in self.utxo_list if str(u.output.address) == address]
+
+    def submit_tx_cbor(self, cbor):
+        pass
+
+    def evaluate_tx_cbor(self, cbor) -> dict:
+        tx = pycardano.Transaction.from_cbor(cbor)
+        return {
+            f"{tag.name.lower()}:{index}": ExecutionUnits(200_000, 80_000_000)
+            for tag, index, _ in redeemers(tx)
+        }
+
+
+def redeemers(tx: pycardano.Transaction) -> list[tuple]:
+    """
+    The tag, index and data of every redeemer of the transaction.
+    """
+    rs = tx.transaction_witness_set.redeemer or []
+    if isinstance(rs, RedeemerMap):
+        return [(k.tag, k.index, v.data) for k, v in rs.items()]
+    return [(r.tag, r.index, r.data) for r in rs]
+
+
+def tx_id(i: int) -> TransactionId:
+    return TransactionId(i.to_bytes(2, "big") + bytes(30))
+
+
+def utxo(i: int, address: Address, amount: Value, datum=None) -> UTxO:
+    return UTxO(
+        TransactionInput(tx_id(i), 0),
+        TransactionOutput(address, amount, datum=datum),
+    )
+
+
+def stake_token(amount: int) -> MultiAsset:
+    return MultiAsset.from_primitive(
+        {STAKE_TOKEN.policy_id: {STAKE_TOKEN.token_name: amount}}
+    )
+
+
+@dataclasses.dataclass
+class Chain:
+    context: FakeChainContext
+    # the typed datums of the UTxOs, the chain context holds them as CBOR
+    datums: dict
+
+
+@pytest.fixture
+def chain() -> Chain:
+    """
+    A farm, stake orders and unstake orders of staking positions, interleaved in input order,
+    and a batcher wallet holding ADA and the reward token.
+    """
+    datums = {}
+
+    def add(i: int, address: Address, amount: Value, datum=None) -> UTxO:
+        u = utxo(i, address, amount, RawCBOR(datum.to_cbor()) if datum else None)
+        datums[u.input] = datum
+        return u
+
+    farm = add(
+        1,
+        STAKING_ADDRESS,
+        Value(
+            5_000_000,
+            MultiAsset.from_primitive({FARM_NFT_POLICY_ID.payload: {POOL_ID: 1}}),
+        ),
+        staking.FarmState(
+            staking.FarmParams(POOL_ID, [REWARD_TOKEN], STAKE_TOKEN),
+            staking.DefaultFarmType(),
+            [86_400_000],
+            CURRENT_TIME - 3_600_000,
+            sum(POSITIONS) + 500,
+            [Fraction(1, 2)],
+        ),
+    )
+    positions = [
+        add(
+            10 + i,
+            STAKING_ADDRESS,
+            Value(
+                2_000_000,
+                stake_token(amount)
+                + MultiAsset.from_primitive(
+                    {STAKING_POLICY_ID.payload: {STAKE_NFT_NAME: 1}}
+                ),
+            ),
+            staking.StakingPosition(OWNER, POOL_ID, 0, 1, [START_RPT]),
+        )
+        for i, amount in enumerate(POSITIONS)
+    ]
+    orders = []
+    for i, amount in enumerate(STAKES):
+        orders.append(
+            add(
+                20 + 2 * i,
+                BATCHING_ADDRESS,
+                Value(3_000_000, stake_token(amount)),
+                batching.StakeOrder(OWNER, POOL_ID),
+            )
+        )
+    for i, position in enumerate(positions):
+        order = batching.UnstakeOrder(
+            OWNER,
+            TxOutRef(TxId(position.input.transaction_id.payload), position.input.index),
+        )
+        permission = MultiAsset.from_primitive(
+            {
+                UNSTAKE_PERMISSION_POLICY_ID.payload: {
+                    unstake_permission_nft_token_name(order): 1
+                }
+            }
+        )
+        orders.append(
+            add(21 + 2 * i, BATCHING_ADDRESS, Value(3_000_000, permission), order)
+        )
+    payment = add(
+        100,
+        PAYMENT_ADDRESS,
+        Value(
+            100_000_000,
+            MultiAsset.from_primitive(
+                {REWARD_TOKEN.policy_id: {REWARD_TOKEN.token_name: 10**9}}
+            ),
+        ),
+    )
+    return Chain(FakeChainContext([farm, *positions, *orders, payment]), datums)
+
+
+def build_batch(chain: Chain) -> pycardano.Transaction:
+    staking_utxos = chain.context.utxos(STAKING_ADDRESS)
+    orders = pending_orders(chain.context.utxos(BATCHING_ADDRESS), staking_utxos)
+    return build_order_batch(
+        orders,
+        find_farm(staking_utxos, FARM_NFT_POLICY_ID, POOL_ID),
+        chain.context.utxos(PAYMENT_ADDRESS),
+        PAYMENT_SKEY,
+        PAYMENT_ADDRESS,
+        CURRENT_TIME,
+        chain_context=chain.context,
+    )
+
+
+def to_tx_info(tx: pycardano.Transaction, chain: Chain) -> TxInfo:
+    """
+    The transaction as seen by the validators, with the validity interval in POSIX time.
+    """
+    body = tx.transaction_body
+    resolved = {u.input: u.output for u in chain.context.utxo_list}
+    inputs = [
+        TransactionOutput(
+            resolved[i].address, resolved[i].amount, datum=chain.datums[i]
+        )
+        for i in body.inputs
+    ]
+    datums = [o.datum for o in body.outputs + inputs if o.datum is not None]
+    return TxInfo(
+        [to_tx_in_info(i, o) for i, o in zip(body.inputs, inputs)],
+        [],
+        [to_tx_out(o) for o in body.outputs],
+        value_to_value(Value(body.fee)),
+        multiasset_to_value(body.mint or MultiAsset()),
+        [],
+        {},
+        POSIXTimeRange(
+            LowerBoundPOSIXTime(
+                FinitePOSIXTime((SYSTEM_START + body.validity_start) * 1000),
+                TrueData(),
+            ),
+            UpperBoundPOSIXTime(
+                FinitePOSIXTime((SYSTEM_START + body.ttl) * 1000), FalseData()
+            ),
+        ),
+        [],
+        {},
+        {pycardano.datum_hash(d): d for d in datums},
+        to_tx_id(body.id),
+    )
+
+
+@pytest.fixture(autouse=True)
+def plutus_dict_keys(monkeypatch):
+    """
+    The keys of a dict are a list in the compiled contracts, but a view in Python.
+    """
+    merge = onchain_util.merge_without_duplicates
+    monkeypatch.setattr(
+        onchain_util,
+        "merge_without_duplicates",
+        lambda a, b: merge(list(a), list(b)),
+    )
+
+
+def run_validators(tx: pycardano.Transaction, chain: Chain, redeemer_data=None):
+    """
+    Run the validator of every redeemer of the transaction, optionally replacing the redeemer data.
+    """
+    tx_info = to_tx_info(tx, chain)
+    body = tx.transaction_body
+    for tag, index, data in redeemers(tx):
+        if redeemer_data is not None:
+            data = redeemer_data(data)
+        if tag == RedeemerTag.MINT:
+            context = ScriptContext(tx_info, Minting(STAKING_POLICY_ID.payload))
+            staking.validator(
+                FARM_NFT_POLICY_ID.payload,
+                UNSTAKE_PERMISSION_POLICY_ID.payload,
+                None,
+                data,
+                context,
+            )
+            continue
+        assert tag == RedeemerTag.SPEND
+        spent = body.inputs[index]
+        context = ScriptContext(tx_info, Spending(to_tx_out_ref(spent)))
+        datum = chain.datums[spent]
+        if tx_info.inputs[index].resolved.address == to_address(BATCHING_ADDRESS):
+            batching.validator(to_address(STAKING_ADDRESS), datum, data, context)
+        else:
+            staking.validator(
+                FARM_NFT_POLICY_ID.payload,
+                UNSTAKE_PERMISSION_POLICY_ID.payload,
+                datum,
+                data,
+                context,
+            )
+
+
+def test_mixed_batch_passes_the_validators(chain):
+    tx = build_batch(chain)
+    run_validators(tx, chain)
+    # the farm, the positions and the orders are spent, the stake NFTs minted
+    assert len(redeemers(tx)) == 1 + len(POSITIONS) + len(STAKES) + len(POSITIONS) + 1
+
+    body = tx.transaction_body
+    (apply_orders,) = [
+        data for _, _, data in redeemers(tx) if isinstance(data, staking.ApplyOrders)
+    ]
+    n_orders = len(STAKES) + len(POSITIONS)
+    # the farm is output 0, followed by one output per order and the change
+    assert apply_orders.farm_output_index == 0
+    assert apply_orders.order_output_indices == list(range(1, n_orders + 1))
+    assert len(body.outputs) == n_orders + 2
+    assert body.outputs[-1].address == PAYMENT_ADDRESS
+    # stake orders have no staking position input, the placeholder keeps the lists aligned
+    assert len(apply_orders.staking_position_input_indices) == n_orders
+    order_data = [
+        chain.datums[body.inputs[i]] for i in apply_orders.order_input_indices
+    ]
+    assert [type(d) for d in order_data] == [
+        batching.StakeOrder,
+        batching.UnstakeOrder,
+    ] * len(POSITIONS) + [batching.StakeOrder] * (len(STAKES) - len(POSITIONS))
+    for order, position_index in zip(
+        order_data, apply_orders.staking_position_input_indices
+    ):
+        if isinstance(order, batching.StakeOrder):
+            assert position_index == -1
+        else:
+            position = body.inputs[position_index]
+            assert (position.transaction_id.payload, position.index) == (
+                order.staking_position.id.tx_id,
+                order.staking_position.idx,
+            )
+    (mint_apply_order,) = [
+        data
+        for tag, _, data in redeemers(tx)
+        if tag == RedeemerTag.MINT and isinstance(data, staking.MintApplyOrder)
+    ]
+    assert mint_apply_order.staking_position_output_indices == [
+        output_index
+        for output_index, order in zip(apply_orders.order_output_indices, order_data)
+        if isinstance(order, batching.StakeOrder)
+    ]
+    assert body.mint == MultiAsset.from_primitive(
+        {STAKING_POLICY_ID.payload: {STAKE_NFT_NAME: len(STAKES)}}
+    )
+
+    # the builder balances the transaction and pays at least the minimum fee of its final size
+    resolved = {u.input: u.output for u in chain.context.utxo_list}
+    assert sum([resolved[i].amount for i in body.inputs], Value()) + Value(
+        multi_asset=body.mint
+    ) == sum([o.amount for o in body.outputs], Value()) + Value(body.fee)
+    rs = tx.transaction_witness_set.redeemer
+    ex_units = [
+        r.ex_units for r in (rs.values() if isinstance(rs, RedeemerMap) else rs)
+    ]
+    assert body.fee >= pycardano.fee(
+        chain.context,
+        len(tx.to_cbor()),
+        sum(u.steps for u in ex_units),
+        sum(u.mem for u in ex_units),
+    )
+
+
+def test_validators_reject_swapped_positions(chain):
+    tx = build_batch(chain)
+
+    def swap_positions(data):
+        if isinstance(data, staking.ApplyOrders):
+            indices = list(data.staking_position_input_indices)
+            unstakes = [i for i, index in enumerate(indices) if index != -1]
+            first, last = unstakes[0], unstakes[-1]
+            indices[first], indices[last] = indices[last], indices[first]
+            return dataclasses.replace(data, staking_position_input_indices=indices)
+        return data
+
+    with pytest.raises(AssertionError, match="Invalid reference to staking position"):
+        run_validators(tx, chain, swap_positions)
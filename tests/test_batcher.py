@@ -0,0 +1,139 @@
+"""
+Chains of unconfirmed batches of the resident batcher.
+"""
+
+from datetime import datetime
+
+import pytest
+from pycardano import TransactionFailedException, TransactionInput, Value
+
+from muesliswap_onchain_staking.api import ogmios_iterator
+from muesliswap_onchain_staking.offchain import batcher
+from muesliswap_onchain_staking.offchain.order_book import OrderBook, out_ref
+
+from test_batch_orders import (
+    BATCHING_ADDRESS,
+    CURRENT_TIME,
+    FARM_NFT_POLICY_ID,
+    LAST_BLOCK_SLOT,
+    PAYMENT_ADDRESS,
+    PAYMENT_SKEY,
+    POOL_ID,
+    STAKING_ADDRESS,
+    chain,
+)
+
+
+@pytest.fixture
+def chained(chain, monkeypatch):
+    """
+    Workers paying from the wallet of the chain at the time of its last block, with two orders
+    per batch. Chained batches are evaluated by the chain context instead of ogmios.
+    """
+
+    class Clock(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(CURRENT_TIME / 1000, tz)
+
+    monkeypatch.setattr(batcher, "datetime", Clock)
+    monkeypatch.setattr(
+        batcher,
+        "get_signing_info",
+        lambda wallet, network: (
+            PAYMENT_SKEY.to_verification_key(),
+            PAYMENT_SKEY,
+            PAYMENT_ADDRESS,
+        ),
+    )
+    monkeypatch.setattr(
+        batcher.ChainedContext,
+        "_evaluate",
+        lambda self, cbor, additional_utxos: chain.context.evaluate_tx_cbor(cbor),
+    )
+    return chain
+
+
+def make_worker(chain) -> batcher.BatchWorker:
+    return batcher.BatchWorker("batcher", chain.context, max_orders=2)
+
+
+def make_book(chain) -> OrderBook:
+    book = OrderBook(FARM_NFT_POLICY_ID, BATCHING_ADDRESS, STAKING_ADDRESS)
+    book.load(chain.context.utxo_list, LAST_BLOCK_SLOT)
+    return book
+
+
+def test_batches_are_chained(chained):
+    worker = make_worker(chained)
+    first, second, third = worker.batch(make_book(chained), [POOL_ID])
+    # each batch spends the farm output of the previous one
+    assert TransactionInput(first.id, 0) in second.transaction_body.inputs
+    assert TransactionInput(second.id, 0) in third.transaction_body.inputs
+    assert [batch.tx for batch in worker.submitted] == [first, second, third]
+
+
+def test_rejection_drops_the_chain(chained, monkeypatch):
+    submitted = []
+
+    def submit_tx_cbor(cbor):
+        if len(submitted) == 2:
+            raise TransactionFailedException("rejected")
+        submitted.append(cbor)
+
+    monkeypatch.setattr(chained.context, "submit_tx_cbor", submit_tx_cbor)
+    worker = make_worker(chained)
+    assert len(worker.batch(make_book(chained), [POOL_ID])) == 2
+    assert worker.submitted == []
+    assert worker.context.pending == {}
+    assert worker.context.spent == set()
+
+
+def test_rollback_drops_the_chains(chained, monkeypatch):
+    monkeypatch.setattr(batcher, "context", chained.context)
+    resident = batcher.Batcher(("batcher",), max_orders=2)
+    resident.book.load(chained.context.utxo_list, LAST_BLOCK_SLOT)
+    resident.point = ogmios_iterator.Point(LAST_BLOCK_SLOT + 20, "11" * 32)
+    assert len(resident.batch()) == 3
+    (worker,) = resident.workers
+
+    resident.handle_operation(
+        ogmios_iterator.Rollback(ogmios_iterator.Point(LAST_BLOCK_SLOT, "00" * 32))
+    )
+    assert worker.submitted == []
+    assert worker.context.pending == {}
+    assert worker.context.spent == set()
+    # the next batch starts from the farm in the index again
+    (first, *_) = resident.batch()
+    farm = resident.book.farm(POOL_ID)
+    assert farm.input in first.transaction_body.inputs
+
+
+def test_rollback_to_the_intersection_keeps_the_chains(chained, monkeypatch):
+    monkeypatch.setattr(batcher, "context", chained.context)
+    resident = batcher.Batcher(("batcher",), max_orders=2)
+    resident.book.load(chained.context.utxo_list, LAST_BLOCK_SLOT)
+    resident.point = ogmios_iterator.Point(LAST_BLOCK_SLOT, "00" * 32)
+    assert len(resident.batch()) == 3
+    (worker,) = resident.workers
+
+    # sent by ogmios after reconnecting at the last applied block
+    resident.handle_operation(ogmios_iterator.Rollback(resident.point))
+    assert len(worker.submitted) == 3
+    assert resident.point.slot == LAST_BLOCK_SLOT
+
+
+def test_unstakes_are_skipped_without_reward_tokens(chained):
+    # a wallet holding only ADA
+    (payment,) = [
+        u for u in chained.context.utxo_list if u.output.address == PAYMENT_ADDRESS
+    ]
+    payment.output.amount = Value(payment.output.amount.coin)
+    book = make_book(chained)
+    worker = make_worker(chained)
+    worker.check_wallet(book)
+    assert len(worker.batch(book, [POOL_ID])) == 2
+    applied = set().union(*(batch.orders for batch in worker.submitted))
+    assert applied == {
+        out_ref(o.utxo) for o in book.pending_orders(POOL_ID) if o.is_stake
+    }
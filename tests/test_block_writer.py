@@ -0,0 +1,90 @@
+"""
+Bulk and direct writes of the chain querier, which need to store the same rows.
+"""
+
+from peewee import ForeignKeyField
+from pycardano import TransactionId, TransactionInput
+
+from muesliswap_onchain_staking.api import ogmios_iterator
+from muesliswap_onchain_staking.api.chain_querier import handle_operation
+from muesliswap_onchain_staking.api.db_models import MODELS, UndoEntry, database
+from muesliswap_onchain_staking.api.tx_processor import TrackedOutputs, to_db
+
+from test_db_queries import POOL_A, T0, make_tx, position_output
+from test_rollback import make_blocks
+
+MODELS_BY_TABLE = {model._meta.table_name: model for model in MODELS}
+
+
+def contents() -> dict:
+    """
+    The rows of all tables without their ids and with references replaced by the referenced rows,
+    so that databases written in a different order can be compared.
+    """
+    described = {}
+
+    def describe(model, row_id) -> tuple:
+        if (model, row_id) not in described:
+            row = model.select().where(model.id == row_id).dicts().get()
+            described[(model, row_id)] = values(model, row)
+        return described[(model, row_id)]
+
+    def values(model, row: dict) -> tuple:
+        result = []
+        for field in model._meta.sorted_fields:
+            value = row[field.name]
+            if field.name == "id":
+                continue
+            if model is UndoEntry and field.name == "row_id":
+                value = describe(MODELS_BY_TABLE[row["table_name"]], value)
+            elif (
+                isinstance(field, ForeignKeyField)
+                and field.rel_field.name == "id"
+                and value is not None
+            ):
+                value = describe(field.rel_model, value)
+            result.append((field.name, value))
+        return tuple(result)
+
+    return {
+        model._meta.table_name: sorted(
+            (values(model, row) for row in model.select().dicts()), key=repr
+        )
+        for model in MODELS
+    }
+
+
+def same_block_spend() -> ogmios_iterator.Rollforward:
+    """
+    A block at slot 31 whose second transaction spends a position created by the first one.
+    """
+    create = make_tx(
+        [position_output(POOL_A, 50, T0 + 5000, 1, 0)],
+        [TransactionInput(TransactionId(bytes(32)), 5)],
+    )
+    spend = make_tx([], [TransactionInput(create.id, 0)])
+    block = {"id": f"{31:064x}", "slot": 31, "height": 31}
+    return ogmios_iterator.Rollforward(
+        ogmios_iterator.Tip(31, block["id"], 31), block, [create, spend]
+    )
+
+
+def sync(blocks: list[ogmios_iterator.Rollforward], bulk: bool):
+    database.drop_tables(MODELS)
+    database.create_tables(MODELS)
+    to_db.clear_caches()
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.load()
+    for block in blocks:
+        handle_operation(block, tracked_outputs, bulk=bulk)
+    return contents(), tracked_outputs.out_refs
+
+
+def test_bulk_and_direct_writes_are_equal(database_url):
+    blocks = make_blocks()[:30] + [same_block_spend()]
+    bulk_contents, bulk_outputs = sync(blocks, bulk=True)
+    direct_contents, direct_outputs = sync(blocks, bulk=False)
+    assert len(bulk_contents["transactionoutput"]) == 1 + 2 * 29 + 1
+    assert len(bulk_contents["currentfarm"]) == 2
+    assert bulk_contents == direct_contents
+    assert bulk_outputs == direct_outputs
@@ -0,0 +1,357 @@
+"""
+The queries of the API on SQLite and PostgreSQL, on farms and staking positions ingested by the chain querier.
+"""
+
+import asyncio
+from dataclasses import dataclass
+
+import pytest
+from opshin.prelude import Token
+from opshin.std.fractions import Fraction
+from pycardano import (
+    Address,
+    MultiAsset,
+    Network,
+    Transaction,
+    TransactionBody,
+    TransactionId,
+    TransactionInput,
+    TransactionOutput,
+    TransactionWitnessSet,
+    Value,
+    VerificationKeyHash,
+)
+
+from muesliswap_onchain_staking.api.chain_querier import process_block
+from muesliswap_onchain_staking.api.config import farm_nft_policy_id, staking_address
+from muesliswap_onchain_staking.api.db_models import Block
+from muesliswap_onchain_staking.api.db_queries import (
+    Page,
+    make_repository,
+    query_farms,
+    query_staking_positions_per_wallet,
+)
+from muesliswap_onchain_staking.api.db_queries.changes import block_changes
+from muesliswap_onchain_staking.api.db_queries.repository import ThreadedRepository
+from muesliswap_onchain_staking.api.tx_processor import TrackedOutputs
+from muesliswap_onchain_staking.api.util import FixedTxHashTransaction
+from muesliswap_onchain_staking.onchain import staking_types
+from muesliswap_onchain_staking.utils.to_script_context import to_address
+
+T0 = 1_700_000_000_000
+STAKE_TOKEN = Token(bytes.fromhex("11" * 28), b"STAKE")
+REWARD_TOKENS = [
+    Token(bytes.fromhex("22" * 28), b"R1"),
+    Token(bytes.fromhex("33" * 28), b"R2"),
+]
+POOL_A = bytes.fromhex("aa" * 32)
+POOL_B = bytes.fromhex("bb" * 32)
+WALLETS = [
+    Address(
+        VerificationKeyHash(bytes([i]) * 28),
+        VerificationKeyHash(bytes([0x40 + i]) * 28),
+        network=Network.TESTNET,
+    )
+    for i in (1, 2)
+]
+WALLET_1, WALLET_2 = (bytes(wallet.to_primitive()).hex() for wallet in WALLETS)
+# pool, staked amount, time of staking and owner of the positions, in the order of their outputs
+POSITIONS = [
+    (POOL_A, 100, T0 + 1000, 0),
+    (POOL_A, 200, T0 + 2000, 0),
+    (POOL_B, 50, T0 + 2000, 0),
+    (POOL_A, 200, T0 + 3000, 0),
+    (POOL_A, 100, T0 + 1000, 1),
+]
+
+
+def farm_output(
+    pool_id: bytes, amount_staked: int, n_rewards: int
+) -> TransactionOutput:
+    datum = staking_types.FarmState(
+        staking_types.FarmParams(pool_id, REWARD_TOKENS[:n_rewards], STAKE_TOKEN),
+        staking_types.DefaultFarmType(),
+        [10**6 * (i + 1) for i in range(n_rewards)],
+        T0,
+        amount_staked,
+        [Fraction(i + 1, 4) for i in range(n_rewards)],
+    )
+    return TransactionOutput(
+        staking_address,
+        Value(
+            2_000_000,
+            MultiAsset.from_primitive({farm_nft_policy_id.payload: {pool_id: 1}}),
+        ),
+        datum=datum,
+    )
+
+
+def position_output(
+    pool_id: bytes, amount: int, staked_since: int, owner: int, index: int
+) -> TransactionOutput:
+    n_rewards = 2 if pool_id == POOL_A else 1
+    datum = staking_types.StakingPosition(
+        to_address(WALLETS[owner]),
+        pool_id,
+        staked_since,
+        index,
+        [Fraction(i, 8) for i in range(n_rewards)],
+    )
+    return TransactionOutput(
+        staking_address,
+        Value(
+            2_000_000,
+            MultiAsset.from_primitive(
+                {STAKE_TOKEN.policy_id: {STAKE_TOKEN.token_name: amount}}
+            ),
+        ),
+        datum=datum,
+    )
+
+
+def make_tx(
+    outputs: list[TransactionOutput], inputs: list[TransactionInput]
+) -> FixedTxHashTransaction:
+    tx = Transaction(
+        TransactionBody(inputs=inputs, outputs=outputs, fee=0), TransactionWitnessSet()
+    )
+    # outputs of transactions decoded from blocks carry their datums undecoded
+    return FixedTxHashTransaction(
+        Transaction.from_cbor(tx.to_cbor()), tx.id.payload.hex()
+    )
+
+
+@dataclass
+class Chain:
+    url: str
+    farms_tx: str
+    positions_tx: str
+
+
+@pytest.fixture
+def chain(database_url) -> Chain:
+    """
+    Two farms created in the block at slot 10, the positions in the block at slot 20,
+    and the position of the second wallet spent in the block at slot 30.
+    """
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.load()
+    farms_tx = make_tx(
+        [farm_output(POOL_A, 500, 2), farm_output(POOL_B, 50, 1)],
+        [TransactionInput(TransactionId(bytes(32)), 0)],
+    )
+    positions_tx = make_tx(
+        [position_output(*position, i) for i, position in enumerate(POSITIONS)],
+        [TransactionInput(TransactionId(bytes(32)), 1)],
+    )
+    spend_tx = make_tx(
+        [],
+        [TransactionInput(positions_tx.id, len(POSITIONS) - 1)],
+    )
+    for slot, txs in ((10, [farms_tx]), (20, [positions_tx]), (30, [spend_tx])):
+        process_block(
+            {"id": f"{slot:064x}", "slot": slot, "height": slot},
+            tracked_outputs,
+            txs=txs,
+        )
+    return Chain(database_url, farms_tx.hash, positions_tx.hash)
+
+
+def query(url: str, method: str, *args):
+    """
+    Run the repository method with the async driver of the database and on worker threads,
+    both need to return the same.
+    """
+
+    async def run(repository):
+        await repository.open()
+        try:
+            return await getattr(repository, method)(*args)
+        finally:
+            await repository.close()
+
+    result = asyncio.run(run(make_repository(url)))
+    assert asyncio.run(run(ThreadedRepository())) == result
+    return result
+
+
+def output_refs(positions: list[dict]) -> list[tuple[str, int]]:
+    # positions are returned once per reward token
+    refs = []
+    for position in positions:
+        ref = (
+            position["output_ref"]["transaction_hash"],
+            position["output_ref"]["output_index"],
+        )
+        if not refs or refs[-1] != ref:
+            refs.append(ref)
+    return refs
+
+
+def test_farms(chain):
+    farms = query(chain.url, "farms")
+    assert [farm["pool_id"] for farm in farms] == [POOL_A.hex(), POOL_B.hex()]
+    assert farms[0]["amount_staked"] == 500
+    assert farms[0]["reward_tokens"] == [
+        {"policy_id": "22" * 28, "asset_name": b"R1".hex(), "idx": "0"},
+        {"policy_id": "33" * 28, "asset_name": b"R2".hex(), "idx": "1"},
+    ]
+    assert farms[0]["emission_rates"] == [
+        {"emission_rate": "1000000", "idx": "0"},
+        {"emission_rate": "2000000", "idx": "1"},
+    ]
+    assert farms[0]["cumulative_rewards_per_token"] == [
+        {"numerator": "1", "denominator": "4", "idx": "0"},
+        {"numerator": "2", "denominator": "4", "idx": "1"},
+    ]
+    assert query_farms() == farms
+
+
+def test_farms_filters(chain):
+    def pools(filters):
+        farms, _ = query(chain.url, "farms_page", filters)
+        return [farm["pool_id"] for farm in farms]
+
+    assert pools({"reward_token": ("33" * 28, b"R2".hex())}) == [POOL_A.hex()]
+    assert pools({"stake_token": ("11" * 28, b"STAKE".hex())}) == [
+        POOL_A.hex(),
+        POOL_B.hex(),
+    ]
+    assert pools({"pool_id": (POOL_B.hex(),)}) == [POOL_B.hex()]
+    assert pools({"farm_type": ("other",)}) == []
+
+
+@pytest.mark.parametrize("sort", ["pool_id", "amount_staked"])
+@pytest.mark.parametrize("descending", [False, True])
+def test_farms_pages(chain, sort, descending):
+    all_farms, _ = query(chain.url, "farms_page", {}, Page(100, sort, descending))
+    farms, cursor = [], None
+    while True:
+        page = Page.from_cursor(1, sort, descending, cursor)
+        items, cursor = query(chain.url, "farms_page", {}, page)
+        farms.extend(items)
+        if cursor is None:
+            break
+    assert farms == all_farms
+    assert len(farms) == 2
+
+
+@pytest.mark.parametrize("sort", ["staked_since", "amount_staked"])
+@pytest.mark.parametrize("descending", [False, True])
+def test_staking_positions_pages(chain, sort, descending):
+    all_positions, cursor = query(
+        chain.url,
+        "staking_positions_page",
+        "address_raw",
+        [WALLET_1],
+        None,
+        Page(100, sort, descending),
+    )
+    assert cursor is None
+    assert len(output_refs(all_positions)) == 4
+    positions, cursor = [], None
+    while True:
+        page = Page.from_cursor(2, sort, descending, cursor)
+        items, cursor = query(
+            chain.url, "staking_positions_page", "address_raw", [WALLET_1], None, page
+        )
+        positions.extend(items)
+        if cursor is None:
+            break
+    assert positions == all_positions
+
+
+def test_staking_positions_of_farm(chain):
+    positions, _ = query(
+        chain.url, "staking_positions_page", "address_raw", [WALLET_1], POOL_B.hex()
+    )
+    assert output_refs(positions) == [(chain.positions_tx, 2)]
+
+
+def test_staking_positions_per_wallet(chain):
+    positions = query(chain.url, "staking_positions_per_wallet", WALLET_1)
+    # ordered by time of staking and batching output index
+    assert output_refs(positions) == [(chain.positions_tx, i) for i in (0, 1, 2, 3)]
+    assert positions[0]["pool_id"] == POOL_A.hex()
+    assert positions[0]["address"] == WALLET_1
+    assert positions[1]["cumulative_pool_rpts_at_start"] == {
+        "numerator": 1,
+        "denominator": 8,
+    }
+    assert query_staking_positions_per_wallet(WALLET_1) == positions
+    # the position of the second wallet is spent
+    assert query(chain.url, "staking_positions_per_wallet", WALLET_2) == []
+    assert (
+        query(chain.url, "staking_positions_per_wallets", [WALLET_2, WALLET_1])
+        == positions
+    )
+
+
+def test_staking_positions_per_credentials(chain):
+    payment_credential = WALLETS[0].payment_part.payload.hex()
+    stake_credential = WALLETS[0].staking_part.payload.hex()
+    positions = query(chain.url, "staking_positions_per_wallet", WALLET_1)
+    assert (
+        query(
+            chain.url,
+            "staking_positions_per_credentials",
+            "payment_credential",
+            [payment_credential],
+        )
+        == positions
+    )
+    assert (
+        query(
+            chain.url,
+            "staking_positions_per_credentials",
+            "stake_credential",
+            [stake_credential, "00" * 28],
+        )
+        == positions
+    )
+
+
+def test_position_stakes(chain):
+    stakes = query(chain.url, "position_stakes_per_farm", POOL_A.hex())
+    assert [(p["output_ref"]["output_index"], p["staked_amount"]) for p in stakes] == [
+        (0, 100),
+        (1, 200),
+        (3, 200),
+    ]
+    assert stakes[0]["cumulative_pool_rpts_at_start"] == [(0, 8), (1, 8)]
+    stakes = query(chain.url, "position_stakes_per_wallet", WALLET_1)
+    assert len(stakes) == 4
+
+
+def test_farm_history(chain):
+    snapshots = query(chain.url, "farm_history", POOL_A.hex(), T0, T0 + 1)
+    assert len(snapshots) == 1
+    assert snapshots[0]["time"] == T0
+    assert snapshots[0]["amount_staked"] == 500
+    assert snapshots[0]["emission_rates"] == [1_000_000, 2_000_000]
+    assert query(chain.url, "farm_history", POOL_A.hex(), T0 + 1, T0 + 2) == []
+
+
+def test_blocks(chain):
+    assert query(chain.url, "latest_block") == {
+        "slot": 30,
+        "height": 30,
+        "hash": f"{30:064x}",
+    }
+    assert query(chain.url, "block_exists", f"{20:064x}")
+    assert not query(chain.url, "block_exists", f"{40:064x}")
+    assert query(chain.url, "wallets_changed_since", 20) == {WALLET_2}
+    assert query(chain.url, "wallets_changed_since", 10) == {WALLET_1, WALLET_2}
+
+
+def test_block_changes(chain):
+    changes = block_changes(Block.get(Block.slot == 10))
+    assert [farm["pool_id"] for farm in changes["farms"]] == [
+        POOL_A.hex(),
+        POOL_B.hex(),
+    ]
+    changes = block_changes(Block.get(Block.slot == 30))
+    assert changes["farms"] == []
+    assert output_refs(changes["positions_spent"]) == [
+        (chain.positions_tx, len(POSITIONS) - 1)
+    ]
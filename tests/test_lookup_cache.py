@@ -0,0 +1,100 @@
+"""
+The lookup caches of the chain querier, which must not outlive the rows they refer to.
+"""
+
+import pytest
+from pycardano import TransactionId, TransactionInput
+
+from muesliswap_onchain_staking.api import chain_querier, ogmios_iterator
+from muesliswap_onchain_staking.api.chain_querier import handle_operation
+from muesliswap_onchain_staking.api.db_models import Address
+from muesliswap_onchain_staking.api.tx_processor import TrackedOutputs, to_db
+from muesliswap_onchain_staking.api.tx_processor.lookup_cache import LRUCache
+
+from test_db_queries import POOL_A, T0, WALLETS, make_tx, position_output
+from test_rollback import make_blocks
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    # "b" is the least recently used entry now
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {
+        "hits": 2,
+        "misses": 1,
+        "hit_rate": 2 / 3,
+        "size": 2,
+        "maxsize": 2,
+    }
+    cache.clear()
+    assert "a" not in cache
+    assert cache.stats()["hits"] == 2
+    cache.clear(reset_stats=True)
+    assert cache.stats()["hits"] == cache.stats()["misses"] == 0
+
+
+def second_wallet_block(slot: int) -> ogmios_iterator.Rollforward:
+    """
+    A block with a position of the second wallet, whose owner address is not stored yet.
+    """
+    tx = make_tx(
+        [position_output(POOL_A, 100, T0 + 5000, 1, 0)],
+        [TransactionInput(TransactionId(bytes(32)), 7)],
+    )
+    block = {"id": f"{slot:064x}", "slot": slot, "height": slot}
+    return ogmios_iterator.Rollforward(
+        ogmios_iterator.Tip(slot, block["id"], slot), block, [tx]
+    )
+
+
+def second_wallet_address():
+    return Address.get_or_none(
+        Address.address_raw == bytes(WALLETS[1].to_primitive()).hex()
+    )
+
+
+def test_caches_are_cleared_after_a_failed_block(database_url, monkeypatch):
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.load()
+    for block in make_blocks()[:3]:
+        handle_operation(block, tracked_outputs)
+    process_tx = chain_querier.process_tx
+
+    def failing_process_tx(*args):
+        process_tx(*args)
+        raise RuntimeError("failed after processing the transaction")
+
+    monkeypatch.setattr(chain_querier, "process_tx", failing_process_tx)
+    with pytest.raises(RuntimeError):
+        handle_operation(second_wallet_block(4), tracked_outputs)
+    assert second_wallet_address() is None
+    assert to_db.cache_stats()["address"]["size"] == 0
+    assert to_db.cache_stats()["datum"]["size"] == 0
+
+    # a cached row of the failed block would now be referenced without existing
+    monkeypatch.setattr(chain_querier, "process_tx", process_tx)
+    handle_operation(second_wallet_block(4), tracked_outputs)
+    assert second_wallet_address() is not None
+
+
+def test_caches_are_cleared_by_a_rollback(database_url):
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.load()
+    for block in make_blocks()[:3] + [second_wallet_block(4)]:
+        handle_operation(block, tracked_outputs)
+    assert to_db.cache_stats()["address"]["size"] > 0
+    handle_operation(
+        ogmios_iterator.Rollback(ogmios_iterator.Point(3, f"{3:064x}")),
+        tracked_outputs,
+    )
+    assert all(stats["size"] == 0 for stats in to_db.cache_stats().values())
+    # the rows are looked up again when the block is synced again
+    handle_operation(second_wallet_block(4), tracked_outputs)
+    assert to_db.cache_stats()["address"]["misses"] > 0
+    assert second_wallet_address() is not None
@@ -0,0 +1,183 @@
+"""
+The pipelined ogmios iterator, which decodes blocks in parallel but yields them in the order they were received.
+"""
+
+import itertools
+import json
+import threading
+from concurrent.futures import Future
+
+import pytest
+import websocket
+from pycardano import TransactionId, TransactionInput
+
+from muesliswap_onchain_staking.api import ogmios_iterator
+from muesliswap_onchain_staking.api.tx_filter import default_tx_filter
+
+from test_db_queries import POOL_A, T0, make_tx, position_output
+from test_tx_filter import wallet_output
+
+
+class FakeWebSocket:
+    """
+    Answers the intersection and then replays the messages, as if they were received from ogmios.
+    """
+
+    messages: list[str] = []
+
+    def __init__(self):
+        self.sent = []
+        self.received = iter([json.dumps({"result": {"intersection": "origin"}})])
+        self.closed = threading.Event()
+
+    def connect(self, url: str):
+        self.received = itertools.chain(self.received, self.messages)
+
+    def send(self, message: str):
+        self.sent.append(json.loads(message)["method"])
+
+    def recv(self) -> str:
+        message = next(self.received, None)
+        if message is None:
+            self.closed.wait()
+            raise websocket.WebSocketConnectionClosedException()
+        return message
+
+    def close(self):
+        self.closed.set()
+
+
+class ReversingPool:
+    """
+    Completes the submitted decodings in the reverse order, once all messages were submitted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.submitted = []
+        self.completed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, fn, *args) -> Future:
+        future = Future()
+        self.submitted.append((future, fn, args))
+        if len(self.submitted) == len(FakeWebSocket.messages):
+            for i, (submitted, fn, args) in reversed(list(enumerate(self.submitted))):
+                submitted.set_result(fn(*args))
+                self.completed.append(i)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+def forward(slot: int, n_txs: int) -> str:
+    """
+    A block with a staking position and `n_txs - 1` unrelated transactions.
+    """
+    txs = [
+        make_tx(
+            [position_output(POOL_A, 100, T0 + slot, 0, 0)],
+            [TransactionInput(TransactionId(bytes(32)), slot)],
+        )
+    ] + [
+        make_tx([wallet_output()], [TransactionInput(TransactionId(bytes(32)), i)])
+        for i in range(1, n_txs)
+    ]
+    tip = {"slot": slot, "id": f"{slot:064x}", "height": slot}
+    block = {
+        "type": "praos",
+        **tip,
+        "transactions": [
+            {"id": tx.hash, "cbor": tx.transaction.to_cbor_hex()} for tx in txs
+        ],
+    }
+    return json.dumps({"result": {"direction": "forward", "tip": tip, "block": block}})
+
+
+def backward(slot: int) -> str:
+    point = {"slot": slot, "id": f"{slot:064x}"}
+    return json.dumps(
+        {"result": {"direction": "backward", "point": point, "tip": point}}
+    )
+
+
+MESSAGES = [
+    forward(1, 20),
+    forward(2, 1),
+    forward(3, 10),
+    backward(2),
+    forward(3, 1),
+    backward(0),
+    forward(1, 5),
+]
+
+
+def summary(result: ogmios_iterator.NextBlockResult) -> tuple:
+    if isinstance(result, ogmios_iterator.Rollback):
+        return "rollback", result.tip.slot
+    return "block", result.tip.slot, len(result.txs)
+
+
+def expected() -> list[tuple]:
+    return [
+        summary(ogmios_iterator.decode_next_block(message, default_tx_filter()))
+        for message in MESSAGES
+    ]
+
+
+def iterate(
+    in_flight: int, workers: int = None
+) -> list[ogmios_iterator.NextBlockResult]:
+    iterator = ogmios_iterator.PipelinedOgmiosIterator(
+        "ws://ogmios", in_flight, workers, default_tx_filter()
+    )
+    blocks = iterator.iterate_blocks([])
+    results = list(itertools.islice(blocks, len(MESSAGES)))
+    blocks.close()
+    assert iterator.ws.closed.is_set()
+    assert iterator.ws.sent[0] == "findIntersection"
+    return results
+
+
+@pytest.fixture
+def fake_ogmios(monkeypatch):
+    monkeypatch.setattr(FakeWebSocket, "messages", MESSAGES)
+    monkeypatch.setattr(ogmios_iterator.websocket, "WebSocket", FakeWebSocket)
+
+
+def test_results_are_yielded_in_receive_order(fake_ogmios, monkeypatch):
+    pools = []
+
+    def make_pool(*args, **kwargs):
+        pools.append(ReversingPool())
+        return pools[-1]
+
+    monkeypatch.setattr(ogmios_iterator, "ProcessPoolExecutor", make_pool)
+    results = iterate(in_flight=len(MESSAGES))
+    assert pools[0].completed == list(reversed(range(len(MESSAGES))))
+    assert [summary(result) for result in results] == expected()
+    # the decoded transactions replace the raw ones
+    assert all(
+        "transactions" not in result.block
+        for result in results
+        if isinstance(result, ogmios_iterator.Rollforward)
+    )
+
+
+def test_results_of_worker_processes(fake_ogmios):
+    """
+    The first block has the most transactions to decode, so later blocks are usually done first.
+    """
+    results = iterate(in_flight=2, workers=2)
+    assert [summary(result) for result in results] == expected()
+    first = results[0]
+    assert isinstance(first.txs[0], ogmios_iterator.FixedTxHashTransaction)
+    assert first.txs[0].transaction.transaction_body.outputs[0].amount.coin == 2_000_000
+    assert all(
+        isinstance(tx, ogmios_iterator.UndecodedTransaction) for tx in first.txs[1:]
+    )
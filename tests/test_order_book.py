@@ -0,0 +1,130 @@
+"""
+Blocks applied to and rolled back from the order book of the resident batcher.
+"""
+
+from pycardano import (
+    Transaction,
+    TransactionBody,
+    TransactionInput,
+    TransactionOutput,
+    TransactionWitnessSet,
+    Value,
+)
+
+from muesliswap_onchain_staking.offchain.order_book import OrderBook, out_ref
+from muesliswap_onchain_staking.onchain import batching
+
+from test_batch_orders import (
+    BATCHING_ADDRESS,
+    FARM_NFT_POLICY_ID,
+    LAST_BLOCK_SLOT,
+    OWNER,
+    POOL_ID,
+    STAKING_ADDRESS,
+    chain,
+    stake_token,
+    tx_id,
+)
+
+NEW_ORDER_TX = tx_id(200).payload
+
+
+def make_book(chain, journal_size: int = 2160) -> OrderBook:
+    book = OrderBook(
+        FARM_NFT_POLICY_ID, BATCHING_ADDRESS, STAKING_ADDRESS, journal_size
+    )
+    book.load(chain.context.utxo_list, LAST_BLOCK_SLOT)
+    return book
+
+
+def pending(book: OrderBook) -> list[tuple[bytes, int]]:
+    return [out_ref(o.utxo) for o in book.pending_orders(POOL_ID)]
+
+
+def spend(*spent: int, outputs=(), valid: bool = True) -> Transaction:
+    tx = Transaction(
+        TransactionBody(
+            inputs=[TransactionInput(tx_id(i), 0) for i in spent],
+            outputs=list(outputs),
+            fee=0,
+        ),
+        TransactionWitnessSet(),
+    )
+    tx.valid = valid
+    return tx
+
+
+def blocks() -> list[tuple[int, list[tuple[bytes, Transaction]]]]:
+    """
+    The first stake order and the first unstake order are spent in the first block,
+    next to a failed transaction spending the second stake order.
+    A new stake order is placed in the second block
+    and the staking position of the second unstake order is spent in the third block.
+    """
+    new_order = TransactionOutput(
+        BATCHING_ADDRESS,
+        Value(3_000_000, stake_token(400)),
+        datum=batching.StakeOrder(OWNER, POOL_ID),
+    )
+    return [
+        (
+            LAST_BLOCK_SLOT + 1,
+            [
+                (tx_id(201).payload, spend(22, valid=False)),
+                (tx_id(202).payload, spend(20, 21)),
+            ],
+        ),
+        (
+            LAST_BLOCK_SLOT + 2,
+            [(NEW_ORDER_TX, spend(100, outputs=[new_order]))],
+        ),
+        (LAST_BLOCK_SLOT + 3, [(tx_id(203).payload, spend(11))]),
+    ]
+
+
+def test_roll_back_within_the_journal(chain):
+    book = make_book(chain)
+    loaded = pending(book)
+    assert loaded == [(tx_id(i).payload, 0) for i in (20, 21, 22, 23, 24)]
+    after_block = []
+    for slot, txs in blocks():
+        book.roll_forward(slot, txs)
+        after_block.append(pending(book))
+    assert after_block == [
+        [(tx_id(i).payload, 0) for i in (22, 23, 24)],
+        [(tx_id(i).payload, 0) for i in (22, 23, 24)] + [(NEW_ORDER_TX, 0)],
+        # the unstake order of a spent position is not pending anymore
+        [(tx_id(i).payload, 0) for i in (22, 24)] + [(NEW_ORDER_TX, 0)],
+    ]
+    assert (tx_id(11).payload, 0) not in book.positions
+
+    assert book.roll_back(LAST_BLOCK_SLOT + 2)
+    assert pending(book) == after_block[1]
+    assert book.positions[(tx_id(11).payload, 0)] == POOL_ID
+    # the unstake order comes with its restored staking position
+    unstake = book.pending_orders(POOL_ID)[1]
+    assert out_ref(unstake.position) == (tx_id(11).payload, 0)
+
+    assert book.roll_back(LAST_BLOCK_SLOT)
+    assert pending(book) == loaded
+    assert book.farm(POOL_ID) is not None
+    # the rolled back blocks can be applied again
+    for slot, txs in blocks():
+        book.roll_forward(slot, txs)
+    assert pending(book) == after_block[-1]
+
+
+def test_roll_back_beyond_the_horizon(chain):
+    book = make_book(chain, journal_size=2)
+    loaded = pending(book)
+    # the blocks are behind the loaded UTxOs
+    assert not book.roll_back(LAST_BLOCK_SLOT - 1)
+    for slot, txs in blocks():
+        book.roll_forward(slot, txs)
+    # the first block dropped out of the journal
+    assert book.roll_back(LAST_BLOCK_SLOT + 1)
+    assert pending(book) == [(tx_id(i).payload, 0) for i in (22, 23, 24)]
+    assert not book.roll_back(LAST_BLOCK_SLOT)
+    assert not book.roll_back(None)
+    book.load(chain.context.utxo_list, LAST_BLOCK_SLOT)
+    assert pending(book) == loaded
@@ -0,0 +1,11 @@
+from muesliswap_onchain_staking.api.db_queries.query_plans import check_query_plans
+
+
+def test_queries_are_served_by_indexes(sqlite_database):
+    scans = check_query_plans()
+    assert {
+        "query_farms_0",
+        "query_staking_positions_per_wallet",
+        "mark_spent",
+    } <= scans.keys()
+    assert {name: steps for name, steps in scans.items() if steps} == {}
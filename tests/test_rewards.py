@@ -0,0 +1,78 @@
+import time
+
+import pytest
+from opshin.std.fractions import Fraction
+
+from muesliswap_onchain_staking.api.db_queries.util import to_str
+from muesliswap_onchain_staking.api.rewards import FarmRewards, to_posix_millis
+from muesliswap_onchain_staking.api.tx_processor.to_db import to_datetime
+from muesliswap_onchain_staking.onchain.staking import (
+    compute_updated_cumulative_rewards_per_token,
+)
+from muesliswap_onchain_staking.onchain.util import floor_scale_fraction
+
+T0 = 1_700_000_000_123
+
+FARMS = [
+    # emission rates, amount staked, cumulative rewards per token
+    ([10**6], 1, [(0, 1)]),
+    ([1_000_000, 7], 123_456_789, [(3, 7), (11, 13)]),
+    ([2**40, 0, 999], 10**15, [(1, 3), (0, 1), (5, 2)]),
+    ([500], 0, [(2, 9)]),
+]
+
+
+@pytest.mark.parametrize("emission_rates,amount_staked,cumulative", FARMS)
+@pytest.mark.parametrize("elapsed", [1, 59_999, 86_400_000, 123 * 86_400_000 + 17])
+def test_rewards_match_contract(emission_rates, amount_staked, cumulative, elapsed):
+    farm = FarmRewards(
+        pool_id="00",
+        reward_tokens=[{} for _ in emission_rates],
+        emission_rates=emission_rates,
+        last_update_time=T0,
+        amount_staked=amount_staked,
+        cumulative_rewards_per_token=cumulative,
+    )
+    expected = compute_updated_cumulative_rewards_per_token(
+        [Fraction(n, d) for n, d in cumulative],
+        emission_rates,
+        amount_staked,
+        T0,
+        T0 + elapsed,
+    )
+    assert farm.cumulative_rewards_per_token_at(T0 + elapsed) == [
+        (f.numerator, f.denominator) for f in expected
+    ]
+    # positions staked before and at the last update, paid out as the contract checks on unstaking
+    starts = [(0, 1)] * len(cumulative), cumulative
+    positions = [(amount, start) for amount in (1, 999, 10**12) for start in starts]
+    assert farm.claimable_rewards(positions, T0 + elapsed) == [
+        [
+            floor_scale_fraction(current, amount)
+            - floor_scale_fraction(Fraction(*start[i]), amount)
+            for i, current in enumerate(expected)
+        ]
+        for amount, start in positions
+    ]
+
+
+@pytest.fixture
+def restore_timezone(monkeypatch):
+    yield monkeypatch
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize(
+    "written_in,read_in", [("UTC", "Asia/Tokyo"), ("America/New_York", "UTC")]
+)
+def test_stored_times_do_not_depend_on_timezone(restore_timezone, written_in, read_in):
+    restore_timezone.setenv("TZ", written_in)
+    time.tzset()
+    stored = to_datetime(T0)
+    restore_timezone.setenv("TZ", read_in)
+    time.tzset()
+    # SQLite returns the stored string, PostgreSQL a datetime
+    assert to_posix_millis(to_str(stored)) == T0
+    assert to_posix_millis(stored) == T0
+    assert to_str(stored) == "2023-11-14 22:13:20.123000"
@@ -0,0 +1,105 @@
+"""
+Rollbacks of the chain querier, compared to the database synced only up to the rollback point.
+"""
+
+import pytest
+from pycardano import TransactionId, TransactionInput
+
+from muesliswap_onchain_staking.api import ogmios_iterator
+from muesliswap_onchain_staking.api.chain_querier import handle_operation
+from muesliswap_onchain_staking.api.db_models import (
+    MODELS,
+    Address,
+    CurrentFarm,
+    CurrentStakingPosition,
+    Datum,
+    FarmParams,
+    StakingParams,
+    Token,
+)
+from muesliswap_onchain_staking.api.tx_processor import TrackedOutputs
+
+from test_db_queries import (
+    POOL_A,
+    POOL_B,
+    T0,
+    farm_output,
+    make_tx,
+    position_output,
+)
+
+N_BLOCKS = 150
+# addresses, datums and tokens are shared rows that are kept on rollbacks
+COMPARED_MODELS = [m for m in MODELS if m not in (Address, Datum, Token)]
+# rows of the current state tables are inserted again for outputs that are unspent by a rollback
+CURRENT_STATE_MODELS = (CurrentFarm, CurrentStakingPosition)
+
+
+def make_blocks() -> list[ogmios_iterator.Rollforward]:
+    """
+    Farm B is created in the block at slot 1. Farm A and a staking position are created in the
+    block at slot 2 and re-created with the same datum by every later block, except for the
+    amount staked of the farm which changes every 50 blocks, so that params are shared between blocks.
+    """
+    blocks = []
+    inputs = [TransactionInput(TransactionId(bytes(32)), 0)]
+    txs = [make_tx([farm_output(POOL_B, 50, 1)], inputs)]
+    for slot in range(1, N_BLOCKS + 1):
+        if slot > 1:
+            tx = make_tx(
+                [
+                    farm_output(POOL_A, 500 + 100 * (slot // 50), 2),
+                    position_output(POOL_A, 100, T0 + 1000, 0, 1),
+                ],
+                inputs,
+            )
+            inputs = [TransactionInput(tx.id, 0), TransactionInput(tx.id, 1)]
+            txs = [tx]
+        block = {"id": f"{slot:064x}", "slot": slot, "height": slot}
+        blocks.append(
+            ogmios_iterator.Rollforward(
+                ogmios_iterator.Tip(slot, block["id"], slot), block, txs
+            )
+        )
+    return blocks
+
+
+def snapshot() -> dict:
+    tables = {}
+    for model in COMPARED_MODELS:
+        if model in CURRENT_STATE_MODELS:
+            fields = [f for f in model._meta.sorted_fields if f.name != "id"]
+            query = model.select(*fields).order_by(model.transaction_output)
+        else:
+            query = model.select().order_by(model.id)
+        tables[model._meta.table_name] = list(query.dicts())
+    return tables
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_rollback_equals_sync_to_the_rollback_point(database_url, bulk):
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.load()
+    # a shallow rollback, then one over more than 100 blocks down to the block before farm A
+    rollback_slots = [120, 1]
+    expected = {}
+    for block in make_blocks():
+        handle_operation(block, tracked_outputs, bulk=bulk)
+        if block.tip.slot in rollback_slots:
+            expected[block.tip.slot] = (snapshot(), set(tracked_outputs.out_refs))
+    # params are shared by the blocks on both sides of the rollback points
+    assert FarmParams.select().count() == 5
+    assert StakingParams.select().count() == 1
+
+    for slot in rollback_slots:
+        handle_operation(
+            ogmios_iterator.Rollback(ogmios_iterator.Point(slot, f"{slot:064x}")),
+            tracked_outputs,
+            bulk=bulk,
+        )
+        assert (snapshot(), tracked_outputs.out_refs) == expected[slot]
+
+    # the reverted blocks can be synced again
+    for block in make_blocks()[1:]:
+        handle_operation(block, tracked_outputs, bulk=bulk)
+    assert FarmParams.select().count() == 5
@@ -0,0 +1,236 @@
+"""
+Response caching, conditional requests, the batch endpoint and the change stream of the API server.
+"""
+
+import asyncio
+
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from pycardano import TransactionId, TransactionInput
+
+from muesliswap_onchain_staking.api import server
+from muesliswap_onchain_staking.api.chain_querier import process_block
+from muesliswap_onchain_staking.api.chain_tip import ChainTip, WalletMarkers
+from muesliswap_onchain_staking.api.change_feed import ChangeFeed
+from muesliswap_onchain_staking.api.db_queries import make_repository
+from muesliswap_onchain_staking.api.response_cache import ResponseCache
+from muesliswap_onchain_staking.api.tx_processor import TrackedOutputs
+
+from test_db_queries import (
+    POOL_A,
+    POOL_B,
+    T0,
+    WALLET_1,
+    WALLET_2,
+    WALLETS,
+    chain,
+    farm_output,
+    make_tx,
+    position_output,
+)
+
+POOL_C = bytes.fromhex("cc" * 32)
+
+
+@pytest.fixture
+def client(chain, monkeypatch):
+    """
+    A client of the API server on the database of the chain.
+    """
+    repository = make_repository(chain.url)
+    chain_tip = ChainTip(repository)
+    monkeypatch.setattr(server, "repository", repository)
+    monkeypatch.setattr(server, "chain_tip", chain_tip)
+    monkeypatch.setattr(server, "wallet_markers", WalletMarkers(repository))
+    monkeypatch.setattr(server, "response_cache", ResponseCache(chain_tip))
+    monkeypatch.setattr(server, "change_feed", ChangeFeed())
+    with TestClient(server.app) as client:
+        yield client
+
+
+def add_block(client: TestClient):
+    """
+    Process the block at slot 40, creating farm C and a position of the second wallet,
+    and let the server see the new tip.
+    """
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.load()
+    tx = make_tx(
+        [farm_output(POOL_C, 10, 1), position_output(POOL_A, 300, T0 + 4000, 1, 1)],
+        [TransactionInput(TransactionId(bytes(32)), 2)],
+    )
+    process_block(
+        {"id": f"{40:064x}", "slot": 40, "height": 40}, tracked_outputs, txs=[tx]
+    )
+    assert client.portal.call(server.chain_tip.poll)
+
+
+def pool_ids(response) -> list[str]:
+    return [farm["pool_id"] for farm in response.json()]
+
+
+def test_farms_are_cached(client):
+    first = client.get("/api/v1/farms")
+    assert pool_ids(first) == [POOL_A.hex(), POOL_B.hex()]
+    second = client.get("/api/v1/farms")
+    assert second.content == first.content
+    assert server.response_cache.stats()["hits"] == 1
+    assert server.response_cache.stats()["misses"] == 1
+
+
+def test_cache_is_invalidated_by_a_new_tip(client):
+    before = client.get("/api/v1/farms")
+    add_block(client)
+    after = client.get("/api/v1/farms")
+    assert pool_ids(after) == [POOL_A.hex(), POOL_B.hex(), POOL_C.hex()]
+    assert after.headers["ETag"] != before.headers["ETag"]
+    assert server.response_cache.stats()["misses"] == 2
+
+
+def test_concurrent_misses_are_computed_once(client):
+    calls = []
+
+    async def compute():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        return {"value": 1}
+
+    async def get_concurrently():
+        return await asyncio.gather(
+            *(server.response_cache.get("single-flight", compute) for _ in range(5))
+        )
+
+    bodies = client.portal.call(get_concurrently)
+    assert bodies == [b'{"value":1}'] * 5
+    assert len(calls) == 1
+
+
+def test_farms_not_modified(client):
+    response = client.get("/api/v1/farms")
+    etag = response.headers["ETag"]
+    assert etag == f'"{30:064x}"'
+    response = client.get("/api/v1/farms", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+    # farms are tagged with the tip, any new block changes the tag
+    add_block(client)
+    response = client.get("/api/v1/farms", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_staking_positions_not_modified(client):
+    def get(wallet, etag=None):
+        return client.get(
+            "/api/v1/staking/positions",
+            params={"wallet": wallet},
+            headers={"If-None-Match": etag} if etag else {},
+        )
+
+    etags = {wallet: get(wallet).headers["ETag"] for wallet in (WALLET_1, WALLET_2)}
+    assert get(WALLET_1, etags[WALLET_1]).status_code == 304
+    # the new block only changes the positions of the second wallet
+    add_block(client)
+    assert get(WALLET_1, etags[WALLET_1]).status_code == 304
+    response = get(WALLET_2, etags[WALLET_2])
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etags[WALLET_2]
+    assert response.json()["items"][0]["staked_since"] is not None
+
+
+def test_staking_positions_batch(client):
+    unknown_wallet = "00" * 29
+    response = client.post(
+        "/api/v1/staking/positions",
+        json={
+            "wallets": [WALLET_1, unknown_wallet],
+            "stake_key_hashes": [WALLETS[0].staking_part.payload.hex(), "00" * 28],
+        },
+    )
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    lines = [orjson.loads(line) for line in response.content.splitlines()]
+    assert [(line.get("wallet"), line.get("stake_key_hash")) for line in lines] == [
+        (WALLET_1, None),
+        (unknown_wallet, None),
+        (None, WALLETS[0].staking_part.payload.hex()),
+        (None, "00" * 28),
+    ]
+    positions = client.get(
+        "/api/v1/staking/positions", params={"wallet": WALLET_1}
+    ).json()["items"]
+    assert [line["items"] for line in lines] == [positions, [], positions, []]
+    assert [line["count"] for line in lines] == [len(positions), 0, len(positions), 0]
+
+
+def test_stream_event(monkeypatch):
+    """
+    The test client waits for the end of the response, so the endless stream is read
+    by calling the application directly.
+    """
+    monkeypatch.setattr(server, "change_feed", ChangeFeed())
+    event = {
+        "type": "block",
+        "slot": 40,
+        "farms": [],
+        "positions_created": [{"address": WALLET_1}, {"address": WALLET_2}],
+        "positions_spent": [],
+    }
+
+    async def read_event() -> tuple[dict, bytes]:
+        messages = []
+        disconnected = asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+            if message.get("body"):
+                disconnected.set()
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/api/v1/stream",
+            "raw_path": b"/api/v1/stream",
+            "query_string": f"wallets={WALLET_1}".encode(),
+            "headers": [],
+            "client": ("test", 0),
+            "server": ("test", 80),
+            "root_path": "",
+        }
+        app = asyncio.create_task(server.app(scope, receive, send))
+        while not server.change_feed.active:
+            await asyncio.sleep(0.01)
+        server.change_feed.publish(event)
+        await asyncio.wait_for(app, timeout=5)
+        return messages[0], b"".join(m.get("body", b"") for m in messages[1:])
+
+    start, body = asyncio.run(read_event())
+    assert (b"content-type", b"text/event-stream; charset=utf-8") in start["headers"]
+    name, data = body.decode().strip().split("\n")
+    assert name == "event: block"
+    # only the positions of the subscribed wallet
+    assert orjson.loads(data.removeprefix("data: ")) == {
+        **event,
+        "positions_created": [{"address": WALLET_1}],
+    }
+
+
+def test_farm_rewards_export(client):
+    response = client.get(f"/api/v1/farms/{POOL_A.hex()}/rewards", params={"at": T0})
+    lines = [orjson.loads(line) for line in response.content.splitlines()]
+    assert [line["output_ref"]["output_index"] for line in lines] == [0, 1, 3]
+    assert all(len(line["claimable_rewards"]) == 2 for line in lines)
+    response = client.get(f"/api/v1/farms/{'dd' * 32}/rewards")
+    assert response.status_code == 404
@@ -0,0 +1,56 @@
+"""
+The in-memory set of unspent outputs of the chain querier.
+"""
+
+from muesliswap_onchain_staking.api import ogmios_iterator
+from muesliswap_onchain_staking.api.chain_querier import handle_operation
+from muesliswap_onchain_staking.api.tx_processor import TrackedOutputs
+
+from test_rollback import make_blocks
+
+
+def test_add_and_spend():
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.add(("aa", 0))
+    tracked_outputs.add(("aa", 0))
+    tracked_outputs.add(("aa", 1))
+    tracked_outputs.add(("bb", 0))
+    assert len(tracked_outputs) == 3
+    assert tracked_outputs.spends_any(["cc", "aa"])
+    # untracked and repeated inputs are skipped
+    assert sorted(tracked_outputs.spend([("aa", 0), ("aa", 0), ("cc", 0)])) == [
+        ("aa", 0)
+    ]
+    assert ("aa", 0) not in tracked_outputs
+    assert tracked_outputs.spends_any(["aa"])
+    tracked_outputs.spend([("aa", 1)])
+    assert not tracked_outputs.spends_any(["aa"])
+    assert tracked_outputs.spends_any(["bb"])
+    assert tracked_outputs.spend([("aa", 1)]) == []
+
+
+def test_reload_after_rollback(database_url):
+    blocks = make_blocks()[:5]
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.load()
+    for block in blocks[:3]:
+        handle_operation(block, tracked_outputs)
+    at_slot_3 = set(tracked_outputs.out_refs)
+    for block in blocks[3:]:
+        handle_operation(block, tracked_outputs)
+    # the farm and position of block 3 are spent, those of block 5 are unspent
+    spent = {(blocks[2].txs[0].hash, i) for i in (0, 1)}
+    assert not spent & tracked_outputs.out_refs
+    reloaded = TrackedOutputs()
+    reloaded.load()
+    assert reloaded.out_refs == tracked_outputs.out_refs
+    assert reloaded.tx_hashes == tracked_outputs.tx_hashes
+
+    handle_operation(
+        ogmios_iterator.Rollback(ogmios_iterator.Point(3, f"{3:064x}")),
+        tracked_outputs,
+    )
+    assert tracked_outputs.out_refs == at_slot_3
+    assert spent <= tracked_outputs.out_refs
+    assert tracked_outputs.spends_any([blocks[2].txs[0].hash])
+    assert not tracked_outputs.spends_any([blocks[4].txs[0].hash])
@@ -0,0 +1,113 @@
+"""
+The pre-filter that skips decoding transactions irrelevant to the chain querier.
+"""
+
+from pycardano import (
+    Address,
+    MultiAsset,
+    Network,
+    TransactionId,
+    TransactionInput,
+    TransactionOutput,
+    Value,
+    VerificationKeyHash,
+)
+
+from muesliswap_onchain_staking.api import ogmios_iterator
+from muesliswap_onchain_staking.api.chain_querier import relevant_txs
+from muesliswap_onchain_staking.api.config import batching_address, staking_address
+from muesliswap_onchain_staking.api.tx_filter import default_tx_filter, input_tx_hashes
+from muesliswap_onchain_staking.api.tx_processor import TrackedOutputs
+from muesliswap_onchain_staking.api.util import FixedTxHashTransaction
+
+from test_db_queries import POOL_A, WALLETS, farm_output, make_tx, position_output
+
+FUNDING_INPUT = TransactionInput(TransactionId(bytes.fromhex("ee" * 32)), 0)
+
+
+def wallet_output(wallet: Address = WALLETS[0]) -> TransactionOutput:
+    return TransactionOutput(
+        wallet,
+        Value(
+            2_000_000,
+            MultiAsset.from_primitive({bytes.fromhex("44" * 28): {b"OTHER": 1}}),
+        ),
+    )
+
+
+def matches(tx: FixedTxHashTransaction) -> bool:
+    return default_tx_filter().matches(tx.transaction.to_cbor())
+
+
+def as_block(*txs: FixedTxHashTransaction) -> dict:
+    return {
+        "type": "praos",
+        "transactions": [
+            {"id": tx.hash, "cbor": tx.transaction.to_cbor_hex()} for tx in txs
+        ],
+    }
+
+
+def test_matches():
+    assert matches(make_tx([position_output(POOL_A, 100, 0, 0, 0)], [FUNDING_INPUT]))
+    assert matches(make_tx([wallet_output(batching_address)], [FUNDING_INPUT]))
+    # a farm NFT held outside of the staking address
+    farm = farm_output(POOL_A, 100, 1)
+    assert matches(make_tx([wallet_output(), farm], [FUNDING_INPUT]))
+    farm.address = WALLETS[1]
+    assert matches(make_tx([farm], [FUNDING_INPUT]))
+    assert not matches(make_tx([wallet_output()], [FUNDING_INPUT]))
+
+
+def test_false_positive():
+    # the script hash of the staking address used as the key hash of a wallet
+    lookalike = Address(
+        VerificationKeyHash(staking_address.payment_part.payload),
+        network=Network.TESTNET,
+    )
+    tx = make_tx([wallet_output(lookalike)], [FUNDING_INPUT])
+    assert matches(tx)
+    # decoding it anyway finds nothing to track
+    [(_, decoded)] = relevant_txs(
+        ogmios_iterator.txs_from_block(as_block(tx), default_tx_filter()),
+        TrackedOutputs(),
+    )
+    assert decoded.transaction.transaction_body.outputs[0].address == lookalike
+
+
+def test_input_tx_hashes_of_spend_only_tx():
+    created = make_tx([position_output(POOL_A, 100, 0, 0, 0)], [FUNDING_INPUT])
+    spend = make_tx(
+        [wallet_output()],
+        [TransactionInput(TransactionId.from_primitive(created.hash), 0)],
+    )
+    assert not matches(spend)
+    assert created.hash in input_tx_hashes(spend.transaction.to_cbor())
+    assert FUNDING_INPUT.transaction_id.payload.hex() in input_tx_hashes(
+        created.transaction.to_cbor()
+    )
+
+
+def test_skipped_txs_are_decoded_when_spending_tracked_outputs():
+    created = make_tx([position_output(POOL_A, 100, 0, 0, 0)], [FUNDING_INPUT])
+    spend = make_tx(
+        [wallet_output()],
+        [TransactionInput(TransactionId.from_primitive(created.hash), 0)],
+    )
+    unrelated = make_tx([wallet_output()], [FUNDING_INPUT])
+    txs = ogmios_iterator.txs_from_block(
+        as_block(created, spend, unrelated), default_tx_filter()
+    )
+    assert isinstance(txs[0], FixedTxHashTransaction)
+    assert all(isinstance(tx, ogmios_iterator.UndecodedTransaction) for tx in txs[1:])
+    assert txs[1].hash == spend.hash
+
+    # without tracked outputs only the matching transaction is decoded
+    assert [i for i, _ in relevant_txs(txs, TrackedOutputs())] == [0]
+
+    tracked_outputs = TrackedOutputs()
+    tracked_outputs.add((created.hash, 0))
+    decoded = list(relevant_txs(txs, tracked_outputs))
+    assert [i for i, _ in decoded] == [0, 1]
+    assert decoded[1][1].hash == spend.hash
+    assert decoded[1][1].transaction.to_cbor_hex() == spend.transaction.to_cbor_hex()